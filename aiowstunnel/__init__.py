@@ -3,3 +3,4 @@ CONNECT = 'connect'
 
 from .server import Server  # NOQA
 from .client import Client  # NOQA
+from .multiserver import MultiServer  # NOQA
@@ -0,0 +1,186 @@
+"""
+This module implements the :class:`~Balancer` class, spreading the
+forwarded connections of ``CONNECT`` mode tunnels over several targets.
+
+Targets are ``(host, port)`` or ``(host, port, weight)`` tuples. With
+:data:`LEAST_CONNECTIONS` a new connection goes to the target with the
+fewest open connections per weight, with :data:`WEIGHTED` the targets take
+turns in proportion to their weight (smooth weighted round robin).
+
+Every ``check_interval`` seconds each target is probed with a TCP connect
+of at most ``check_timeout`` seconds. A target failing ``fall`` times in a
+row, probes and real connects alike, is ejected until ``rise`` probes in a
+row succeed. A connect failing is retried on the next target, so a dead
+target costs a retry instead of a ``Reject``. When every target is ejected
+they are all tried anyway.
+"""
+
+import asyncio
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+LEAST_CONNECTIONS = 'least-connections'
+WEIGHTED = 'weighted'
+
+
+class Target:
+    __slots__ = (
+        'host', 'port', 'weight', 'active', 'connects', 'failures',
+        'healthy', 'fails', 'rises', 'current', 'connect_time'
+    )
+
+    def __init__(self, host, port, weight=1):
+        self.host, self.port = host, port
+        self.weight = weight
+        self.active = 0  # open forwarded connections
+        self.connects = 0
+        self.failures = 0
+        self.healthy = True
+        self.fails = 0  # failures in a row
+        self.rises = 0  # successful probes in a row while ejected
+        self.current = 0  # smooth weighted round robin
+        self.connect_time = None  # smoothed, seconds
+
+    def __str__(self):
+        return '{}:{}'.format(self.host, self.port)
+
+    def as_dict(self):
+        return {
+            'host': self.host,
+            'port': self.port,
+            'weight': self.weight,
+            'healthy': self.healthy,
+            'active': self.active,
+            'connects': self.connects,
+            'connectFailures': self.failures,
+            'connectTime': self.connect_time
+        }
+
+
+class Balancer:
+    def __init__(
+        self, targets, method=LEAST_CONNECTIONS, connect=None,
+        check_interval=5, check_timeout=2, fall=2, rise=1, loop=None
+    ):
+        assert method in (LEAST_CONNECTIONS, WEIGHTED)
+        self.targets = [Target(*target) for target in targets]
+        assert self.targets
+        self.method = method
+        self.connect = connect or asyncio.open_connection
+        self.check_interval, self.check_timeout = check_interval, check_timeout
+        self.fall, self.rise = fall, rise
+        self.loop = asyncio.get_event_loop() if loop is None else loop
+        self._checker = None
+
+    def start(self):
+        if self._checker is None and self.check_interval:
+            self._checker = asyncio.ensure_future(self._check())
+
+    async def close(self):
+        if self._checker is not None and not self._checker.done():
+            self._checker.cancel()
+            try:
+                await self._checker
+            except asyncio.CancelledError:
+                pass
+        self._checker = None
+
+    def stats(self):
+        return [target.as_dict() for target in self.targets]
+
+    def choose(self, exclude=()):
+        """
+        The :class:`Target` for a new connection, ``None`` if all are
+        excluded.
+        """
+        candidates = [t for t in self.targets if t not in exclude]
+        healthy = [t for t in candidates if t.healthy]
+        candidates = healthy or candidates
+        if not candidates:
+            return None
+        if self.method == LEAST_CONNECTIONS:
+            # among equals the one used least, so they take turns
+            return min(candidates, key=lambda t: (
+                t.active / t.weight, t.connects / t.weight
+            ))
+        total = 0
+        for t in candidates:
+            t.current += t.weight
+            total += t.weight
+        target = max(candidates, key=lambda t: t.current)
+        target.current -= total
+        return target
+
+    async def open_connection(self):
+        """
+        Connect to a target, trying the others if it fails. Returns the
+        :class:`Target` and the reader and writer, raises the exception of
+        the last target tried. The target counts the connection in
+        ``Target.active`` from the start of the connect, the caller calls
+        :meth:`release` when it is closed.
+        """
+        tried, error = [], None
+        while True:
+            target = self.choose(tried)
+            if target is None:
+                raise error
+            tried.append(target)
+            # busy already, so concurrent connects spread over the targets
+            target.active += 1
+            start = self.loop.time()
+            try:
+                r, w = await self.connect(target.host, target.port)
+            except OSError as exc:
+                error = exc
+                target.active -= 1
+                target.failures += 1
+                self._failed(target)
+                msg = 'can not connect to target {} ({})'
+                logger.info(msg.format(target, exc))
+                continue
+            except BaseException:
+                target.active -= 1
+                raise
+            elapsed = self.loop.time() - start
+            target.connects += 1
+            target.fails = 0
+            if target.connect_time is None:
+                target.connect_time = elapsed
+            else:
+                target.connect_time += (elapsed - target.connect_time) / 8
+            return target, r, w
+
+    def release(self, target):
+        target.active -= 1
+
+    def _failed(self, target):
+        target.fails += 1
+        target.rises = 0
+        if target.healthy and target.fails >= self.fall:
+            target.healthy = False
+            logger.warning('target {} ejected'.format(target))
+
+    async def _probe(self, target):
+        try:
+            r, w = await asyncio.wait_for(
+                self.connect(target.host, target.port), self.check_timeout
+            )
+        except (OSError, asyncio.TimeoutError):
+            self._failed(target)
+            return
+        w.close()
+        target.fails = 0
+        if not target.healthy:
+            target.rises += 1
+            if target.rises >= self.rise:
+                target.healthy = True
+                target.rises = 0
+                logger.warning('target {} back'.format(target))
+
+    async def _check(self):
+        while True:
+            await asyncio.gather(*[self._probe(t) for t in self.targets])
+            await asyncio.sleep(self.check_interval)
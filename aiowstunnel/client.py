@@ -1,9 +1,19 @@
 import asyncio
 import logging
+import os
+import time
 
 import websockets
 
-from .connection import Connection
+from .connection import Connection, SUBPROTOCOL, DRAIN_CHECK
+from .listener import Listener
+from .compression import CODECS
+from .metrics import Metrics
+from .resolver import Resolver
+from .session import Sessions
+from .balancer import Balancer, LEAST_CONNECTIONS
+from . import history
+from . import fwd_connection
 from . import LISTEN, CONNECT
 
 
@@ -18,7 +28,21 @@ class Client:
         connect_host, connect_port,
         ssl=None,
         initial_delay=1, delay_factor=1.2, max_delay=10,
-        response_timeout=5, heartbeat_interval=10
+        response_timeout=5, heartbeat_interval=10,
+        window_size=fwd_connection.INITIAL_WINDOW,
+        window_min=fwd_connection.WINDOW_MIN,
+        window_max=fwd_connection.WINDOW_MAX,
+        batch_size=0, batch_delay=0.001,
+        stream_weight=1,
+        read_size_min=fwd_connection.READ_SIZE_MIN,
+        read_size_max=fwd_connection.READ_SIZE_MAX, read_delay=0,
+        compression=None, ws_compression='deflate', early_data=0,
+        connect_pool_min=0, connect_pool_max=0, connect_pool_ttl=30,
+        dns_ttl=60, dns_negative_ttl=5, connect_timeout=10,
+        targets=None, balance=LEAST_CONNECTIONS,
+        health_interval=5, health_timeout=2,
+        resume_timeout=0,
+        pool_size=1
     ):
         assert server_mode in (LISTEN, CONNECT)
 
@@ -38,12 +62,59 @@ class Client:
             'wss' if ssl else 'ws',
             tunnel_host, tunnel_port, server_mode, self.fwd_host, self.fwd_port
         )
+        # with a pool of websockets the server groups them by a random id,
+        # they share one listener on the listening side, that also outlives
+        # reconnects
+        self.pool_size = pool_size
+        self.group = None
+        self.listener = None
+        if pool_size > 1:
+            self.group = os.urandom(8).hex()
+            self.url += '/' + self.group
+        if self.mode == LISTEN:
+            self.listener = Listener(self.conn_host, self.conn_port)
 
         self.initial_delay = initial_delay
         self.delay_factor = delay_factor
         self.max_delay = max_delay
         self.response_timeout = response_timeout
         self.heartbeat_interval = heartbeat_interval
+        self.window_size = window_size
+        self.window_min, self.window_max = window_min, window_max
+        self.batch_size, self.batch_delay = batch_size, batch_delay
+        self.stream_weight = stream_weight
+        self.read_size_min, self.read_size_max = read_size_min, read_size_max
+        self.read_delay = read_delay
+        assert compression is None or compression in CODECS
+        self.compression = compression
+        self.ws_compression = ws_compression
+        self.early_data = early_data
+        self.connect_pool_min = connect_pool_min
+        self.connect_pool_max = connect_pool_max
+        self.connect_pool_ttl = connect_pool_ttl
+        self.dns_ttl, self.dns_negative_ttl = dns_ttl, dns_negative_ttl
+        self.connect_timeout = connect_timeout
+
+        self.metrics = Metrics()
+        # connecting side: spread the connections over targets instead of
+        # connect_host:connect_port
+        self.targets, self.balance = targets, balance
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        # built by task() on the running loop
+        self.resolver = None
+        self.balancer = None
+        self.history = history.History()
+        # resumable sessions, the token of each member of the pool
+        self.resume_timeout = resume_timeout
+        self.sessions = None  # built by task() on the running loop
+        self.tokens = [b''] * pool_size
+
+        self.connections = []  # open tunnels
+        # tunnels finishing their streams on a draining server
+        self._draining_tunnels = set()
+        # since, deadline and streams at start while draining
+        self.draining = None
 
         self._task = None
         self._task_cancelled = False
@@ -64,32 +135,86 @@ class Client:
         except:
             pass
 
-    async def try_connect(self):
+    async def try_connect(self, member=0):
         # do not raise or raise CancelledError to stop,
         # raise stg else to retry
-        ws = await websockets.connect(self.url, ssl=self.ssl)
+        ws = await websockets.connect(
+            self.url, ssl=self.ssl, compression=self.ws_compression,
+            subprotocols=[SUBPROTOCOL]
+        )
         logger.info('connected to {}'.format(self.url))
         conn = Connection(
             self.mode,
             self.conn_host, self.conn_port,
-            ws, self.response_timeout, self.heartbeat_interval
+            ws, self.response_timeout, self.heartbeat_interval,
+            window_size=self.window_size,
+            window_min=self.window_min, window_max=self.window_max,
+            batch_size=self.batch_size, batch_delay=self.batch_delay,
+            stream_weight=self.stream_weight,
+            read_size_min=self.read_size_min,
+            read_size_max=self.read_size_max,
+            read_delay=self.read_delay,
+            compression=self.compression,
+            early_data=self.early_data,
+            connect_pool_min=self.connect_pool_min,
+            connect_pool_max=self.connect_pool_max,
+            connect_pool_ttl=self.connect_pool_ttl,
+            group=self.group, listener=self.listener, metrics=self.metrics,
+            history=self.history, resolver=self.resolver,
+            balancer=self.balancer,
+            resume_timeout=self.resume_timeout, sessions=self.sessions,
+            token=self.tokens[member]
         )
+        handler = asyncio.ensure_future(self.handle(conn, member))
         try:
-            await conn.handle()
-        except:
-            await self.safe_close(ws)
+            await asyncio.wait(
+                [handler, conn.peer_draining],
+                return_when=asyncio.FIRST_COMPLETED
+            )
+        except asyncio.CancelledError:
+            handler.cancel()  # the tunnel closes
+            await asyncio.wait([handler])
             raise
-        await self.safe_close(ws)
+        if handler.done():
+            handler.result()
+            return
+        # the server drains: this tunnel finishes its streams, a new one
+        # takes the new streams
+        logger.info('server draining, reconnecting to {}'.format(self.url))
+        self.tokens[member] = b''
+        self._draining_tunnels.add(handler)
+        handler.add_done_callback(self._drained)
+
+    async def handle(self, conn, member):
+        self.history.members += 1
+        self.connections.append(conn)
+        try:
+            await conn.handle()
+        finally:
+            self.history.members -= 1
+            self.connections.remove(conn)
+            if not conn.peer_draining.done():
+                self.tokens[member] = conn.token if conn.parked else b''
+            await self.safe_close(conn.ws)
+
+    def _drained(self, handler):
+        self._draining_tunnels.discard(handler)
+        if not handler.cancelled() and handler.exception() is not None:
+            msg = 'draining tunnel failed ({})'
+            logger.error(msg.format(handler.exception()))
 
-    async def wait_loop(self):
+    async def wait_loop(self, member=0):
         for waitsec in self.intervals():
+            if self.draining is not None:
+                break
             try:
-                await self.try_connect()
+                await self.try_connect(member)
             except asyncio.CancelledError:
                 break
             except Exception as exc:
                 msg = 'connection to {} failed ({}), waiting {:.2f} seconds'
                 logger.error(msg.format(self.url, exc, waitsec))
+                self.metrics.reconnects.labels().inc()
                 try:
                     await asyncio.sleep(waitsec)
                 except asyncio.CancelledError:
@@ -97,11 +222,96 @@ class Client:
             else:
                 break
 
+    async def member_task(self, member=0):
+        while True:
+            await self.wait_loop(member)
+            if self._task_cancelled or self.draining is not None:
+                break
+            self.metrics.reconnects.labels().inc()
+
+    def history_stats(self, period=None):
+        """
+        The throughput history of the tunnel, see :mod:`~aiowstunnel.history`.
+        """
+        return self.history.query(time.time(), period)
+
+    async def _sample_history(self):
+        while True:
+            await asyncio.sleep(history.SAMPLE_INTERVAL - time.time() % 1)
+            self.history.sample(time.time())
+
     async def task(self):
-        while not self._task_cancelled:
-            await self.wait_loop()
+        loop = asyncio.get_event_loop()
+        self.resolver = Resolver(
+            self.dns_ttl, self.dns_negative_ttl, self.connect_timeout,
+            metrics=self.metrics, loop=loop
+        )
+        self.sessions = Sessions(self.resume_timeout, loop=loop)
+        if self.targets and self.mode == CONNECT:
+            self.balancer = Balancer(
+                self.targets, self.balance, self.resolver.open_connection,
+                self.health_interval, self.health_timeout, loop=loop
+            )
+        # every member of the pool reconnects on its own
+        sampler = asyncio.ensure_future(self._sample_history())
+        if self.balancer is not None:
+            self.balancer.start()
+        try:
+            await asyncio.gather(
+                *[self.member_task(i) for i in range(self.pool_size)]
+            )
+        finally:
+            sampler.cancel()
+            tunnels = list(self._draining_tunnels)
+            for handler in tunnels:
+                handler.cancel()
+            if tunnels:
+                await asyncio.wait(tunnels)
+            await self.sessions.close()
+            if self.balancer is not None:
+                await self.balancer.close()
         logger.info('connection closed')
 
+    def streams(self):
+        return sum(len(conn.connections) for conn in self.connections)
+
+    def drain_stats(self):
+        """
+        The progress of :meth:`drain`, ``None`` if the client is not
+        draining.
+        """
+        if self.draining is None:
+            return None
+        return dict(self.draining, streams=self.streams())
+
+    async def drain(self, timeout):
+        """
+        Stop taking new forwarded connections and reconnecting, tell the
+        server, wait at most ``timeout`` seconds for the open streams to
+        finish, then close the client.
+        """
+        if not self._task or self.draining is not None:
+            return
+        now = time.time()
+        self.draining = {
+            'since': now,
+            'deadline': now + timeout,
+            'streamsAtStart': self.streams()
+        }
+        logger.info('draining, {} streams'.format(self.streams()))
+        if self.listener is not None:
+            await self.listener.close()
+        for conn in list(self.connections):
+            await conn.drain()
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while self.streams() and loop.time() < deadline:
+            await asyncio.sleep(DRAIN_CHECK)
+        if self.streams():
+            msg = 'drain deadline passed, closing {} streams'
+            logger.warning(msg.format(self.streams()))
+        await self.close()
+
     async def close(self):
         if not self._task:
             return
@@ -0,0 +1,167 @@
+"""
+Compression of the data of forwarded connections.
+
+When a tunnel is set up with a ``compression`` codec, each side of a
+stream announces the codecs it can decompress with a
+:class:`~aiowstunnel.packets.Compress` packet. Once the peer's announcement
+arrives, the stream sends its data in
+:class:`~aiowstunnel.packets.ZData` packets compressed with the configured
+codec, or with zlib if the peer can not decompress that one. zlib keeps
+its dictionary for the whole stream, so small messages of text protocols
+compress well too.
+
+Data that does not compress is not worth the CPU: a stream starting with a
+TLS record is sent as it is, and a stream whose recent data shrank by less
+than ``1 - MIN_RATIO`` stops compressing. It tries again after sending
+``REPROBE`` bytes uncompressed.
+"""
+
+import struct
+import time
+import zlib
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+
+# codec bits of the Compress packet, codec numbers of ZData
+ZLIB = 1
+LZ4 = 2
+
+CODECS = {'zlib': ZLIB, 'lz4': LZ4}
+NAMES = {codec: name for name, codec in CODECS.items()}
+
+ZLIB_LEVEL = 1
+MIN_SIZE = 32  # smaller chunks are not compressed
+PROBE_SIZE = 64 * 1024  # bytes compressed before judging the ratio
+MIN_RATIO = 0.9  # compressed / raw above this means incompressible
+REPROBE = 4 * 1024 * 1024  # bytes sent uncompressed before trying again
+
+_lz4_size = struct.Struct('<I')
+_errors = (zlib.error, ValueError)
+if lz4 is not None:
+    _errors += (getattr(lz4.block, 'LZ4BlockError', ValueError), )
+
+
+class CompressionError(Exception):
+    pass
+
+
+def available():
+    """
+    The bits of the codecs this side can decompress.
+    """
+    codecs = ZLIB
+    if lz4 is not None:
+        codecs |= LZ4
+    return codecs
+
+
+def choose(name, peer_codecs):
+    """
+    The codec to send with: ``name`` if the peer can decompress it, else
+    zlib if it can, else None.
+    """
+    codec = CODECS[name]
+    if codec & peer_codecs & available():
+        return codec
+    if ZLIB & peer_codecs:
+        return ZLIB
+    return None
+
+
+def looks_encrypted(data):
+    # a TLS record: content type 20-23, protocol major version 3
+    return len(data) >= 2 and 20 <= data[0] <= 23 and data[1] == 3
+
+
+class Compressor:
+    def __init__(self, codec):
+        self.codec = codec
+        if codec == ZLIB:
+            self._zlib = zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED, -15)
+        self.enabled = True
+        self.raw = 0  # bytes given to the codec
+        self.compressed = 0  # bytes it made of them
+        self.cpu = 0.0  # seconds spent compressing
+        self._started = False
+        self._probe_raw = 0
+        self._probe_compressed = 0
+        self._plain = 0  # bytes sent uncompressed since disabled
+
+    @property
+    def ratio(self):
+        if not self.raw:
+            return None
+        return self.compressed / self.raw
+
+    def compress(self, data):
+        """
+        Return the compressed ``data``, or None to send it as it is.
+        """
+        if not self._started:
+            self._started = True
+            if looks_encrypted(data):
+                self.enabled = False
+        if not self.enabled:
+            self._plain += len(data)
+            if self._plain < REPROBE:
+                return None
+            self.enabled = True
+            self._plain = 0
+        if len(data) < MIN_SIZE:
+            return None
+
+        start = time.process_time()
+        if self.codec == ZLIB:
+            z = self._zlib
+            out = z.compress(data) + z.flush(zlib.Z_SYNC_FLUSH)
+        else:
+            out = lz4.block.compress(data, mode='fast')
+        self.cpu += time.process_time() - start
+
+        self.raw += len(data)
+        self.compressed += len(out)
+        self._probe_raw += len(data)
+        self._probe_compressed += len(out)
+        if self._probe_raw >= PROBE_SIZE:
+            if self._probe_compressed > self._probe_raw * MIN_RATIO:
+                self.enabled = False
+            self._probe_raw = self._probe_compressed = 0
+        return out
+
+
+class Decompressor:
+    def __init__(self, codec):
+        if codec == ZLIB:
+            self._zlib = zlib.decompressobj(-15)
+        elif codec != LZ4 or lz4 is None:
+            raise CompressionError('unknown codec {}'.format(codec))
+        self.codec = codec
+        self.cpu = 0.0  # seconds spent decompressing
+
+    def decompress(self, codec, data, limit):
+        """
+        Decompress ``data``, raise :class:`CompressionError` if it is
+        invalid or would be longer than ``limit`` bytes.
+        """
+        if codec != self.codec:
+            raise CompressionError('codec changed')
+        start = time.process_time()
+        try:
+            if codec == ZLIB:
+                z = self._zlib
+                out = z.decompress(data, max(limit, 1))
+                if z.unconsumed_tail:
+                    raise CompressionError('data exceeds the window')
+            else:
+                if len(data) < 4 or _lz4_size.unpack_from(data)[0] > limit:
+                    raise CompressionError('data exceeds the window')
+                out = lz4.block.decompress(data)
+        except _errors as exc:
+            raise CompressionError(exc)
+        finally:
+            self.cpu += time.process_time() - start
+        return out
@@ -0,0 +1,119 @@
+"""
+This module implements the :class:`~ConnectPool` class, idle connections
+to the target of a ``CONNECT`` mode tunnel opened in advance, so a
+``Request`` can be accepted without waiting for the TCP handshake.
+
+The pool keeps at least ``min_idle`` connections. Every miss (a request
+finding the pool empty) raises its target by one, up to ``max_idle``; an
+idle connection unused for ``idle_ttl`` seconds is closed and lowers the
+target again, down to ``min_idle``. Connections the target closed while
+idle are dropped. What the target sent before a connection was taken (a
+banner, for example) is kept in its reader. Connections are opened with
+``connect``, ``asyncio.open_connection`` by default.
+"""
+
+import asyncio
+import collections
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+RETRY_MIN = 0.5  # seconds to wait after a failed connect, doubling
+RETRY_MAX = 30
+
+
+class ConnectPool:
+    def __init__(
+        self, host, port, min_idle=0, max_idle=4, idle_ttl=30, connect=None
+    ):
+        self.host, self.port = host, port
+        self.connect = connect or asyncio.open_connection
+        self.min_idle, self.max_idle = min(min_idle, max_idle), max_idle
+        self.idle_ttl = idle_ttl
+        self.target = self.min_idle
+        self.idle = collections.deque()  # (r, w, time opened)
+        self.hits = 0
+        self.misses = 0
+        self.loop = asyncio.get_event_loop()
+        self._filler = None
+        self._reaper = None
+        self._closed = False
+
+    def __len__(self):
+        return len(self.idle)
+
+    def start(self):
+        self._reaper = asyncio.ensure_future(self._reap())
+        self._fill_soon()
+
+    async def get(self):
+        """
+        An open connection to the target, from the pool if there is one.
+        Raises what ``asyncio.open_connection`` raises.
+        """
+        while self.idle:
+            r, w, _ = self.idle.popleft()
+            if r.at_eof() or w.transport.is_closing():
+                w.close()
+                continue
+            self.hits += 1
+            self._fill_soon()
+            return r, w
+        self.misses += 1
+        self.target = min(self.target + 1, self.max_idle)
+        self._fill_soon()
+        return await self.connect(self.host, self.port)
+
+    def _fill_soon(self):
+        if self._closed:
+            return
+        if self._filler is None or self._filler.done():
+            self._filler = asyncio.ensure_future(self._fill())
+
+    async def _fill(self):
+        delay = RETRY_MIN
+        while not self._closed and len(self.idle) < self.target:
+            try:
+                r, w = await self.connect(self.host, self.port)
+            except OSError as exc:
+                msg = 'pool can not connect to {}:{} ({})'
+                logger.info(msg.format(self.host, self.port, exc))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RETRY_MAX)
+                continue
+            if self._closed:
+                w.close()
+                break
+            self.idle.append((r, w, self.loop.time()))
+            delay = RETRY_MIN
+
+    async def _reap(self):
+        while True:
+            await asyncio.sleep(self.idle_ttl / 2)
+            deadline = self.loop.time() - self.idle_ttl
+            while self.idle and self.idle[0][2] < deadline:
+                r, w, _ = self.idle.popleft()
+                w.close()
+                self.target = max(self.target - 1, self.min_idle)
+            # drop what the target closed
+            for item in list(self.idle):
+                r, w, _ = item
+                if r.at_eof() or w.transport.is_closing():
+                    self.idle.remove(item)
+                    w.close()
+            self._fill_soon()
+
+    async def close(self):
+        self._closed = True
+        for task in (self._filler, self._reaper):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        while self.idle:
+            r, w, _ = self.idle.popleft()
+            w.close()
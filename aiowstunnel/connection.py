@@ -8,24 +8,192 @@ from . import packets
 from . import CONNECT, LISTEN
 from . import ids
 from . import fwd_connection
+from . import scheduler
+from . import listener
+from .metrics import Metrics
+from .history import History
+from .connect_pool import ConnectPool
+from .resolver import Resolver
+from . import session
 
 
 logger = logging.getLogger(__name__)
 
 
+# Peers offering this websocket subprotocol exchange Greeting packets,
+# others are older versions and get none.
+SUBPROTOCOL = 'aiowstunnel'
+# 2: stream ids are varints (see packets.varint)
+PROTOCOL_VERSION = 2
+# stream ids of a tunnel, by protocol version (0: peers without Greeting)
+STREAM_IDS = {0: 1 << 16, 1: 1 << 16, 2: 1 << 20}
+# Greeting.features
+BATCH = 1
+COMPRESS = 2
+EARLY_DATA = 4
+RESUME = 8
+DRAIN = 16
+FEATURES = BATCH | COMPRESS | EARLY_DATA | RESUME | DRAIN
+# seconds between checks for the open streams while draining
+DRAIN_CHECK = 0.1
+
+
 class TunnelListenError(Exception):
     def __init__(self, msg='other side can not listen'):
         super(TunnelListenError, self).__init__(msg)
 
 
+class TunnelHandshakeError(Exception):
+    def __init__(self, msg='greeting not received'):
+        super(TunnelHandshakeError, self).__init__(msg)
+
+
 class Connection:
+    """
+    One tunnel, multiplexing forwarded connections on a websocket.
+
+    Outgoing packets are queued in a :class:`~aiowstunnel.scheduler.
+    Scheduler` and sent by a single writer task, forwarded connections
+    share the websocket in proportion to their weight. ``stream_weight`` is
+    an integer or a callable returning the weight for a new
+    :class:`~aiowstunnel.fwd_connection.FwdConnection`.
+
+    Forwarded connections read from their sockets in chunks adapting
+    between ``read_size_min`` and ``read_size_max`` bytes. With a positive
+    ``read_delay`` a short read waits up to that many seconds for more
+    data before it is sent.
+
+    With a positive ``batch_size`` the writer coalesces packets into
+    :class:`~aiowstunnel.packets.Batch` frames of up to ``batch_size``
+    bytes. A packet waits at most ``batch_delay`` seconds for others to
+    join it. Both sides of the tunnel must support batches.
+
+    With a ``compression`` codec (see :mod:`~aiowstunnel.compression`)
+    the data of forwarded connections is compressed, where the peer
+    supports it and the data compresses well. Both sides of the tunnel
+    must support the compression packets.
+
+    Counters and histograms are updated in ``metrics``, a
+    :class:`~aiowstunnel.metrics.Metrics` shared by the connections of a
+    server or client, and in ``history``, the
+    :class:`~aiowstunnel.history.History` of the tunnel.
+
+    With a positive ``early_data`` forwarded connections from the
+    listener do not wait for the ``Accept``: up to that many bytes (at most
+    the initial window) are read and sent as
+    :class:`~aiowstunnel.packets.EarlyData` right after the ``Request``,
+    and the connecting side writes them once its target connection is
+    open. Both sides of the tunnel must support early data.
+
+    If the websocket has the :data:`SUBPROTOCOL`, both sides start with a
+    :class:`~aiowstunnel.packets.Greeting` and adapt to each other: the
+    lower protocol version is used (version 2 has room for
+    :data:`STREAM_IDS` streams), features the peer lacks (batches,
+    compression, early data) are turned off, streams start with the
+    windows the sides announced (``window_size``) and packets are kept
+    within the largest frame the peer accepts. Without it the peer is an
+    older version, spoken to in protocol version 0: no batches,
+    compression, early data or resume, and ``Continue`` packets grant
+    :data:`~aiowstunnel.packets.LEGACY_CREDIT` data packets instead of
+    bytes.
+
+    In ``CONNECT`` mode the target is connected to with ``resolver``, a
+    :class:`~aiowstunnel.resolver.Resolver` caching the lookups, shared by
+    the connections of a server or client. With a positive
+    ``connect_pool_max`` idle connections to the target are opened in
+    advance, see :class:`~aiowstunnel.connect_pool.ConnectPool`. With a
+    ``balancer`` (a :class:`~aiowstunnel.balancer.Balancer`) forwarded
+    connections go to its targets instead, without a pool.
+
+    With a positive ``resume_timeout`` on both sides (and a Greeting) the
+    tunnel is a resumable session, see :mod:`~aiowstunnel.session`. The
+    side that opened the websocket passes ``token``, the token of the
+    session to resume or ``b''``, the other side looks it up in
+    ``sessions``, where a connection losing its websocket is parked. On
+    resume both sides send an :class:`~aiowstunnel.packets.Ack` for every
+    stream they still have, with the bytes received and the window from
+    there; streams the peer does not acknowledge are closed, the others
+    send again what the peer has not received. Acks are also sent with
+    every ``Continue``, so the replay buffers are bounded by the windows.
+    Resumable streams are not compressed: the codecs keep state across
+    packets.
+
+    In ``LISTEN`` mode the connection joins ``listener``, a
+    :class:`~aiowstunnel.listener.Listener` shared with the other
+    connections of its ``group``, or a listener of its own.
+
+    A draining connection (see :meth:`drain`) rejects new ``Request``
+    packets and tells the peer with a :class:`~aiowstunnel.packets.Drain`
+    packet, if the peer supports it. Listeners do not give new streams to
+    connections draining on either side, and ``peer_draining`` is resolved
+    when the peer drains, so a client can open another tunnel.
+    """
+
     def __init__(
-        self, mode, host, port, ws, response_timeout, heartbeat_interval
+        self, mode, host, port, ws, response_timeout, heartbeat_interval,
+        window_size=fwd_connection.INITIAL_WINDOW,
+        window_min=fwd_connection.WINDOW_MIN,
+        window_max=fwd_connection.WINDOW_MAX,
+        batch_size=0, batch_delay=0.001,
+        stream_weight=1,
+        read_size_min=fwd_connection.READ_SIZE_MIN,
+        read_size_max=fwd_connection.READ_SIZE_MAX,
+        read_delay=0, compression=None, early_data=0,
+        connect_pool_min=0, connect_pool_max=0, connect_pool_ttl=30,
+        group=None, listener=None, metrics=None, history=None,
+        resolver=None, balancer=None,
+        resume_timeout=0, sessions=None, token=None
     ):
         self.mode, self.host, self.port, self.ws = mode, host, port, ws
         self.response_timeout = response_timeout
         self.heartbeat_interval = heartbeat_interval
-        self._listener = None
+        self.window_size = window_size
+        self.window_min, self.window_max = window_min, window_max
+        self.batch_size, self.batch_delay = batch_size, batch_delay
+        self.stream_weight = stream_weight
+        self.read_size_min, self.read_size_max = read_size_min, read_size_max
+        self.read_delay = read_delay
+        self.compression = compression
+        self.early_data = early_data
+        # CONNECT side, Request id: early data received while connecting
+        # (a list), then the FwdConnection of the stream
+        self.early = {}
+        # the initial stream windows, the peer's one from its Greeting
+        self.initial_window = fwd_connection.INITIAL_WINDOW
+        self.peer_window = fwd_connection.INITIAL_WINDOW
+        self.peer = None  # the Greeting of the peer
+        # the protocol version used with it, 0 without a Greeting
+        self.version = 0
+        self.resume_timeout = resume_timeout
+        self.resume = False  # negotiated
+        self.sessions = sessions
+        self.token = token
+        self.parked = False
+        self.running = False  # started, the streams can send updates
+        self.started = ws.loop.create_future()  # the mode started
+        self.draining = False
+        self.peer_draining = ws.loop.create_future()
+        self.metrics = Metrics() if metrics is None else metrics
+        if resolver is None:
+            resolver = Resolver(metrics=self.metrics)
+        self.resolver = resolver
+        self.balancer = balancer
+        self.connect_pool = None
+        if mode == CONNECT and connect_pool_max > 0 and balancer is None:
+            self.connect_pool = ConnectPool(
+                host, port, connect_pool_min, connect_pool_max,
+                connect_pool_ttl, connect=resolver.open_connection
+            )
+        self.history = History() if history is None else history
+        self.scheduler = scheduler.Scheduler(ws.loop)
+        self.scheduler.queue_wait = self.metrics.queue_wait.labels()
+        self._out_waiter = None  # writer waits for packets
+        self._out_full = None  # writer waits for a full batch
+        self._writer_task = None
+        self.frames_out = 0
+        self.packets_out = 0
+        self.group = group
+        self.listener = listener
         self.connections = ids.Ids()
         self._heartbeat_task = None
         self.id = None
@@ -38,12 +206,68 @@ class Connection:
     async def wait_closed(self):
         await self.done
 
-    async def send_safe(self, packet):
+    async def send_safe(self, packet, flow=None):
+        if self._writer_task is None or self._writer_task.done():
+            await self._send_frame(packets.encode(packet, self.version))
+            self.packets_out += 1
+            self.history.packets_out += 1
+            self.metrics.packets_out[packet.code].value += 1
+            return
+        self.scheduler.push(packet, flow)
+        if self._out_waiter and not self._out_waiter.done():
+            self._out_waiter.set_result(None)
+        if self.scheduler.bytes >= self.batch_size:
+            if self._out_full and not self._out_full.done():
+                self._out_full.set_result(None)
+        if flow is not None:
+            # let the writer catch up before queueing more
+            await flow.wait_space()
+
+    async def _send_frame(self, frame):
         try:
-            await self.ws.send(packet.as_bytes)
-        except:
+            await self.ws.send(frame)
+            self.frames_out += 1
+            self.metrics.frames_out.value += 1
+            self.metrics.ws_out.value += len(frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
             pass
 
+    async def _writer(self):
+        loop = self.ws.loop
+        packets_out = self.metrics.packets_out
+        try:
+            while True:
+                if not self.scheduler:
+                    self._out_waiter = loop.create_future()
+                    await self._out_waiter
+                    self._out_waiter = None
+                if self.scheduler.bytes < self.batch_size:
+                    self._out_full = loop.create_future()
+                    try:
+                        await asyncio.wait_for(
+                            self._out_full, self.batch_delay
+                        )
+                    except asyncio.TimeoutError:
+                        pass
+                    self._out_full = None
+                # without batching take a single packet
+                packs = self.scheduler.take(self.batch_size or 1)
+                if len(packs) == 1:
+                    frame = packets.encode(packs[0], self.version)
+                else:
+                    frame = packets.batch(packs, self.version)
+                await self._send_frame(frame)
+                self.packets_out += len(packs)
+                self.history.packets_out += len(packs)
+                for pack in packs:
+                    packets_out[pack.code].value += 1
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.scheduler.clear()
+
     async def handle_fwd_conn(self, r, w, peer_id=None):
         # this coro will not be cancelled, so we need to make sure
         # the FwdConnection.handle method returns
@@ -51,14 +275,241 @@ class Connection:
         try:
             fwd_conn.id = self.connections.store(fwd_conn)
         except ids.IdException:
-            await fwd_conn.close()
-        else:
+            # out of stream ids, the tunnel goes on without this one
+            msg = 'no free stream id, closing connection from {}'
+            logger.warning(msg.format(fwd_conn.peername))
+            self.metrics.rejects.labels('out').inc()
+            w.close()
             if peer_id is not None:
-                fwd_conn.peer_id = peer_id
-                await self.send_safe(packets.Accept(peer_id, fwd_conn.id))
-            await fwd_conn.handle()
+                self.early.pop(peer_id, None)
+                await self.send_safe(packets.Reject(peer_id))
+                await self.send_safe(packets.Closed(peer_id))
+            return
+        self.metrics.streams_opened.labels().inc()
+        self.history.streams += 1
+        if peer_id is not None:
+            fwd_conn.peer_id = peer_id
+            early = self.early.get(peer_id)
+            self.early[peer_id] = fwd_conn
+            await self.send_safe(packets.Accept(peer_id, fwd_conn.id))
+            for data in early or ():
+                fwd_conn.data(data)
+        await fwd_conn.handle()
+        if peer_id is not None and self.early.get(peer_id) is fwd_conn:
+            del self.early[peer_id]
         del self.connections[fwd_conn.id]
 
+    async def greet(self):
+        window = min(self.window_size, 0xffffffff)
+        features = FEATURES
+        if not self.resume_timeout or self.sessions is None:
+            features &= ~RESUME
+        greeting = packets.Greeting(
+            PROTOCOL_VERSION, features, window, self.ws.max_size or 0
+        )
+        await self.send_safe(greeting)
+        try:
+            pack = await self.get_one_packet(timeout=self.response_timeout)
+        except asyncio.TimeoutError:
+            pack = None
+        if not isinstance(pack, packets.Greeting):
+            raise TunnelHandshakeError()
+        self.initial_window = window
+        self.negotiate(pack)
+
+    def negotiate(self, peer):
+        """
+        Adapt the settings to the :class:`~aiowstunnel.packets.Greeting` of
+        the peer.
+        """
+        if peer.version < 1:
+            raise TunnelHandshakeError('invalid protocol version')
+        self.peer = peer
+        self.version = min(PROTOCOL_VERSION, peer.version)
+        self.connections.cap = STREAM_IDS[self.version]
+        self.peer_window = peer.window
+        if not peer.features & BATCH:
+            self.batch_size = 0
+        if not peer.features & COMPRESS:
+            self.compression = None
+        if not peer.features & EARLY_DATA:
+            self.early_data = 0
+        self.resume = bool(
+            peer.features & RESUME and self.resume_timeout
+            and self.sessions is not None
+        )
+        if self.resume:
+            self.compression = None
+        if peer.max_size:
+            # a batch can exceed batch_size by a packet
+            limit = max((peer.max_size - 64) // 2, 1)
+            self.read_size_max = min(self.read_size_max, limit)
+            self.read_size_min = min(self.read_size_min, self.read_size_max)
+            self.batch_size = min(self.batch_size, limit)
+        msg = 'greeting: version {}, features {}, window {}, max size {}'
+        logger.info(msg.format(*peer))
+
+    def fallback(self):
+        """
+        The peer sends no Greeting, it is an older version: turn off what
+        it does not have, count the flow control windows in packets.
+        """
+        self.version = 0
+        self.connections.cap = STREAM_IDS[self.version]
+        self.batch_size = 0
+        self.compression = None
+        self.early_data = 0
+        logger.info('no greeting, protocol version 0')
+
+    async def _expect(self, klass):
+        pack = await self.get_one_packet(timeout=self.response_timeout)
+        if not isinstance(pack, klass):
+            raise TunnelHandshakeError('session not agreed')
+        return pack
+
+    async def start_session(self):
+        """
+        Agree on the session with the peer. If a parked session is resumed
+        take over its streams, return them with the peer's Acks.
+        """
+        if self.token is not None:
+            # the side that opened the websocket asks
+            await self.send_safe(packets.Resume(0, self.token))
+            pack = await self._expect(packets.Resume)
+            token = bytes(pack.bytes)
+            old = self.sessions.take(self.token) if self.token else None
+            if token != self.token:
+                # a new session, the peer does not know the old one
+                if old is not None:
+                    await old.expire()
+                self.token = token
+                return []
+            acks = await self._read_acks(pack.streams)
+            if old is not None:
+                await self.adopt(old)
+            await self._send_acks()
+        else:
+            pack = await self._expect(packets.Resume)
+            token = bytes(pack.bytes)
+            old = self.sessions.take(token) if token else None
+            same = (self.mode, self.host, self.port)
+            if old is not None and (old.mode, old.host, old.port) != same:
+                await old.expire()  # the token of another tunnel
+                old = None
+            if old is None:
+                self.token = session.new_token()
+                await self.send_safe(packets.Resume(0, self.token))
+                return []
+            self.token = token
+            await self.adopt(old)
+            await self._send_acks()
+            pack = await self._expect(packets.Resume)
+            acks = await self._read_acks(pack.streams)
+        # both sides have sent their Acks, streams both have go on
+        matched = {}
+        for ack in acks:
+            try:
+                fwd_conn = self.connections[ack.peer_id]
+            except KeyError:
+                continue
+            if fwd_conn.peer_id == ack.id:
+                matched[fwd_conn] = ack
+        for fwd_conn in list(self.connections.values()):
+            if fwd_conn.peer_id is not None and fwd_conn not in matched:
+                asyncio.ensure_future(fwd_conn.abandon())
+        msg = 'session resumed, {} streams'
+        logger.info(msg.format(len(matched)))
+        return list(matched.items())
+
+    async def _read_acks(self, count):
+        return [await self._expect(packets.Ack) for _ in range(count)]
+
+    async def _send_acks(self):
+        streams = [
+            fwd_conn for fwd_conn in self.connections.values()
+            if fwd_conn.peer_id is not None
+        ]
+        await self.send_safe(packets.Resume(len(streams), self.token))
+        for fwd_conn in streams:
+            await self.send_safe(fwd_conn.resume_ack())
+
+    async def adopt(self, old):
+        """
+        Take over the streams of ``old``, a parked connection.
+        """
+        self.sessions.resumed += 1
+        self.connections = old.connections
+        self.connections.cap = STREAM_IDS[self.version]
+        self.early = old.early
+        for fwd_conn in self.connections.values():
+            fwd_conn.connection = self
+            fwd_conn.flow = self.scheduler.flow(fwd_conn.flow.weight)
+        if old.connect_pool is not None:
+            await old.connect_pool.close()
+        if self.mode == LISTEN and old.listener is not None:
+            # join before the old one leaves, the port stays open
+            self.listener = old.listener
+            await self.listener.attach(self)
+            await self.listener.detach(old)
+
+    async def park(self):
+        """
+        The websocket is lost: keep the streams for ``resume_timeout``
+        seconds, close the ones not opened yet.
+        """
+        self.parked = True
+        self.running = False
+        for task in (self._heartbeat_task, self._writer_task):
+            if task is not None:
+                task.cancel()
+                await task
+        pending = []
+        for fwd_conn in self.connections.values():
+            fwd_conn.park()
+            if fwd_conn.peer_id is None:
+                pending.append(fwd_conn)
+        for id, early in list(self.early.items()):
+            if isinstance(early, list):
+                del self.early[id]
+        self.sessions.park(self)
+        if pending:
+            await asyncio.wait(
+                [asyncio.ensure_future(c.close()) for c in pending]
+            )
+
+    async def expire(self):
+        """
+        Close the streams of a parked connection.
+        """
+        self.parked = False
+        for fwd_conn in self.connections.values():
+            fwd_conn.unpark()
+        await self.cleanup()
+
+    @property
+    def accepting(self):
+        """
+        Whether new streams can be opened on this connection.
+        """
+        return not (
+            self.parked or self.draining or self.peer_draining.done()
+        )
+
+    async def drain(self):
+        """
+        Take no new streams, tell the peer to open them elsewhere. The open
+        streams go on.
+        """
+        if self.draining:
+            return
+        self.draining = True
+        if self.running:
+            await self._send_drain()
+
+    async def _send_drain(self):
+        if self.peer is not None and self.peer.features & DRAIN:
+            await self.send_safe(packets.Drain())
+
     async def start_connect(self):
         # CancelledError will be thrown
         pack = await self.get_one_packet(timeout=self.response_timeout)
@@ -68,25 +519,24 @@ class Connection:
             logger.info('linstening confirmed')
 
     async def start_listen(self):
+        if self.listener is None:
+            self.listener = listener.Listener(self.host, self.port)
         try:
-            self._listener = await asyncio.start_server(
-                self.handle_fwd_conn,
-                host=self.host, port=self.port
-            )
+            await self.listener.attach(self)
         except asyncio.CancelledError:
             raise
         except:
             msg = 'can not listen on {}:{}'
             raise TunnelListenError(msg.format(self.host, self.port))
         else:
-            msg = 'fwd listening on {}:{}'
-            logger.info(msg.format(self.host, self.port))
             await self.send_safe(packets.ListenOK())
 
     async def get_one_packet(self, timeout=None):
         try:
             frame = await asyncio.wait_for(self.ws.recv(), timeout)
-            packet = packets.get_packet(frame)
+            self.metrics.frames_in.value += 1
+            self.metrics.ws_in.value += len(frame)
+            packet = packets.get_packet(frame, self.version)
             logger.debug('packet in: {}'.format(packet))
             return packet
         except asyncio.TimeoutError:
@@ -108,6 +558,7 @@ class Connection:
                     await asyncio.wait_for(pong, self.response_timeout)
                     logger.debug('.......... heartbeat')
                 except asyncio.TimeoutError:
+                    self.metrics.timeouts.labels('heartbeat').inc()
                     self.ws_close()
                     break
                 await asyncio.sleep(self.heartbeat_interval)
@@ -120,16 +571,37 @@ class Connection:
     async def handle(self):
         # must not raise CancelledError:
         # server and client awaits and cancels this coro
+        self.metrics.tunnels_opened.labels().inc()
         self._heartbeat_task = asyncio.ensure_future(self.heartbeat())
+        self._writer_task = asyncio.ensure_future(self._writer())
         try:
+            if self.ws.subprotocol == SUBPROTOCOL:
+                await self.greet()
+            else:
+                self.fallback()
+            resumed = []
+            if self.resume:
+                resumed = await self.start_session()
             if self.mode == CONNECT:
                 await self.start_connect()
+                if self.connect_pool is not None:
+                    self.connect_pool.start()
             elif self.mode == LISTEN:
                 await self.start_listen()
+            self.running = True
+            if not self.started.done():
+                self.started.set_result(None)
+            # after the ListenOK, the peer expects that first
+            for fwd_conn, ack in resumed:
+                asyncio.ensure_future(fwd_conn.resumed(ack))
+            if self.draining:
+                await self._send_drain()
         except asyncio.CancelledError:
+            await self.cleanup()
             self.done.set_result(None)
             return
         except:
+            await self.cleanup()
             self.done.set_result(None)
             raise
 
@@ -137,49 +609,88 @@ class Connection:
             packet = await self.get_one_packet()
             if packet is None:
                 break
-            try:
-                getattr(self, 'handle_%s' % packet.name)(packet)
-            except AttributeError:
-                logger.error('packet handler not found: {}'.format(packet))
+            self.dispatch(packet)
 
-        await self.cleanup()
+        # 1006: closed without a close handshake, the link failed
+        if self.resume and self.ws.close_code == 1006:
+            await self.park()
+        else:
+            await self.cleanup()
         self.done.set_result(None)
 
+    def dispatch(self, packet):
+        self.metrics.packets_in[packet.code].value += 1
+        self.history.packets_in += 1
+        try:
+            getattr(self, 'handle_%s' % packet.name)(packet)
+        except AttributeError:
+            logger.error('packet handler not found: {}'.format(packet))
+
     async def cleanup(self):
         try:
             if self._heartbeat_task:
                 self._heartbeat_task.cancel()
                 await self._heartbeat_task
-            if self._listener:
-                self._listener.close()
-                await self._listener.wait_closed()
-                self._listener = None
-                msg = 'fwd listener closed {}:{}'
-                logger.info(msg.format(self.host, self.port))
+            if self.listener:
+                await self.listener.detach(self)
+            if self.connect_pool is not None:
+                await self.connect_pool.close()
             conns = list(self.connections.values())
             if conns:
-                await asyncio.wait([c.close() for c in conns])
+                await asyncio.wait(
+                    [asyncio.ensure_future(c.close()) for c in conns]
+                )
+            if self._writer_task:
+                self._writer_task.cancel()
+                await self._writer_task
         except asyncio.CancelledError:
             await self.cleanup()
 
     def handle_Request(self, p):
         if self.mode != CONNECT:
             return
+        self.early[p.id] = []
         asyncio.ensure_future(self.handle_Request_async(p))
 
     async def handle_Request_async(self, p):
         # no cancel
+        target = None
         try:
-            r, w = await asyncio.open_connection(self.host, self.port)
+            if self.draining:
+                raise ConnectionRefusedError('draining')
+            if self.balancer is not None:
+                target, r, w = await self.balancer.open_connection()
+            elif self.connect_pool is not None:
+                r, w = await self.connect_pool.get()
+            else:
+                r, w = await self.resolver.open_connection(
+                    self.host, self.port
+                )
         except:
+            self.early.pop(p.id, None)  # lost with the stream
+            self.metrics.rejects.labels('out').inc()
             await self.send_safe(packets.Reject(p.id))
             msg = 'connection failed to {}:{}, sending close'
             logger.info(msg.format(self.host, self.port))
             await self.send_safe(packets.Closed(p.id))
         else:
-            msg = 'connection established to {}:{}'
-            logger.info(msg.format(self.host, self.port))
-            await self.handle_fwd_conn(r, w, peer_id=p.id)
+            if self.done.done():
+                # the websocket is gone, nobody to accept it
+                w.close()
+                self.early.pop(p.id, None)
+                if target is not None:
+                    self.balancer.release(target)
+                return
+            if target is None:
+                msg = 'connection established to {}:{}'
+                logger.info(msg.format(self.host, self.port))
+                await self.handle_fwd_conn(r, w, peer_id=p.id)
+                return
+            logger.info('connection established to {}'.format(target))
+            try:
+                await self.handle_fwd_conn(r, w, peer_id=p.id)
+            finally:
+                self.balancer.release(target)
 
     def _handle_Packet(self, p, menthod_name, field_to_pass=None):
         try:
@@ -196,13 +707,59 @@ class Connection:
         self._handle_Packet(p, 'accept', 'id')
 
     def handle_Reject(self, p):
+        self.metrics.rejects.labels('in').inc()
         self._handle_Packet(p, 'reject')
 
     def handle_Data(self, p):
         self._handle_Packet(p, 'data', 'bytes')
 
+    def handle_ZData(self, p):
+        try:
+            fwd_conn = self.connections[p.peer_id]
+        except KeyError:
+            pass
+        else:
+            fwd_conn.zdata(p.codec, p.bytes)
+
+    def handle_EarlyData(self, p):
+        early = self.early.get(p.id)
+        if early is None:
+            return
+        if not isinstance(early, list):
+            early.data(p.bytes)  # sent before the Accept arrived
+            return
+        early.append(p.bytes)
+        if sum(len(d) for d in early) > self.initial_window:
+            logger.error('early data exceeds the window')
+            self.ws_close()
+
+    def handle_Compress(self, p):
+        self._handle_Packet(p, 'got_compress', 'codecs')
+
     def handle_Closed(self, p):
-        self._handle_Packet(p, 'closed')
+        self._handle_Packet(p, 'got_closed')
+
+    def handle_Ack(self, p):
+        try:
+            fwd_conn = self.connections[p.peer_id]
+        except KeyError:
+            pass
+        else:
+            if fwd_conn.replay is not None:
+                fwd_conn.got_ack(p.received, p.flags)
+
+    def handle_Drain(self, p):
+        logger.info('peer draining')
+        if not self.peer_draining.done():
+            self.peer_draining.set_result(None)
 
     def handle_Continue(self, p):
-        self._handle_Packet(p, 'got_continue')
+        self._handle_Packet(p, 'got_continue', 'increment')
+
+    def handle_Batch(self, p):
+        try:
+            for packet in packets.unbatch(p, self.version):
+                self.dispatch(packet)
+        except packets.PacketError:
+            logger.error('invalid batch received')
+            self.ws_close()
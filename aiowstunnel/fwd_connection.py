@@ -1,21 +1,98 @@
 import logging
 import asyncio
+import collections
 import datetime
 
 from . import packets
+from . import compression
 
 logger = logging.getLogger(__name__)
 
 
+# Flow control works with byte windows, like HTTP/2: every stream starts
+# with INITIAL_WINDOW bytes of credit in both directions (or the windows
+# announced in the Greeting packets), the receiver grants more with
+# Continue packets as it writes the data to the socket.
+INITIAL_WINDOW = 256 * 1024
+
+# The read size doubles while reads fill the buffer (bulk transfers) and
+# halves when they return much less (interactive traffic).
+READ_SIZE_MIN = 4096
+READ_SIZE_MAX = 256 * 1024
+
+# The receiver tunes its window towards twice the bandwidth-delay product,
+# measured on the Continue round trip: the time from granting credit until
+# data arrives that could only be sent with that credit.
+WINDOW_MIN = 64 * 1024
+WINDOW_MAX = 4 * 1024 * 1024
+
+# Peers without a Greeting (protocol version 0) count the windows in Data
+# packets, a Continue grants packets.LEGACY_CREDIT more. The receiver
+# grants them when the credit is used up and no more than the byte window
+# waits for the socket.
+
+
+class WriteBuffer:
+    """
+    Data waiting to be written to a socket. Readers take everything that is
+    buffered at once, so it can be written with one ``writelines``.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.chunks = []
+        self.bytes = 0
+        self.closed = False
+        self._waiter = None
+
+    def put(self, data):
+        self.chunks.append(data)
+        self.bytes += len(data)
+        self._wake()
+
+    def close(self):
+        self.closed = True
+        self._wake()
+
+    def _wake(self):
+        if self._waiter and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def get(self):
+        """
+        Return all buffered chunks and their total size, an empty list when
+        the buffer is closed and everything has been taken.
+        """
+        while not self.chunks and not self.closed:
+            self._waiter = self.loop.create_future()
+            await self._waiter
+            self._waiter = None
+        chunks, size = self.chunks, self.bytes
+        self.chunks, self.bytes = [], 0
+        return chunks, size
+
+
 class FwdConnection:
     def __init__(self, r, w, connection):
         self.r, self.w, self.connection = r, w, connection
         self.peername = self.w.get_extra_info('peername')
         self.response_timeout = connection.response_timeout
-        self.accept_before_continue = 64  # TODO: configure -------------------
-        self.send_without_continue = 64  # TODO: configure --------------------
-        self.queue_high_mark = 64  # TODO: configure --------------------------
-        self.queue_low_mark = 32  # TODO: configure ---------------------------
+        # the receive buffer we allow the peer to fill, in bytes
+        self.window = connection.window_size
+        self.window_min = connection.window_min
+        self.window_max = connection.window_max
+        weight = connection.stream_weight
+        if callable(weight):
+            weight = weight(self)
+        self.flow = connection.scheduler.flow(weight)
+        self.read_size = self.read_size_min = connection.read_size_min
+        self.read_size_max = connection.read_size_max
+        self.read_delay = connection.read_delay
+        self.compressor = None  # set when the peer announces its codecs
+        # bytes sent before the Accept, at most the peer's initial window
+        self.early_data = min(connection.early_data, connection.peer_window)
+        self.early_sent = 0
+        self.decompressor = None  # set by the first ZData
 
         self.id = None
         self.peer_id = None
@@ -24,21 +101,47 @@ class FwdConnection:
         self.close_response = connection.ws.loop.create_future()
         self._closed = False
         self.write_task = None
-        self.write_queue = asyncio.Queue()
-        self.sent_cnt = 0  # data packets sent after received continue
-        self.recv_cnt = 0  # data packets received after sent continue
-        self.queue_ok = None
+        self.write_buffer = WriteBuffer(connection.ws.loop)
+        self.legacy = connection.version == 0  # windows in packets
+        self.send_window = connection.peer_window  # bytes we can send
+        self.recv_window = connection.initial_window  # the peer can send
+        if self.legacy:
+            self.send_window = self.recv_window = packets.LEGACY_CREDIT
+        self.queued = 0  # bytes received, not written to the socket yet
+        self.received = 0
         self._continue = None
+        self._probe = None  # (granted offset, grant time, received)
+        self.srtt = None  # smoothed Continue round trip time, seconds
+        self.bandwidth = 0  # smoothed received bytes per second
         self.from_socket = 0
         self.to_socket = 0
         self.create_time = datetime.datetime.utcnow()
+        # resumable sessions: what was sent and not acknowledged yet, by
+        # byte offset (sent, acked), so it can be sent again on resume
+        self.replay = None
+        self.close_acked = None  # the peer got our Closed
+        if connection.resume:
+            self.replay = collections.deque()
+            self.close_acked = connection.ws.loop.create_future()
+        self.sent = 0
+        self.acked = 0
+        self.closed_sent = False
+        self._parked = None  # the websocket is lost, waiting for resume
 
     def closed(self):
-        self.close_nowait()
+        # the peer closed, write out what is buffered before closing
         if not self.close_response.done():
             self.close_response.set_result(None)
         if self.write_task:
-            self.write_task.cancel()
+            self.write_buffer.close()
+        else:
+            self.close_nowait()
+
+    def got_closed(self):
+        self.closed()
+        if self.replay is not None:
+            # tells the peer it can finish the stream
+            asyncio.ensure_future(self.connection.send_safe(self._ack()))
 
     def accept(self, peer_id):
         self.peer_id = peer_id
@@ -49,111 +152,386 @@ class FwdConnection:
         if not self.response.done():
             self.response.set_result(False)
 
+    def _cost(self, data):
+        # of a Data packet, in window units
+        return 1 if self.legacy else len(data)
+
     def data(self, d):
-        self.recv_cnt += 1
-        if self.recv_cnt > self.accept_before_continue:
-            logger.error('no continue received')
+        self.recv_window -= self._cost(d)
+        if self.recv_window < 0:
+            logger.error('flow control window exceeded')
+            self.connection.ws_close()
+            return
+        if self.legacy and self.recv_window == 0:
+            asyncio.ensure_future(self._update_window())
+        self.queued += len(d)
+        self.received += len(d)
+        self.write_buffer.put(d)
+        if self._probe and self.received > self._probe[0]:
+            self._rtt_sample()
+
+    def zdata(self, codec, d):
+        try:
+            if self.decompressor is None:
+                self.decompressor = compression.Decompressor(codec)
+            d = self.decompressor.decompress(codec, d, self.recv_window)
+        except compression.CompressionError as exc:
+            logger.error('invalid compressed data ({})'.format(exc))
+            self.connection.ws_close()
+            return
+        self.data(d)
+
+    def got_compress(self, codecs):
+        name = self.connection.compression
+        if name is None or self.compressor is not None:
+            return
+        codec = compression.choose(name, codecs)
+        if codec is not None:
+            self.compressor = compression.Compressor(codec)
+
+    @property
+    def compression_cpu(self):
+        cpu = 0.0
+        if self.compressor is not None:
+            cpu += self.compressor.cpu
+        if self.decompressor is not None:
+            cpu += self.decompressor.cpu
+        return cpu
+
+    def _ack(self):
+        flags = packets.CLOSED if self.close_response.done() else 0
+        return packets.Ack(
+            self.peer_id, self.id, self.received, max(self.recv_window, 0),
+            flags
+        )
+
+    def got_ack(self, received, flags):
+        if received > self.sent:
+            logger.error('acknowledged data not sent')
             self.connection.ws_close()
             return
-        self.write_queue.put_nowait(d)
+        drop = received - self.acked
+        while drop > 0:
+            chunk = self.replay[0]
+            if len(chunk) <= drop:
+                self.replay.popleft()
+                drop -= len(chunk)
+            else:
+                self.replay[0] = chunk[drop:]
+                drop = 0
+        self.acked = max(self.acked, received)
+        if flags & packets.CLOSED and not self.close_acked.done():
+            self.close_acked.set_result(None)
 
-        if self.recv_cnt == self.accept_before_continue:
-            asyncio.ensure_future(self._send_continue())
+    def park(self):
+        if self._parked is None:
+            self._parked = self.connection.ws.loop.create_future()
 
-    def got_continue(self):
+    def unpark(self):
+        if self._parked is not None:
+            self._parked.set_result(None)
+            self._parked = None
+
+    def resume_ack(self):
+        """
+        The :class:`~aiowstunnel.packets.Ack` telling the peer where to
+        resume. The peer may send a full window after what was received.
+        """
+        self._probe = None
+        self.recv_window = max(self.window - self.queued, 0)
+        return self._ack()
+
+    async def resumed(self, ack):
+        """
+        Continue on the new websocket after the peer's
+        :class:`~aiowstunnel.packets.Ack`: send again what it did not
+        receive, then what the socket sends.
+        """
+        await self._update_window()  # what was written since the Ack
+        self.got_ack(ack.received, ack.flags)
+        self.send_window = ack.window - (self.sent - self.acked)
+        # the read loop may add to the buffer meanwhile, parked before it
+        # sends, and acks may trim it
+        pos = self.acked  # offset of the next byte to send
+        while pos < self.sent:
+            skip = pos - self.acked
+            for chunk in self.replay:
+                if skip < len(chunk):
+                    break
+                skip -= len(chunk)
+            chunk = chunk[skip:]
+            pos += len(chunk)
+            await self.connection.send_safe(
+                packets.Data(self.peer_id, chunk), self.flow
+            )
+        if self.closed_sent and not self.close_acked.done():
+            pack = packets.Closed(self.peer_id)
+            await self.connection.send_safe(pack, self.flow)
+        self.unpark()
+        self._wake_sender()
+
+    async def abandon(self):
+        """
+        Close without telling the peer, it does not have the stream.
+        """
+        self.peer_id = None
+        self.unpark()
+        await self.close()
+
+    def got_continue(self, increment):
+        self.send_window += increment
+        self._wake_sender()
+
+    def _wake_sender(self):
         if self._continue and not self._continue.done():
             self._continue.set_result(None)
 
-    async def _send_continue(self):
-        if self.write_queue.qsize() > self.queue_high_mark:
-            self.queue_ok = self.connection.ws.loop.create_future()
-            await self.queue_ok
-            self.queue_ok = None
-        await self.connection.send_safe(packets.Continue(self.peer_id))
-        self.recv_cnt = 0
+    def _rtt_sample(self):
+        offset, start, received = self._probe
+        self._probe = None
+        sample = max(self.connection.ws.loop.time() - start, 1e-6)
+        if sample > self.response_timeout:
+            # the peer had nothing to send for a while, not a round trip
+            return
+        self.connection.metrics.continue_rtt.labels().observe(sample)
+        bandwidth = (self.received - received) / sample
+        if self.srtt is None:
+            self.srtt, self.bandwidth = sample, bandwidth
+        else:
+            self.srtt += (sample - self.srtt) / 8
+            self.bandwidth += (bandwidth - self.bandwidth) / 8
+        target = int(2 * self.bandwidth * self.srtt)
+        target = min(max(target, self.window_min), self.window_max)
+        # grow right away, shrink slowly
+        self.window = max(target, self.window - self.window // 8)
+
+    async def _update_window(self):
+        if not self.connection.running:
+            return  # parked, or resuming: the window goes with the Ack
+        if self.legacy:
+            if self.recv_window <= 0 and self.queued <= self.window:
+                self.recv_window += packets.LEGACY_CREDIT
+                pack = packets.Continue(self.peer_id, packets.LEGACY_CREDIT)
+                await self.connection.send_safe(pack)
+            return
+        # grant the peer what was written to the socket, but not in tiny
+        # pieces: wait until a quarter of the window can be granted
+        increment = self.window - self.recv_window - self.queued
+        if increment > 0 and increment >= self.window // 4:
+            if self._probe is None:
+                self._probe = (
+                    self.received + self.recv_window,
+                    self.connection.ws.loop.time(),
+                    self.received
+                )
+            self.recv_window += increment
+            if self.replay is not None:
+                await self.connection.send_safe(self._ack())
+            pack = packets.Continue(self.peer_id, increment)
+            await self.connection.send_safe(pack)
 
     async def _write_loop(self):
-        while not self._closed:
-            try:
-                data = await self.write_queue.get()
-                self.w.write(data)
+        # everything received while the previous write drained goes out
+        # with a single writelines and drain
+        try:
+            while True:
+                chunks, size = await self.write_buffer.get()
+                if not chunks:
+                    break
+                self.w.writelines(chunks)
                 await self.w.drain()
-                self.to_socket += len(data)
-                if self.write_queue.qsize() <= self.queue_low_mark:
-                    if self.queue_ok and not self.queue_ok.done():
-                        self.queue_ok.set_result(None)
-            except:
-                break
+                self.to_socket += size
+                self.connection.metrics.socket_out.value += size
+                self.connection.history.to_socket += size
+                self.queued -= size
+                await self._update_window()
+        except:
+            pass
+        self.close_nowait()
 
     async def _request_tunnel(self):
         await self.connection.send_safe(packets.Request(self.id))
+        await self._wait_response()
+
+    async def _wait_response(self):
+        metrics = self.connection.metrics
+        start = self.connection.ws.loop.time()
         try:
             # close will call reject to set result on self.response
             resp = await asyncio.wait_for(self.response, self.response_timeout)
+            elapsed = self.connection.ws.loop.time() - start
+            metrics.request_seconds.labels().observe(elapsed)
             if not resp:
                 logger.info('request rejected, closing fwd conn')
                 self.close_nowait()
         except asyncio.TimeoutError:
+            metrics.timeouts.labels('response').inc()
             logger.error('response timeout')
             self.connection.ws_close()
 
+    async def _open_early(self):
+        # the Request is out and the socket is read already, set up the
+        # stream when the Accept comes
+        await self._wait_response()
+        if self.peer_id is not None and not self._closed:
+            await self._accepted()
+
+    async def _accepted(self):
+        if self.connection.compression is not None:
+            pack = packets.Compress(self.peer_id, compression.available())
+            await self.connection.send_safe(pack)
+        await self._update_window()
+
+    async def _read(self, size):
+        data = await self.r.read(size)
+        if not self.read_delay or not data or len(data) >= size:
+            return data
+        # wait a little for more to send less, larger packets
+        loop = self.connection.ws.loop
+        parts, got = [data], len(data)
+        deadline = loop.time() + self.read_delay
+        while got < size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                data = await asyncio.wait_for(self.r.read(size - got), timeout)
+            except asyncio.TimeoutError:
+                break
+            if not data:
+                break  # EOF, the next read returns it again
+            parts.append(data)
+            got += len(data)
+        return b''.join(parts)
+
+    def _adapt_read_size(self, size, got):
+        if got >= size:
+            self.read_size = min(self.read_size * 2, self.read_size_max)
+        elif got < size // 4:
+            self.read_size = max(self.read_size // 2, self.read_size_min)
+
     async def _read_loop(self):
-        while True:
+        while not self._closed:
+            if self.send_window <= 0:
+                self._continue = self.connection.ws.loop.create_future()
+                await self._continue
+                self._continue = None
+                continue
+            size = self.read_size
+            if not self.legacy:
+                size = min(size, self.send_window)
+            if self.peer_id is None:
+                size = min(size, self.early_data - self.early_sent)
+                if size <= 0:
+                    # early data budget used up, wait for the Accept
+                    await asyncio.wait([self.response])
+                    continue
             try:
-                data = await self.r.read(4096)
+                data = await self._read(size)
                 self.from_socket += len(data)
+                self.connection.metrics.socket_in.value += len(data)
+                self.connection.history.from_socket += len(data)
             except:
                 data = None
             if not data:
                 break
+            self._adapt_read_size(size, len(data))
 
-            pack = packets.Data(self.peer_id, data)
-            await self.connection.send_safe(pack)
+            self.send_window -= self._cost(data)
+            if self.peer_id is None:
+                # in the control queue, behind the Request
+                self.early_sent += len(data)
+                pack = packets.EarlyData(self.id, data)
+                await self.connection.send_safe(pack)
+                continue
+            if self.replay is not None:
+                self.replay.append(data)
+                self.sent += len(data)
+                if self._parked is not None:
+                    # sent from the replay buffer on resume
+                    await self._parked
+                    continue
+            await self.connection.send_safe(self._pack(data), self.flow)
 
-            self.sent_cnt += 1
-            if self.sent_cnt == self.send_without_continue:
-                self._continue = self.connection.ws.loop.create_future()
-                await self._continue
-                self._continue = None
-                self.sent_cnt = 0
+    def _pack(self, data):
+        if self.compressor is not None:
+            compressed = self.compressor.compress(data)
+            if compressed is not None:
+                codec = self.compressor.codec
+                return packets.ZData(self.peer_id, codec, compressed)
+        return packets.Data(self.peer_id, data)
 
     async def handle(self):
         # will not be cancelled
         if (self.id is None) or self._closed:
             return
         # connection from the listener, request, wait for response
+        # (or with early data, send what the socket sends in the meantime)
+        opening = None
         if self.peer_id is None:
             msg = 'tunneling server connection from {}'
             logger.info(msg.format(self.peername))
-            await self._request_tunnel()
+            if self.early_data > 0:
+                await self.connection.send_safe(packets.Request(self.id))
+                opening = asyncio.ensure_future(self._open_early())
+            else:
+                await self._request_tunnel()
 
-        if not self._closed and self.peer_id is not None:
+        if not self._closed and (self.peer_id is not None or opening):
+            if opening is None:
+                await self._accepted()
             self.write_task = asyncio.ensure_future(self._write_loop())
             await self._read_loop()
+        if opening is not None:
+            # the socket may be done before the answer, Closed needs it
+            await opening
 
         # closing
         self.close_nowait()
         if self.peer_id is not None:
             logger.debug('sending closed packet to {}'.format(self.peer_id))
-            await self.connection.send_safe(packets.Closed(self.peer_id))
-        try:
-            await asyncio.wait_for(self.close_response, self.response_timeout)
-        except asyncio.TimeoutError:
-            logger.error('timeout in waiting for close')
-            self.connection.ws_close()
+            self.closed_sent = True
+            if self._parked is None:
+                pack = packets.Closed(self.peer_id)
+                await self.connection.send_safe(pack, self.flow)
+            else:
+                await self._parked  # sent on resume
+        await self._wait_closed()
 
         self.done.set_result(None)
 
+    async def _wait_closed(self):
+        # the peer's Closed, and on a resumable stream the peer's Ack of
+        # ours, nothing is sent again after that
+        while True:
+            waits = [self.close_response]
+            if self.close_acked is not None and self.peer_id is not None:
+                waits.append(self.close_acked)
+            waits = [f for f in waits if not f.done()]
+            if not waits:
+                return
+            await asyncio.wait(waits, timeout=self.response_timeout)
+            if all(f.done() for f in waits):
+                return
+            if self._parked is not None:
+                await self._parked  # resumed or expired
+                continue
+            self.connection.metrics.timeouts.labels('close').inc()
+            logger.error('timeout in waiting for close')
+            self.connection.ws_close()
+            return
+
     def close_nowait(self):
         self._closed = True
         self.w.close()
         self.reject()  # will set response future
-        self.got_continue()
-        if self.queue_ok and not self.queue_ok.done():
-            self.queue_ok.set_result(None)
+        self._wake_sender()
 
     async def close(self):
         self.closed()  # will set close_response future
+        if self.close_acked is not None and not self.close_acked.done():
+            self.close_acked.set_result(None)
+        self.close_nowait()
         if self.write_task:
             self.write_task.cancel()
             await self.write_task
@@ -0,0 +1,170 @@
+"""
+This module implements the :class:`~Handoff` class, handing the listening
+sockets of a :class:`~aiowstunnel.server.Server` over to a new server
+process, to upgrade it without refusing connections.
+
+A server started with a ``handoff_path`` waits for its successor on a Unix
+socket at that path. The new server, started with the same path, connects
+to it and gets the listening sockets, the tunnel port and the forward
+ports of ``LISTEN`` tunnels, as ``SCM_RIGHTS`` ancillary data. Once it
+accepts on them it confirms, the old server drains and the new one waits
+on the path for the next upgrade. For a moment both processes accept on
+the same sockets, connections are never refused.
+
+A handoff takes one socket per address: the tunnel server must listen on
+a numeric host.
+"""
+
+import array
+import asyncio
+import json
+import logging
+import os
+import socket
+import struct
+
+
+logger = logging.getLogger(__name__)
+
+
+TUNNEL = 'tunnel'  # key of the tunnel port, forward ports are [host, port]
+MAX_SOCKETS = 1024
+ACK = b'ok'
+
+header = struct.Struct('>I')
+
+
+def send_sockets(conn, sockets):
+    """
+    Send ``sockets``, a list of (key, socket) pairs, on the Unix socket
+    ``conn``. Keys are JSON values.
+    """
+    keys = json.dumps([key for key, _ in sockets]).encode()
+    fds = array.array('i', [sock.fileno() for _, sock in sockets])
+    data = header.pack(len(keys)) + keys
+    sent = conn.sendmsg(
+        [data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)]
+    )
+    conn.sendall(data[sent:])
+
+
+def recv_sockets(conn):
+    """
+    Receive the (key, socket) pairs sent with :func:`send_sockets`.
+    """
+    fds = array.array('i')
+    data, ancdata, flags, _ = conn.recvmsg(
+        65536, socket.CMSG_SPACE(MAX_SOCKETS * fds.itemsize)
+    )
+    for level, kind, cdata in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cdata[:len(cdata) - len(cdata) % fds.itemsize])
+    sockets = [socket.socket(fileno=fd) for fd in fds]
+    try:
+        if flags & socket.MSG_CTRUNC:
+            raise OSError('too many sockets')
+        while len(data) < header.size or \
+                len(data) < header.size + header.unpack_from(data)[0]:
+            chunk = conn.recv(65536)
+            if not chunk:
+                raise OSError('handoff cut short')
+            data += chunk
+        keys = json.loads(data[header.size:].decode())
+        if len(keys) != len(sockets):
+            raise OSError('{} keys for {} sockets'.format(
+                len(keys), len(sockets)
+            ))
+    except:
+        for sock in sockets:
+            sock.close()
+        raise
+    return list(zip(keys, sockets))
+
+
+class Handoff:
+    def __init__(self, path, timeout=5, loop=None):
+        self.path = path
+        self.timeout = timeout
+        self.loop = asyncio.get_event_loop() if loop is None else loop
+        self._conn = None  # to the old server until confirmed
+        self._sock = None  # waiting for the successor
+
+    async def receive(self):
+        """
+        The (key, socket) pairs of the server running on ``path``, an empty
+        list if there is none.
+        """
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.settimeout(self.timeout)
+        try:
+            await self.loop.run_in_executor(None, conn.connect, self.path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            conn.close()
+            return []
+        try:
+            sockets = await self.loop.run_in_executor(
+                None, recv_sockets, conn
+            )
+        except OSError as exc:
+            logger.error('handoff failed ({})'.format(exc))
+            conn.close()
+            return []
+        logger.info('{} sockets handed over'.format(len(sockets)))
+        self._conn = conn
+        return sockets
+
+    async def confirm(self):
+        """
+        Tell the old server the sockets are accepted on.
+        """
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        try:
+            await self.loop.run_in_executor(None, conn.sendall, ACK)
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    async def serve(self, sockets):
+        """
+        Wait for a successor on ``path`` and send it the pairs returned by
+        ``sockets()``. Returns when it confirmed.
+        """
+        try:
+            os.unlink(self.path)  # left by the previous server
+        except FileNotFoundError:
+            pass
+        sock = self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self.path)
+            sock.listen(1)
+            sock.setblocking(False)
+            while True:
+                conn, _ = await self.loop.sock_accept(sock)
+                conn.settimeout(self.timeout)
+                try:
+                    await self.loop.run_in_executor(
+                        None, send_sockets, conn, sockets()
+                    )
+                    ack = await self.loop.run_in_executor(
+                        None, conn.recv, len(ACK)
+                    )
+                except OSError as exc:
+                    logger.error('handoff failed ({})'.format(exc))
+                    ack = None
+                finally:
+                    conn.close()
+                if ack == ACK:
+                    return
+        finally:
+            self.close()
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -2,6 +2,14 @@ import React, {Component} from 'react';
 // import logo from './logo.svg';
 // import './App.css';
 
+// apply {set: {key: fields}, removed: [key]} of a stats delta
+function applyDelta(items, delta) {
+  const ret = {...items};
+  delta.removed.forEach(key => delete ret[key]);
+  Object.keys(delta.set).forEach(key => (ret[key] = {...ret[key], ...delta.set[key]}));
+  return ret;
+}
+
 class App extends Component {
   constructor(props) {
     super(props);
@@ -57,7 +65,19 @@ class App extends Component {
       });
     };
     this.ws.onmessage = e => {
-      this.setState({data: JSON.parse(e.data)});
+      const msg = JSON.parse(e.data);
+      if (msg.type === 'snapshot') {
+        this.setState({data: msg});
+      } else if (this.state.data !== null) {
+        const data = this.state.data;
+        this.setState({
+          data: {
+            ...data,
+            tunnels: applyDelta(data.tunnels, msg.tunnels),
+            streams: applyDelta(data.streams, msg.streams)
+          }
+        });
+      }
     };
   }
 
@@ -65,11 +85,27 @@ class App extends Component {
     this.wsConnect();
   }
 
+  // the tunnels with their streams, like /stats/json
+  connections() {
+    const {tunnels, streams} = this.state.data;
+    const conns = {};
+    Object.keys(tunnels)
+      .sort()
+      .forEach(key => (conns[key] = {...tunnels[key], key: key, connections: []}));
+    Object.keys(streams)
+      .sort()
+      .forEach(key => {
+        const conn = conns[streams[key].tunnel];
+        if (conn) conn.connections.push(streams[key]);
+      });
+    return Object.values(conns);
+  }
+
   connectionRows(conns) {
     const ret = [];
     conns.map(conn => {
       ret.push(
-        <tr className="conn" key={conn.id}>
+        <tr className="conn" key={conn.key}>
           <td style={{textAlign: 'right'}}>{conn.mode}</td>
           <td>{conn.host}</td>
           <td>{conn.port}</td>
@@ -82,7 +118,7 @@ class App extends Component {
       );
       conn.connections.map(fwdconn =>
         ret.push(
-          <tr key={conn.id + '|' + fwdconn.id}>
+          <tr key={conn.key + '|' + fwdconn.websocket + '|' + fwdconn.id}>
             <td style={{textAlign: 'right'}}>{fwdconn.id}</td>
             <td>{fwdconn.addr}</td>
             <td>{fwdconn.port}</td>
@@ -126,7 +162,7 @@ class App extends Component {
                 tunnel server listening on {this.state.data.host}: {this.state.data.port}
               </div>
               <table cellSpacing="0">
-                <tbody>{this.connectionRows(this.state.data.connections)}</tbody>
+                <tbody>{this.connectionRows(this.connections())}</tbody>
               </table>
             </div>
           );
@@ -0,0 +1,112 @@
+"""
+Throughput history of tunnels in fixed size ring buffers.
+
+A :class:`History` belongs to a tunnel endpoint: the websockets forwarding
+the same ``mode``, ``host``, ``port`` (and group) share it, so the history
+goes on across reconnects. Connections add to its counters with plain
+increments on the packet path. Once a second the counters are sampled
+into rings of ``RESOLUTIONS``: per second values for 5 minutes and per
+minute values for 24 hours, stored in arrays of 64 bit integers, about
+70 KB per tunnel.
+"""
+
+import array
+
+
+SERIES = ('fromSocket', 'toSocket', 'packetsIn', 'packetsOut', 'streams')
+RESOLUTIONS = ((1, 300), (60, 1440))  # (seconds per slot, slots)
+SAMPLE_INTERVAL = 1  # seconds
+
+
+class Ring:
+    def __init__(self, period, length):
+        self.period, self.length = period, length
+        self.series = [array.array('Q', bytes(8 * length)) for _ in SERIES]
+        self.first = None  # the first slot (time // period) recorded
+        self.last = None  # the newest slot
+
+    def _advance(self, slot):
+        if self.last is None:
+            self.first = self.last = slot
+            return
+        # clear the slots skipped since the newest one
+        for i in range(self.last + 1, min(slot, self.last + self.length) + 1):
+            index = i % self.length
+            for values in self.series:
+                values[index] = 0
+        self.last = max(self.last, slot)
+
+    def add(self, t, deltas):
+        slot = int(t // self.period)
+        self._advance(slot)
+        if slot <= self.last - self.length:
+            return  # the clock went back further than the ring
+        index = slot % self.length
+        for values, delta in zip(self.series, deltas):
+            values[index] += delta
+
+    def query(self, t):
+        """
+        The values from the first recorded slot (at most ``length`` slots
+        ago) up to the slot of ``t``.
+        """
+        self._advance(int(t // self.period))
+        count = min(self.length, self.last - self.first + 1)
+        start = self.last - count + 1
+        indexes = [i % self.length for i in range(start, self.last + 1)]
+        return {
+            'period': self.period,
+            'start': start * self.period,
+            'series': {
+                name: [values[i] for i in indexes]
+                for name, values in zip(SERIES, self.series)
+            }
+        }
+
+
+class History:
+    def __init__(self, resolutions=RESOLUTIONS):
+        # counters, updated by the connections of the tunnel
+        self.from_socket = 0
+        self.to_socket = 0
+        self.packets_in = 0
+        self.packets_out = 0
+        self.streams = 0
+
+        self.members = 0  # connections using this history
+        self.resolutions = resolutions
+        self.rings = None  # created at the first sample
+        self.last_active = None
+        self._sampled = (0, ) * len(SERIES)
+
+    def _totals(self):
+        return (
+            self.from_socket, self.to_socket,
+            self.packets_in, self.packets_out, self.streams
+        )
+
+    def sample(self, t):
+        totals = self._totals()
+        deltas = [a - b for a, b in zip(totals, self._sampled)]
+        self._sampled = totals
+        if self.rings is None:
+            self.rings = [Ring(p, n) for p, n in self.resolutions]
+        for ring in self.rings:
+            ring.add(t, deltas)
+        if self.members or self.last_active is None:
+            self.last_active = t
+
+    def expired(self, t):
+        """
+        True if the tunnel has been gone for longer than the history spans.
+        """
+        if self.members or self.last_active is None:
+            return False
+        span = max(p * n for p, n in self.resolutions)
+        return t - self.last_active > span
+
+    def query(self, t, period=None):
+        return [
+            ring.query(t) for ring in self.rings or ()
+            if period is None or ring.period == period
+        ]
@@ -2,120 +2,85 @@ class IdException(Exception):
     pass
 
 
-class Node:
-    def __init__(self, parent, _min, _max):
-        self.parent = parent
-        self.min = _min
-        self.max = _max
-
-        self.has_free = True
-        self.is_leaf = _min + 1 == _max
-        self.left = None
-        self.right = None
-        self.value = None
-
-    def set_free_false(self):
-        self.has_free = False
-        if (
-            self.parent and
-            self.parent.left and
-            not self.parent.left.has_free and
-            self.parent.right and
-            not self.parent.right.has_free
-        ):
-            self.parent.set_free_false()
-
-    def set_free_true(self):
-        if not self.left and not self.right and self.parent:
-            if self.parent.left == self:
-                self.parent.left = None
-            if self.parent.right == self:
-                self.parent.right = None
-        self.has_free = True
-        if self.parent:
-            self.parent.set_free_true()
+_FREE = object()  # marks an unused slot
 
-    def store(self, value):
-        if not self.has_free:
-            raise IdException('no more slots')
-        if self.is_leaf:
-            self.value = value
-            self.set_free_false()
-            return self.min
-        mx = (self.min + self.max) // 2
-        if not self.left:
-            self.left = Node(self, self.min, mx)
-        if self.left.has_free:
-            return self.left.store(value)
-        if not self.right:
-            self.right = Node(self, mx, self.max)
-        return self.right.store(value)
-
-    def _get_or_del(self, key, _del=False):
-        if self.is_leaf:
-            if self.min == key and not self.has_free:
-                if _del:
-                    self.set_free_true()
-                return self.value
-            else:
-                raise KeyError(key)
-        if self.left and key < self.left.max:
-            return self.left._get_or_del(key, _del)
-        if self.right and key >= self.right.min:
-            return self.right._get_or_del(key, _del)
-        raise KeyError(key)
-
-    def __iter__(self):
-        for k, v in self.items():
-            yield k
 
-    def items(self):
-        if self.is_leaf and not self.has_free:
-            yield self.min, self.value
-        else:
-            if self.left:
-                for k, v in self.left.items():
-                    yield k, v
-            if self.right:
-                for k, v in self.right.items():
-                    yield k, v
+class Ids:
+    """
+    Id allocator, a mapping from small integer ids to values.
 
+    ``store`` always hands out the lowest free id, so ids are reused as soon
+    as they are released. Values live in a list indexed by the id, it grows
+    only up to the highest id ever used. Free slots below that are tracked
+    in a two-level bitmap: one 64 bit word per 64 slots, and a summary
+    integer with a bit set for every word that has a free slot. ``cap`` is
+    the number of ids, it can be raised while in use.
+    """
 
-class Ids:
     def __init__(self, cap=65536):
-        self.node = Node(None, 0, cap)
+        self._values = []
+        self._words = []
+        self._summary = 0
         self._len = 0
-        self._max = cap
+        self.cap = cap
 
     def store(self, value):
-        ret = self.node.store(value)
+        summary = self._summary
+        if summary:
+            w = (summary & -summary).bit_length() - 1
+            word = self._words[w]
+            bit = word & -word
+            word ^= bit
+            self._words[w] = word
+            if not word:
+                self._summary = summary ^ (1 << w)
+            key = (w << 6) + bit.bit_length() - 1
+            self._values[key] = value
+        else:
+            key = len(self._values)
+            if key >= self.cap:
+                raise IdException('no more slots')
+            self._values.append(value)
+            if not key & 63:
+                self._words.append(0)
         self._len += 1
-        return ret
+        return key
 
     def __getitem__(self, key):
-        return self.node._get_or_del(key)
+        values = self._values
+        if 0 <= key < len(values):
+            value = values[key]
+            if value is not _FREE:
+                return value
+        raise KeyError(key)
 
     def __delitem__(self, key):
-        self.node._get_or_del(key, _del=True)
-        self._len -= 1
+        self.pop(key)
 
     def pop(self, key):
-        ret = self.node._get_or_del(key, _del=True)
+        ret = self[key]
+        self._values[key] = _FREE
+        w = key >> 6
+        self._words[w] |= 1 << (key & 63)
+        self._summary |= 1 << w
         self._len -= 1
         return ret
 
     def __iter__(self):
-        return self.node.__iter__()
+        for k, v in self.items():
+            yield k
 
     def items(self):
-        return self.node.items()
+        for k, v in enumerate(self._values):
+            if v is not _FREE:
+                yield k, v
 
     def values(self):
         for k, v in self.items():
             yield v
 
     def full(self):
-        if len(self) == self._max:
+        if len(self) == self.cap:
             return True
         return False
 
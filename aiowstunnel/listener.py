@@ -0,0 +1,110 @@
+"""
+This module implements the :class:`~Listener` class, the forward listener
+of a tunnel in ``LISTEN`` mode.
+
+A listener is shared by the websockets listening on its address: the
+members of a tunnel group (see the ``pool_size`` option of
+:class:`~aiowstunnel.client.Client`) and, on a server, independent clients
+asking for the same host and port. It is bound when the first member
+connects and closed when the last one goes away, so a member dropping only
+moves new connections to the others. Every accepted connection is
+forwarded on the member carrying the fewest streams
+(:data:`LEAST_STREAMS`), or on the members in turn (:data:`ROUND_ROBIN`).
+With ``sock``, a listening socket handed over by another process (see
+:mod:`~aiowstunnel.handoff`), that is accepted on instead of binding.
+"""
+
+import logging
+import asyncio
+
+
+logger = logging.getLogger(__name__)
+
+
+LEAST_STREAMS = 'least-streams'
+ROUND_ROBIN = 'round-robin'
+
+
+class Listener:
+    def __init__(self, host, port, balance=LEAST_STREAMS, sock=None):
+        assert balance in (LEAST_STREAMS, ROUND_ROBIN)
+        self.host, self.port = host, port
+        self.sock = sock
+        self.balance = balance
+        self.connections = []
+        self._turn = 0
+        self._server = None
+        self._starting = None
+
+    def __len__(self):
+        return len(self.connections)
+
+    async def attach(self, conn):
+        """
+        Add a member connection, bind the listener if it is the first one.
+        Raises the bind error.
+        """
+        while self._starting is not None:
+            await asyncio.shield(self._starting)
+        if self._server is None:
+            self._starting = asyncio.get_event_loop().create_future()
+            try:
+                if self.sock is not None:
+                    sock, self.sock = self.sock, None
+                    self._server = await asyncio.start_server(
+                        self.handle_fwd_conn, sock=sock
+                    )
+                else:
+                    self._server = await asyncio.start_server(
+                        self.handle_fwd_conn, host=self.host, port=self.port
+                    )
+            finally:
+                self._starting.set_result(None)
+                self._starting = None
+            msg = 'fwd listening on {}:{}'
+            logger.info(msg.format(self.host, self.port))
+        if conn not in self.connections:
+            self.connections.append(conn)
+
+    async def detach(self, conn):
+        """
+        Remove a member connection, close the listener with the last one.
+        """
+        if conn in self.connections:
+            self.connections.remove(conn)
+        if not self.connections:
+            await self.close()
+
+    @property
+    def sockets(self):
+        return self._server.sockets if self._server is not None else []
+
+    async def close(self):
+        """
+        Stop accepting connections, the members stay.
+        """
+        if self._server is not None:
+            # the sockets are closed, wait_closed would wait for the
+            # accepted connections too (python 3.12)
+            self._server.close()
+            self._server = None
+            msg = 'fwd listener closed {}:{}'
+            logger.info(msg.format(self.host, self.port))
+
+    def pick(self):
+        # parked members wait for their websocket to come back, draining
+        # ones take no new streams
+        connections = [c for c in self.connections if c.accepting]
+        if not connections:
+            return None
+        if self.balance == ROUND_ROBIN:
+            self._turn = (self._turn + 1) % len(connections)
+            return connections[self._turn]
+        return min(connections, key=lambda c: len(c.connections))
+
+    async def handle_fwd_conn(self, r, w):
+        conn = self.pick()
+        if conn is None:
+            w.close()
+            return
+        await conn.handle_fwd_conn(r, w)
@@ -0,0 +1,273 @@
+"""
+Metrics of a tunnel server or client in the Prometheus text format.
+
+Counters and histograms are updated on the packet path, so updating one
+is an attribute increment (and a bisect for histograms). Resolve the
+labels once with :meth:`Family.labels` and keep the child around. Gauges
+are computed by a callback when the metrics are collected.
+
+:meth:`Metrics.snapshot` returns plain, picklable data.
+:func:`merge` sums snapshots, e.g. those of the worker processes of a
+:class:`~aiowstunnel.multiserver.MultiServer`. :func:`render` formats a
+snapshot for a scrape.
+"""
+
+import bisect
+
+from . import packets
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds, from a local round trip to a slow one
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+
+class Counter:
+    __slots__ = ('value', )
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Family:
+    """
+    A metric with its children, one per combination of label values.
+    """
+
+    def __init__(self, name, kind, help, labelnames=(), buckets=None,
+                 collect=None):
+        self.name, self.kind, self.help = name, kind, help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.collect = collect  # gauges: returns {label values: value}
+        self.children = {}
+        if not labelnames and collect is None:
+            self.labels()  # export a zero before the first update
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if self.kind == 'histogram':
+                child = Histogram(self.buckets)
+            else:
+                child = Counter()
+            self.children[values] = child
+        return child
+
+    def samples(self):
+        if self.collect is not None:
+            return sorted(self.collect().items())
+        if self.kind == 'histogram':
+            return sorted(
+                (values, (list(h.counts), h.sum))
+                for values, h in self.children.items()
+            )
+        return sorted(
+            (values, c.value) for values, c in self.children.items()
+        )
+
+
+class Metrics:
+    def __init__(self):
+        self.families = []
+        counter, histogram = self.counter, self.histogram
+
+        self.socket_bytes = counter(
+            'aiowstunnel_socket_bytes_total',
+            'Bytes read from (in) and written to (out) forwarded sockets.',
+            ('direction', )
+        )
+        self.websocket_bytes = counter(
+            'aiowstunnel_websocket_bytes_total',
+            'Bytes of websocket frames received and sent.',
+            ('direction', )
+        )
+        self.frames = counter(
+            'aiowstunnel_frames_total',
+            'Websocket frames received and sent.',
+            ('direction', )
+        )
+        self.packets = counter(
+            'aiowstunnel_packets_total',
+            'Tunnel packets received and sent, by type.',
+            ('direction', 'type')
+        )
+        self.rejects = counter(
+            'aiowstunnel_rejects_total',
+            'Forwarded connections rejected by this side (out) or the '
+            'peer (in).',
+            ('direction', )
+        )
+        self.timeouts = counter(
+            'aiowstunnel_timeouts_total',
+            'Peers not answering in time, by what was waited for.',
+            ('kind', )
+        )
+        self.tunnels_opened = counter(
+            'aiowstunnel_tunnels_opened_total',
+            'Tunnel websockets opened.'
+        )
+        self.streams_opened = counter(
+            'aiowstunnel_streams_opened_total',
+            'Forwarded connections opened.'
+        )
+        self.reconnects = counter(
+            'aiowstunnel_reconnects_total',
+            'Websocket connections the client retried or reopened.'
+        )
+        self.request_seconds = histogram(
+            'aiowstunnel_request_seconds',
+            'Time from sending a Request until the Accept or Reject.'
+        )
+        self.continue_rtt = histogram(
+            'aiowstunnel_continue_rtt_seconds',
+            'Round trip time measured with window updates.'
+        )
+        self.queue_wait = histogram(
+            'aiowstunnel_queue_wait_seconds',
+            'Time packets of forwarded connections wait to be sent.'
+        )
+        self.dns_lookups = counter(
+            'aiowstunnel_dns_lookups_total',
+            'Target name lookups, answered from the cache (hit, negative) '
+            'or not (miss).',
+            ('result', )
+        )
+        self.connect_seconds = histogram(
+            'aiowstunnel_connect_seconds',
+            'Time to resolve and connect to a target.'
+        )
+
+        # the children updated on the packet path
+        self.packets_in, self.packets_out = [
+            [self.packets.labels(direction, k.name) for k in packets.klasses]
+            for direction in ('in', 'out')
+        ]
+        self.frames_in = self.frames.labels('in')
+        self.frames_out = self.frames.labels('out')
+        self.ws_in = self.websocket_bytes.labels('in')
+        self.ws_out = self.websocket_bytes.labels('out')
+        self.socket_in = self.socket_bytes.labels('in')
+        self.socket_out = self.socket_bytes.labels('out')
+
+    def _add(self, family):
+        self.families.append(family)
+        return family
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Family(name, 'counter', help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(
+            Family(name, 'histogram', help, labelnames, buckets=buckets)
+        )
+
+    def gauge(self, name, help, labelnames, collect):
+        """
+        Add a gauge, ``collect`` returns a dict of label value tuples to
+        values.
+        """
+        return self._add(
+            Family(name, 'gauge', help, labelnames, collect=collect)
+        )
+
+    def snapshot(self):
+        return [
+            (f.name, f.kind, f.help, f.labelnames, f.buckets, f.samples())
+            for f in self.families
+        ]
+
+
+def merge(snapshots):
+    """
+    Sum the samples of ``snapshots`` into one snapshot.
+    """
+    merged = {}
+    for snapshot in snapshots:
+        for name, kind, help, labelnames, buckets, samples in snapshot:
+            family = merged.setdefault(
+                name, (name, kind, help, labelnames, buckets, {})
+            )
+            values = family[-1]
+            for labels, value in samples:
+                if kind == 'histogram':
+                    counts, total = value
+                    old_counts, old_total = values.get(
+                        labels, ([0] * len(counts), 0.0)
+                    )
+                    value = (
+                        [a + b for a, b in zip(old_counts, counts)],
+                        old_total + total
+                    )
+                else:
+                    value += values.get(labels, 0)
+                values[labels] = value
+    return [
+        family[:-1] + (sorted(family[-1].items()), )
+        for family in merged.values()
+    ]
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n') \
+        .replace('"', r'\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, _escape(value)) for name, value in pairs
+    )
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+
+def render(snapshot):
+    """
+    The text exposition format of a snapshot.
+    """
+    lines = []
+    for name, kind, help, labelnames, buckets, samples in snapshot:
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for values, value in samples:
+            if kind != 'histogram':
+                labels = _labels(labelnames, values)
+                lines.append('%s%s %s' % (name, labels, _number(value)))
+                continue
+            counts, total = value
+            cumulative = 0
+            for le, count in zip(buckets + (float('inf'), ), counts):
+                cumulative += count
+                labels = _labels(labelnames, values, [('le', _number(le))])
+                lines.append('%s_bucket%s %d' % (name, labels, cumulative))
+            labels = _labels(labelnames, values)
+            lines.append('%s_sum%s %s' % (name, labels, _number(total)))
+            lines.append('%s_count%s %d' % (name, labels, cumulative))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,279 @@
+"""
+This module implements the :class:`~MultiServer` class, running the tunnel
+server in several worker processes.
+"""
+
+import logging
+import asyncio
+import multiprocessing
+import os
+import pickle
+import signal
+import socket
+import struct
+
+from .server import Server
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+STATS_INTERVAL = 1  # seconds between the stats reports of the workers
+# a worker gets the stats of all workers while it served stats or metrics
+# within this many seconds
+CLUSTER_HOLD = 300
+RESTART_DELAY = 0.5  # seconds before restarting a worker that died
+RESTART_DELAY_MAX = 30
+
+header = struct.Struct('>I')
+
+
+def send_message(w, msg):
+    """
+    Write ``msg`` to the stream ``w``, unless the previous message is still
+    in its buffer (the other side is slow): returns False then.
+    """
+    if w.transport.get_write_buffer_size():
+        return False
+    data = msg if isinstance(msg, bytes) else encode(msg)
+    w.write(data)
+    return True
+
+
+def encode(msg):
+    data = pickle.dumps(msg)
+    return header.pack(len(data)) + data
+
+
+async def recv_message(r):
+    size, = header.unpack(await r.readexactly(header.size))
+    return pickle.loads(await r.readexactly(size))
+
+
+def merge_draining(draining):
+    """
+    The drain progress of the whole server from that of the draining
+    workers, ``None`` if none is draining.
+    """
+    if not draining:
+        return None
+    return {
+        'since': min(d['since'] for d in draining),
+        'deadline': max(d['deadline'] for d in draining),
+        'streamsAtStart': sum(d['streamsAtStart'] for d in draining),
+        'streams': sum(d['streams'] for d in draining)
+    }
+
+
+def _worker(index, host, port, server_kwargs, sock):
+    # the supervisor stops the workers, ignore ctrl-c sent to the group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(
+            _serve(index, host, port, server_kwargs, sock, loop)
+        )
+    finally:
+        loop.close()
+
+
+async def _serve(index, host, port, server_kwargs, sock, loop):
+    srv = Server(host, port, reuse_port=True, loop=loop, **server_kwargs)
+    r, w = await asyncio.open_connection(sock=sock)
+
+    async def receive():
+        # the stats of all workers, until None or the supervisor is gone
+        try:
+            while True:
+                msg = await recv_message(r)
+                if msg is None:
+                    break
+                srv.cluster_stats, srv.cluster_metrics = msg
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+
+    srv.start()
+    # the first report tells the supervisor the worker started
+    closed = asyncio.ensure_future(srv.wait_closed())
+    await asyncio.wait(
+        [srv.listening, closed], return_when=asyncio.FIRST_COMPLETED
+    )
+    closed.cancel()
+    if not srv.listening.done():
+        await srv.close()
+        raise SystemExit(1)
+    receiving = asyncio.ensure_future(receive())
+    try:
+        while not receiving.done():
+            wanted = srv.published_time is not None and \
+                loop.time() - srv.published_time < CLUSTER_HOLD
+            send_message(w, (
+                os.getpid(), srv.stats, srv.metrics.snapshot(), wanted
+            ))
+            await asyncio.wait([receiving], timeout=STATS_INTERVAL)
+    finally:
+        receiving.cancel()
+        w.close()
+        await srv.close()
+
+
+class MultiServer:
+    """
+    Runs a :class:`~aiowstunnel.server.Server` on ``host:port`` in each of
+    ``workers`` processes (the number of CPUs by default), sharing the
+    port with ``SO_REUSEPORT``. The kernel spreads new websockets among
+    the workers. Keyword arguments are passed to the servers.
+
+    Every worker reports its stats to this supervisor over a socket pair,
+    with length prefixed messages that neither side waits for: a message
+    is skipped while the previous one is not sent yet. A worker that
+    served ``/stats``, ``/stats/json`` or ``/metrics`` within
+    ``CLUSTER_HOLD`` seconds gets back the stats of all workers, so they
+    show the whole server, whichever worker answers; the metrics are
+    summed. The first request to a worker shows only its own.
+
+    A worker that dies is restarted after ``RESTART_DELAY`` seconds,
+    doubled up to ``RESTART_DELAY_MAX`` while it keeps dying within that
+    time. A worker that fails to start (can not create its server or
+    listen) is not restarted.
+
+    A ``LISTEN`` mode forward listener is bound in the worker that got the
+    websocket asking for it; another worker can not bind the same address.
+    A websocket of the same group (see ``Client(pool_size=...)``) landing
+    in another worker is refused and reconnects, until the kernel assigns
+    it to the worker holding the listener.
+    """
+
+    def __init__(self, host, port, workers=None, **server_kwargs):
+        self.host, self.port = host, port
+        self.workers = workers or os.cpu_count() or 1
+        self.server_kwargs = server_kwargs
+        self._processes = {}  # index: (process, task reading its reports)
+        self._writers = {}  # index: stream to the worker
+        self._stats = {}  # index: (pid, stats, metrics snapshot)
+        self._started = {}  # index: time of the first report
+        self._delays = {}  # index: last restart delay
+        self._restarts = {}  # index: timer handle
+        self._cluster = None  # (time, encoded stats of all workers)
+        self._closing = False
+        self.loop = None
+
+    def start(self):
+        """
+        Start the workers. This function is not a coroutine, will not block.
+        """
+        self.loop = asyncio.get_event_loop()
+        for index in range(self.workers):
+            self._start_worker(index)
+
+    def _start_worker(self, index):
+        self._restarts.pop(index, None)
+        sock, child_sock = socket.socketpair()
+        process = multiprocessing.Process(
+            target=_worker,
+            args=(index, self.host, self.port, self.server_kwargs, child_sock),
+            daemon=True
+        )
+        process.start()
+        child_sock.close()
+        reader = asyncio.ensure_future(self._read_reports(index, sock))
+        self._processes[index] = (process, reader)
+        logger.info('worker {} started, pid {}'.format(index, process.pid))
+
+    async def _read_reports(self, index, sock):
+        r, w = await asyncio.open_connection(sock=sock)
+        self._writers[index] = w
+        try:
+            while True:
+                pid, stats, snapshot, wanted = await recv_message(r)
+                self._stats[index] = (pid, stats, snapshot)
+                self._started.setdefault(index, self.loop.time())
+                if wanted:
+                    send_message(w, self._cluster_message())
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            w.close()
+            del self._writers[index]
+        self._exited(index)
+
+    def _cluster_message(self):
+        # built once per interval, whichever workers want it
+        now = self.loop.time()
+        if self._cluster is None or now - self._cluster[0] >= STATS_INTERVAL:
+            msg = encode((self.stats, self.metrics_snapshot()))
+            self._cluster = (now, msg)
+        return self._cluster[1]
+
+    def _exited(self, index):
+        process, _ = self._processes.pop(index)
+        self._stats.pop(index, None)
+        started = self._started.pop(index, None)
+        if self._closing:
+            return
+        process.join(1)  # exiting, it closed the socket
+        if started is None:
+            msg = 'worker {} failed to start ({}), not restarted'
+            logger.error(msg.format(index, process.exitcode))
+            return
+        delay = RESTART_DELAY
+        if self.loop.time() - started < RESTART_DELAY_MAX:
+            # died again soon, back off
+            delay = min(
+                self._delays.get(index, RESTART_DELAY / 2) * 2,
+                RESTART_DELAY_MAX
+            )
+        self._delays[index] = delay
+        msg = 'worker {} exited ({}), restarting in {}s'
+        logger.error(msg.format(index, process.exitcode, delay))
+        self._restarts[index] = self.loop.call_later(
+            delay, self._start_worker, index
+        )
+
+    @property
+    def stats(self):
+        connections = []
+        sessions = {'parked': 0, 'resumed': 0, 'expired': 0}
+        draining = []
+        for index, (pid, stats, _) in sorted(self._stats.items()):
+            for tunnel in stats['connections']:
+                tunnel = dict(tunnel, worker=index)
+                connections.append(tunnel)
+            for key in sessions:
+                sessions[key] += stats['sessions'][key]
+            if stats['draining'] is not None:
+                draining.append(stats['draining'])
+        return {
+            'host': self.host,
+            'port': self.port,
+            'workers': [
+                {'worker': index, 'pid': pid}
+                for index, (pid, _, _) in sorted(self._stats.items())
+            ],
+            'sessions': sessions,
+            'draining': merge_draining(draining),
+            'connections': connections
+        }
+
+    def metrics_snapshot(self):
+        return metrics.merge(m for _, _, m in self._stats.values())
+
+    async def close(self):
+        self._closing = True
+        for timer in self._restarts.values():
+            timer.cancel()
+        self._restarts = {}
+        workers = list(self._processes.values())
+        for w in self._writers.values():
+            w.write(encode(None))
+        for process, reader in workers:
+            await self.loop.run_in_executor(None, process.join, 10)
+            if process.is_alive():
+                process.terminate()
+            reader.cancel()
+        if workers:
+            await asyncio.wait([reader for _, reader in workers])
+        self._processes = {}
+        logger.info('bye...')
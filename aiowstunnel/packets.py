@@ -1,4 +1,6 @@
+import struct
 import types
+import operator
 
 
 def format_data(b, prnt=5):
@@ -15,32 +17,63 @@ class PacketError(Exception):
     pass
 
 
-class GenericPacket:
-    def __init__(self, *args):
-        assert len(args) == len(self.integers) + (1 if self.has_bytes else 0)
-        self._args = args
+# Version 2 of the wire format writes stream ids (the leading ``id`` and
+# ``peer_id`` fields) as varints, 7 bits per byte, least significant
+# first, so they are not limited to 16 bits. The other integers and the
+# payload are the same as in version 1.
+_SMALL = [bytes((n, )) for n in range(128)]
 
-    def __getattr__(self, name):
-        if name == 'bytes':
-            if self.has_bytes:
-                return self._args[-1]
-            else:
-                raise AttributeError(name)
+
+def varint(n):
+    if n < 128:
+        return _SMALL[n]
+    out = bytearray()
+    while n >= 128:
+        out.append(n & 127 | 128)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def read_varint(b, offset):
+    """
+    Decode the varint at ``offset`` of ``b``, return it and the offset
+    after it.
+    """
+    n, shift = 0, 0
+    while True:
         try:
-            return self._args[self.integers.index(name)]
-        except ValueError:
-            pass
-        raise AttributeError(name)
+            byte = b[offset]
+        except IndexError:
+            raise PacketError('truncated varint')
+        offset += 1
+        n |= (byte & 127) << shift
+        if byte < 128:
+            return n, offset
+        shift += 7
+        if shift >= 35:
+            raise PacketError('varint too long')
+
+
+class GenericPacket(tuple):
+    # packets are tuples of their fields (like namedtuples), ``code``,
+    # ``name``, ``integers``, ``has_bytes`` and the precompiled ``header``
+    # struct are set on the generated subclasses, and for version 2 the
+    # number of leading ``ids`` and the struct of the integers after them
+    __slots__ = ()
+
+    def __new__(cls, *args):
+        assert len(args) == len(cls.integers) + (1 if cls.has_bytes else 0)
+        return tuple.__new__(cls, args)
 
     def __len__(self):
-            return (
-                1 + 2 * len(self.integers) +
-                (len(self.bytes) if self.has_bytes else 0)
-            )
+        if self.has_bytes:
+            return self.header.size + len(self[-1])
+        return self.header.size
 
     def __str__(self):
         name = self.__class__.__name__
-        args = list(zip(self.integers, self._args))
+        args = list(zip(self.integers, self))
         if self.has_bytes:
             args.append(('bytes', format_data(self.bytes)))
         args = ', '.join('%s=%s' % a for a in args)
@@ -48,57 +81,203 @@ class GenericPacket:
 
     @property
     def as_bytes(self):
-        ba = bytearray(len(self))
-        ba[0] = self.code
-        for i, arg in enumerate(self.integers):
-            start = 1 + 2 * i
-            ba[start:start + 2] = self._args[i].to_bytes(2, byteorder='big')
         if self.has_bytes:
-            start = 1 + 2 * len(self.integers)
-            ba[start:] = self.bytes
-        return bytes(ba)
+            # one copy of the payload, straight into the result
+            return self.header.pack(self.code, *self[:-1]) + \
+                self[-1]
+        return self.header.pack(self.code, *self)
+
+    def pack_into(self, buffer, offset=0):
+        """
+        Write the packet into ``buffer`` at ``offset``, return the offset
+        after the packet.
+        """
+        header = self.header
+        if self.has_bytes:
+            header.pack_into(buffer, offset, self.code, *self[:-1])
+            start = offset + header.size
+            end = start + len(self[-1])
+            buffer[start:end] = self[-1]
+            return end
+        header.pack_into(buffer, offset, self.code, *self)
+        return offset + header.size
 
     @classmethod
     def from_bytes(cls, _bytes):
-        args = []
-        for i, _ in enumerate(cls.integers):
-            start = 1 + 2 * i
-            integer = int.from_bytes(_bytes[start:start + 2], byteorder='big')
-            args.append(integer)
+        args = cls.header.unpack_from(_bytes)
+        if cls.has_bytes:
+            # the payload is a view of the received frame, not a copy
+            payload = memoryview(_bytes)[cls.header.size:]
+            return cls(*args[1:], payload)
+        return cls(*args[1:])
+
+    def header_v2(self):
+        if self.simple_v2:
+            # Data, Request, Closed...: the code and one id
+            return self.prefix + varint(self[0])
+        parts = [self.prefix]
+        for i in range(self.ids):
+            parts.append(varint(self[i]))
+        if self.tail.size:
+            parts.append(self.tail.pack(*self[self.ids:len(self.integers)]))
+        return b''.join(parts)
+
+    @property
+    def as_bytes_v2(self):
+        if self.has_bytes:
+            return self.header_v2() + self[-1]
+        return self.header_v2()
+
+    @classmethod
+    def from_bytes_v2(cls, _bytes):
+        if cls.simple_v2 and len(_bytes) > 1 and _bytes[1] < 128:
+            # one id below 128
+            if cls.has_bytes:
+                return cls(_bytes[1], memoryview(_bytes)[2:])
+            return cls(_bytes[1])
+        args, offset = [], 1
+        for _ in range(cls.ids):
+            value, offset = read_varint(_bytes, offset)
+            args.append(value)
+        if cls.tail.size:
+            args.extend(cls.tail.unpack_from(_bytes, offset))
+            offset += cls.tail.size
         if cls.has_bytes:
-            start = 1 + 2 * len(cls.integers)
-            args.append(_bytes[start:])
+            args.append(memoryview(_bytes)[offset:])
         return cls(*args)
 
 
 # Define packet types here:
-# (class name, 2-byte integer attribute names, is there stream data?)
+# (class name, struct format of the integers, integer attribute names,
+# is there stream data?)
 packets = (
-    ('ListenOK', (), False),
-    # ('Greeting', ('maps', 'mabc', 'nhb'), False),
-    ('Request', ('id',), False),
-    ('Accept', ('peer_id', 'id'), False),
-    ('Reject', ('peer_id', ), False),
-    ('Data', ('peer_id', ), True),
-    ('Continue', ('peer_id', ), False),
-    ('Closed', ('peer_id', ), False),
+    ('ListenOK', '', (), False),
+    ('Request', 'H', ('id',), False),
+    ('Accept', 'HH', ('peer_id', 'id'), False),
+    ('Reject', 'H', ('peer_id', ), False),
+    ('Data', 'H', ('peer_id', ), True),
+    ('Continue', 'HI', ('peer_id', 'increment'), False),
+    ('Closed', 'H', ('peer_id', ), False),
+    # length prefixed packets coalesced into one websocket frame
+    ('Batch', '', (), True),
+    # codecs the sender can decompress (compression.ZLIB | LZ4 bits)
+    ('Compress', 'HB', ('peer_id', 'codecs'), False),
+    # Data compressed with a codec
+    ('ZData', 'HB', ('peer_id', 'codec'), True),
+    # Data sent before the Accept, by the id of the Request
+    ('EarlyData', 'H', ('id', ), True),
+    # protocol version, feature bits, initial stream window and largest
+    # frame (0: no limit) of the sender, exchanged at tunnel start
+    ('Greeting', 'BHII', ('version', 'features', 'window', 'max_size'), False),
+    # session token, the number of Acks following (resumed streams)
+    ('Resume', 'I', ('streams', ), True),
+    # bytes of a stream received, the window from there and the flags
+    # (CLOSED: the stream's Closed arrived too) of a resumable stream
+    ('Ack', 'HHQIB', ('peer_id', 'id', 'received', 'window', 'flags'), False),
+    # the sender drains: open new streams on another tunnel
+    ('Drain', '', (), False),
 )
 
+# Ack.flags
+CLOSED = 1
+
+# Version 0 is the wire format of peers without a Greeting: a Continue has
+# no increment, it lets the peer send LEGACY_CREDIT more Data packets.
+LEGACY_CREDIT = 64
+_legacy_continue = struct.Struct('>BH')
+
 klasses = []
 
 current_module = __import__(__name__)
-for code, (name, integers, has_bytes) in enumerate(packets):
+for code, (name, fmt, integers, has_bytes) in enumerate(packets):
     def fnc(ns):
+        ns['__slots__'] = ()
         ns['code'] = code
         ns['name'] = name
         ns['integers'] = integers
         ns['has_bytes'] = has_bytes
+        ns['header'] = struct.Struct('>B' + fmt)
+        ids = 0
+        while ids < len(integers) and integers[ids] in ('id', 'peer_id'):
+            ids += 1
+        ns['ids'] = ids
+        ns['tail'] = struct.Struct('>' + fmt[ids:])
+        ns['prefix'] = bytes((code, ))
+        ns['simple_v2'] = ids == 1 and len(integers) == 1
+        for i, integer in enumerate(integers):
+            ns[integer] = property(operator.itemgetter(i))
+        if has_bytes:
+            ns['bytes'] = property(operator.itemgetter(-1))
 
     klass = types.new_class(name, (GenericPacket,), None, fnc)
     locals()[name] = klass
     klasses.append(klass)
 
 
-def get_packet(bytes):
+def get_packet(bytes, version=1):
     code = bytes[0]
-    return klasses[code].from_bytes(bytes)
+    if version < 2:
+        if version == 0 and code == Continue.code:  # NOQA
+            _, peer_id = _legacy_continue.unpack_from(bytes)
+            return Continue(peer_id, LEGACY_CREDIT)  # NOQA
+        return klasses[code].from_bytes(bytes)
+    return klasses[code].from_bytes_v2(bytes)
+
+
+def encode(pack, version=1):
+    if version < 2:
+        if version == 0 and pack.code == Continue.code:  # NOQA
+            return _legacy_continue.pack(pack.code, pack.peer_id)
+        return pack.as_bytes
+    return pack.as_bytes_v2
+
+
+_length = struct.Struct('>I')
+
+
+def batch(packs, version=1):
+    """
+    Pack ``packs`` into the bytes of a single :class:`Batch` packet.
+    """
+    parts = [Batch.header.pack(Batch.code)]  # NOQA
+    if version >= 2:
+        # varint lengths
+        for pack in packs:
+            header = pack.header_v2()
+            if pack.has_bytes:
+                parts.append(varint(len(header) + len(pack[-1])))
+                parts.append(header)
+                parts.append(pack[-1])
+            else:
+                parts.append(varint(len(header)))
+                parts.append(header)
+        return b''.join(parts)
+    for pack in packs:
+        parts.append(_length.pack(len(pack)))
+        if pack.has_bytes:
+            parts.append(pack.header.pack(pack.code, *pack[:-1]))
+            parts.append(pack[-1])
+        else:
+            parts.append(pack.header.pack(pack.code, *pack))
+    return b''.join(parts)
+
+
+def unbatch(pack, version=1):
+    """
+    Iterate over the packets of a :class:`Batch`. The packets are decoded
+    from views of the batch, nothing is copied.
+    """
+    data = pack.bytes
+    offset, end = 0, len(data)
+    while offset < end:
+        if version < 2:
+            if offset + _length.size > end:
+                raise PacketError('invalid batch')
+            length, = _length.unpack_from(data, offset)
+            offset += _length.size
+        else:
+            length, offset = read_varint(data, offset)
+        if length == 0 or offset + length > end:
+            raise PacketError('invalid batch')
+        yield get_packet(data[offset:offset + length], version)
+        offset += length
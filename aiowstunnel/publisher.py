@@ -0,0 +1,203 @@
+"""
+This module implements the :class:`~StatsPublisher` class, feeding the
+``/stats`` websockets of a server.
+
+The stats are built once per tick for all the subscribers that are due,
+however many are connected. A subscriber first gets a full snapshot::
+
+    {"type": "snapshot", "host": ..., "port": ...,
+     "tunnels": {key: tunnel}, "streams": {key: stream}}
+
+where tunnels are the tunnels of :attr:`~aiowstunnel.server.Server.stats`
+without their ``connections``, and streams are those connections with the
+key of their tunnel in ``tunnel``. Then only what changed since its
+previous update::
+
+    {"type": "delta",
+     "tunnels": {"set": {key: changed fields}, "removed": [key, ...]},
+     "streams": {"set": {key: changed fields}, "removed": [key, ...]}}
+
+A new tunnel or stream comes with all its fields. Nothing is sent when
+nothing changed. Subscribers get an update every ``interval`` seconds,
+rounded to whole ticks; those with the same interval share the encoded
+messages. Each subscriber is sent to on its own: one still busy with its
+previous update skips the tick, one taking more than ``send_timeout``
+seconds for an update is dropped.
+"""
+
+import asyncio
+import json
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+TICK = 1  # seconds
+SEND_TIMEOUT = 10  # seconds
+MAX_INTERVAL = 3600
+
+
+def flatten(stats):
+    """
+    The tunnels and streams of ``stats`` in two dicts keyed by stable ids.
+    """
+    tunnels, streams = {}, {}
+    for tunnel in stats['connections']:
+        tunnel = dict(tunnel)
+        key = '{}|{}|{}'.format(
+            tunnel.get('worker', ''), tunnel['mode'],
+            tunnel['id'] if tunnel['group'] is None else tunnel['group']
+        )
+        for stream in tunnel.pop('connections'):
+            skey = '{}|{}|{}'.format(key, stream['websocket'], stream['id'])
+            streams[skey] = dict(stream, tunnel=key)
+        tunnels[key] = tunnel
+    return tunnels, streams
+
+
+def diff(old, new):
+    changed = {}
+    for key, item in new.items():
+        prev = old.get(key)
+        if prev is None:
+            changed[key] = item
+        elif prev != item:
+            changed[key] = {
+                k: v for k, v in item.items() if k not in prev or prev[k] != v
+            }
+    removed = [key for key in old if key not in new]
+    return {'set': changed, 'removed': removed}
+
+
+class Subscriber:
+    def __init__(self, ws, every):
+        self.ws = ws
+        self.every = every  # ticks between updates
+        self.last = None  # the (stats, tunnels, streams) sent last
+        self.sending = None  # the task sending an update
+        self.done = asyncio.get_event_loop().create_future()
+
+
+class StatsPublisher:
+    def __init__(self, get_stats, tick=TICK, send_timeout=SEND_TIMEOUT):
+        self.get_stats = get_stats
+        self.tick = tick
+        self.send_timeout = send_timeout
+        self.subscribers = set()
+        self._task = None
+        self._tick = 0
+        self._latest = None  # (stats, tunnels, streams)
+        self._built_at = None
+
+    async def subscribe(self, ws, interval=TICK):
+        """
+        Send the stats to ``ws`` every ``interval`` seconds, until it is
+        closed.
+        """
+        interval = min(max(interval, self.tick), MAX_INTERVAL)
+        sub = Subscriber(ws, max(1, round(interval / self.tick)))
+        latest = self._latest
+        now = asyncio.get_event_loop().time()
+        if latest is None or now - self._built_at >= self.tick:
+            latest = self._build()
+        try:
+            await ws.send(self._snapshot(latest))
+        except Exception:
+            return
+        sub.last = latest
+        self.subscribers.add(sub)
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        closed = asyncio.ensure_future(self._wait_closed(ws))
+        try:
+            await asyncio.wait(
+                [sub.done, closed], return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            self.subscribers.discard(sub)
+            closed.cancel()
+            if sub.sending is not None:
+                sub.sending.cancel()
+
+    async def _wait_closed(self, ws):
+        # subscribers do not send anything, recv returns when it is closed
+        try:
+            while True:
+                await ws.recv()
+        except Exception:
+            pass
+
+    def _build(self):
+        stats = self.get_stats()
+        self._latest = (stats, ) + flatten(stats)
+        self._built_at = asyncio.get_event_loop().time()
+        return self._latest
+
+    def _snapshot(self, latest):
+        stats, tunnels, streams = latest
+        return json.dumps({
+            'type': 'snapshot',
+            'host': stats['host'],
+            'port': stats['port'],
+            'tunnels': tunnels,
+            'streams': streams
+        })
+
+    def _delta(self, last, current):
+        tunnels = diff(last[1], current[1])
+        streams = diff(last[2], current[2])
+        if not any(tunnels.values()) and not any(streams.values()):
+            return None
+        return json.dumps(
+            {'type': 'delta', 'tunnels': tunnels, 'streams': streams}
+        )
+
+    async def _send(self, sub, msg):
+        try:
+            await asyncio.wait_for(sub.ws.send(msg), self.send_timeout)
+        except Exception:
+            if not sub.done.done():
+                sub.done.set_result(None)
+        finally:
+            sub.sending = None
+
+    async def _run(self):
+        try:
+            while self.subscribers:
+                await asyncio.sleep(self.tick)
+                self._tick += 1
+                # one still sending gets everything in its next delta
+                due = [
+                    s for s in self.subscribers
+                    if self._tick % s.every == 0 and not s.done.done() and
+                    s.sending is None
+                ]
+                if not due:
+                    continue
+                current = self._build()
+                # subscribers that got the same stats get the same delta
+                messages = {}
+                for sub in due:
+                    key = id(sub.last)
+                    if key not in messages:
+                        messages[key] = self._delta(sub.last, current)
+                    sub.last = current
+                    if messages[key] is not None:
+                        sub.sending = asyncio.ensure_future(
+                            self._send(sub, messages[key])
+                        )
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.exception('exception in stats publisher')
+        finally:
+            self._task = None
+            for sub in self.subscribers:
+                if not sub.done.done():
+                    sub.done.set_result(None)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await self._task
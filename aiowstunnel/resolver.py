@@ -0,0 +1,215 @@
+"""
+This module implements the :class:`~Resolver` class, resolving and
+connecting to the targets of ``CONNECT`` mode tunnels.
+
+Lookups are cached for ``ttl`` seconds, failed ones for ``negative_ttl``
+seconds, and lookups of a name already being resolved wait for that one,
+so a burst of new streams costs a single ``getaddrinfo`` in the default
+executor instead of one each.
+
+Connections are raced across the addresses like in RFC 8305 (happy
+eyeballs): the address families alternate, starting with the first one
+``getaddrinfo`` returned, a new attempt starts when the previous one fails
+or has not succeeded in ``CONNECT_DELAY`` seconds, the first connection
+established wins and the other attempts are cancelled. All of it is
+limited to ``connect_timeout`` seconds.
+"""
+
+import asyncio
+import collections
+import itertools
+import socket
+
+from .metrics import Metrics
+
+
+CONNECT_DELAY = 0.25  # seconds, the Connection Attempt Delay of RFC 8305
+
+
+def interleave(addresses):
+    """
+    Order ``(family, sockaddr)`` pairs alternating between the families.
+    """
+    families = collections.OrderedDict()
+    for address in addresses:
+        families.setdefault(address[0], []).append(address)
+    return [
+        address
+        for addresses in itertools.zip_longest(*families.values())
+        for address in addresses if address is not None
+    ]
+
+
+class TargetStats:
+    __slots__ = (
+        'hits', 'misses', 'negative_hits', 'connects', 'failures',
+        'connect_time'
+    )
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.connects = 0
+        self.failures = 0
+        self.connect_time = None  # smoothed, seconds
+
+    def as_dict(self):
+        cached = self.hits + self.negative_hits
+        lookups = cached + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'negativeHits': self.negative_hits,
+            'hitRate': cached / lookups if lookups else None,
+            'connects': self.connects,
+            'connectFailures': self.failures,
+            'connectTime': self.connect_time
+        }
+
+
+class Resolver:
+    def __init__(
+        self, ttl=60, negative_ttl=5, connect_timeout=10, metrics=None,
+        loop=None
+    ):
+        self.ttl, self.negative_ttl = ttl, negative_ttl
+        self.connect_timeout = connect_timeout
+        self.metrics = Metrics() if metrics is None else metrics
+        self.loop = asyncio.get_event_loop() if loop is None else loop
+        # (host, port): (expires, addresses or the OSError of the lookup)
+        self.cache = {}
+        self.targets = {}  # (host, port): TargetStats
+        self._lookups = {}  # (host, port): lookup in progress
+        self._lookup_results = {
+            result: self.metrics.dns_lookups.labels(result)
+            for result in ('hit', 'miss', 'negative')
+        }
+
+    def stats(self, host, port):
+        target = self.targets.get((host, port))
+        return target and target.as_dict()
+
+    def _target(self, key):
+        target = self.targets.get(key)
+        if target is None:
+            target = self.targets[key] = TargetStats()
+        return target
+
+    async def resolve(self, host, port):
+        """
+        The ``(family, sockaddr)`` pairs of ``host`` in the order to try
+        them. Raises the ``OSError`` of the lookup.
+        """
+        key = (host, port)
+        target = self._target(key)
+        entry = self.cache.get(key)
+        if entry is not None and entry[0] > self.loop.time():
+            result = entry[1]
+            if isinstance(result, OSError):
+                target.negative_hits += 1
+                self._lookup_results['negative'].inc()
+                raise result
+            target.hits += 1
+            self._lookup_results['hit'].inc()
+            return result
+        lookup = self._lookups.get(key)
+        if lookup is None:
+            target.misses += 1
+            self._lookup_results['miss'].inc()
+            lookup = asyncio.ensure_future(self._lookup(key))
+            self._lookups[key] = lookup
+        else:
+            target.hits += 1  # answered by the lookup in progress
+            self._lookup_results['hit'].inc()
+        # one waiter cancelled must not cancel the lookup of the others
+        return await asyncio.shield(lookup)
+
+    async def _lookup(self, key):
+        host, port = key
+        try:
+            infos = await self.loop.getaddrinfo(
+                host, port, type=socket.SOCK_STREAM
+            )
+            if not infos:
+                raise OSError('no address for {}'.format(host))
+        except OSError as exc:
+            self.cache[key] = (self.loop.time() + self.negative_ttl, exc)
+            raise
+        finally:
+            del self._lookups[key]
+        addresses = interleave([(info[0], info[4]) for info in infos])
+        self.cache[key] = (self.loop.time() + self.ttl, addresses)
+        return addresses
+
+    async def open_connection(self, host, port):
+        """
+        Like ``asyncio.open_connection``, with the cache and the race.
+        """
+        target = self._target((host, port))
+        start = self.loop.time()
+        try:
+            addresses = await self.resolve(host, port)
+            r, w = await asyncio.wait_for(
+                self._race(addresses), self.connect_timeout
+            )
+        except asyncio.TimeoutError:
+            target.failures += 1
+            msg = 'connecting to {}:{} timed out'
+            raise TimeoutError(msg.format(host, port))
+        except OSError:
+            target.failures += 1
+            raise
+        elapsed = self.loop.time() - start
+        self.metrics.connect_seconds.labels().observe(elapsed)
+        target.connects += 1
+        if target.connect_time is None:
+            target.connect_time = elapsed
+        else:
+            target.connect_time += (elapsed - target.connect_time) / 8
+        return r, w
+
+    async def _race(self, addresses):
+        addresses = collections.deque(addresses)
+        attempts, errors = set(), []
+        try:
+            while addresses or attempts:
+                timeout = None
+                if addresses:
+                    attempts.add(asyncio.ensure_future(
+                        self._connect(*addresses.popleft())
+                    ))
+                    if addresses:
+                        timeout = CONNECT_DELAY
+                done, attempts = await asyncio.wait(
+                    attempts, timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                connected = [t.result() for t in done if not t.exception()]
+                errors += [t.exception() for t in done if t.exception()]
+                if connected:
+                    # attempts finishing together: keep the first one
+                    for r, w in connected[1:]:
+                        w.close()
+                    return connected[0]
+        finally:
+            for attempt in attempts:
+                if not attempt.done():
+                    attempt.cancel()
+                elif not attempt.exception():
+                    attempt.result()[1].close()  # won too late
+        if len(errors) == 1:
+            raise errors[0]
+        raise OSError('Multiple exceptions: {}'.format(
+            ', '.join(str(exc) for exc in errors)
+        ))
+
+    async def _connect(self, family, sockaddr):
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.setblocking(False)
+            await self.loop.sock_connect(sock, sockaddr)
+            return await asyncio.open_connection(sock=sock)
+        except BaseException:
+            sock.close()
+            raise
@@ -0,0 +1,125 @@
+"""
+Outgoing packet scheduling for a tunnel.
+
+Packets of forwarded connections are queued per connection (a
+:class:`Flow`) and taken with deficit round robin, so a bulk transfer can
+not monopolise the websocket. Packets without a flow (control packets:
+requests, accepts, window updates) go first.
+"""
+
+import collections
+
+
+QUANTUM = 16 * 1024  # bytes per round for a flow of weight 1
+FLOW_LIMIT = 64 * 1024  # queued bytes a flow's sender may run ahead
+
+
+class Flow:
+    def __init__(self, scheduler, weight):
+        self.scheduler = scheduler
+        self.weight = weight
+        self.queue = collections.deque()  # (packet, enqueue time)
+        self.bytes = 0
+        self.deficit = 0
+        self.active = False  # in the round robin
+        self.visited = False  # got its quantum in the current round
+        self.queue_delay = 0  # smoothed queueing delay, seconds
+        self._space = None
+
+    async def wait_space(self):
+        while self.bytes >= FLOW_LIMIT:
+            if self._space is None:
+                self._space = self.scheduler.loop.create_future()
+            await self._space
+
+    def _release(self):
+        if self.bytes < FLOW_LIMIT and self._space is not None:
+            if not self._space.done():
+                self._space.set_result(None)
+            self._space = None
+
+
+class Scheduler:
+    def __init__(self, loop, quantum=QUANTUM):
+        self.loop = loop
+        self.quantum = quantum
+        self.control = collections.deque()
+        self.active = collections.deque()  # flows with queued packets
+        self.bytes = 0
+        self.queue_wait = None  # a metrics.Histogram of the waiting times
+
+    def flow(self, weight=1):
+        return Flow(self, max(int(weight), 1))
+
+    def __len__(self):
+        return len(self.control) + len(self.active)
+
+    def push(self, packet, flow=None):
+        size = len(packet)
+        self.bytes += size
+        if flow is None:
+            self.control.append(packet)
+            return
+        flow.queue.append((packet, self.loop.time()))
+        flow.bytes += size
+        if not flow.active:
+            flow.active = True
+            self.active.append(flow)
+
+    def take(self, limit):
+        """
+        Take packets to send, control packets first, then round robin over
+        the flows. Stops when at least ``limit`` bytes are taken.
+        """
+        packs, size = [], 0
+        control = self.control
+        while control and size < limit:
+            pack = control.popleft()
+            packs.append(pack)
+            size += len(pack)
+
+        active = self.active
+        now = self.loop.time()
+        queue_wait = self.queue_wait
+        while active and size < limit:
+            flow = active[0]
+            if not flow.visited:
+                flow.deficit += self.quantum * flow.weight
+                flow.visited = True
+            queue = flow.queue
+            while queue and size < limit:
+                pack, queued_at = queue[0]
+                n = len(pack)
+                if n > flow.deficit:
+                    break
+                queue.popleft()
+                flow.deficit -= n
+                flow.bytes -= n
+                wait = now - queued_at
+                flow.queue_delay += (wait - flow.queue_delay) / 8
+                if queue_wait is not None:
+                    queue_wait.observe(wait)
+                packs.append(pack)
+                size += n
+            flow._release()
+            if not queue:
+                active.popleft()
+                flow.active = flow.visited = False
+                flow.deficit = 0
+            elif size < limit:
+                # quantum used up, next flow
+                flow.visited = False
+                active.rotate(-1)
+
+        self.bytes -= size
+        return packs
+
+    def clear(self):
+        self.control.clear()
+        for flow in self.active:
+            flow.queue.clear()
+            flow.bytes = 0
+            flow.active = flow.visited = False
+            flow._release()
+        self.active.clear()
+        self.bytes = 0
@@ -7,36 +7,261 @@ import logging
 import asyncio
 from urllib import parse
 import json
+import math
 import os
+import time
 from http import HTTPStatus
 
 import websockets
 
-from .connection import Connection, TunnelListenError
+from .connection import Connection, TunnelListenError, TunnelHandshakeError
+from .connection import SUBPROTOCOL, DRAIN_CHECK
+from .listener import Listener, LEAST_STREAMS
+from .compression import CODECS, NAMES
+from . import fwd_connection
 from . import ids
+from . import metrics
+from .publisher import StatsPublisher, TICK, MAX_INTERVAL
+from .resolver import Resolver
+from .session import Sessions
+from .balancer import Balancer, LEAST_CONNECTIONS
+from .handoff import Handoff
+from . import handoff
+from . import history
+from . import LISTEN, CONNECT
 
 
 logger = logging.getLogger(__name__)
 
 
+MAX_TUNNELS = 1 << 20  # tunnel websockets of a server
+MAX_HISTORIES = 1024
+# try again later: 1013 in the application range, websockets < 9 refuses it
+CLOSE_TRY_AGAIN = 4013
+
+
+def stats_interval(query):
+    """
+    The seconds between ``/stats`` updates in ``query``, ``None`` if it is
+    malformed.
+    """
+    try:
+        interval = float(parse.parse_qs(query)['interval'][0])
+    except KeyError:
+        return TICK
+    except ValueError:
+        return None
+    return interval if math.isfinite(interval) else None
+
+
 class Server:
     """
     The Server class represents the tunnel server listening on ``host:port``.
+
+    ``window_size`` is the number of bytes a peer can send on a forwarded
+    connection before it has to wait for the data to be written to the
+    socket (the flow control window). Every forwarded connection measures
+    its round trip time and bandwidth and tunes its window between
+    ``window_min`` and ``window_max`` bytes.
+
+    With a positive ``batch_size`` packets sent within ``batch_delay``
+    seconds are coalesced into websocket frames of up to ``batch_size``
+    bytes. Clients must support batches when it is turned on.
+
+    Forwarded connections of a tunnel share the websocket in proportion to
+    their weight. ``stream_weight`` is an integer, or a callable getting
+    the new :class:`~aiowstunnel.fwd_connection.FwdConnection` and
+    returning its weight, e.g. to prefer interactive ports::
+
+        lambda fwd_conn: 8 if fwd_conn.connection.port == 22 else 1
+
+    Sockets are read in chunks growing from ``read_size_min`` up to
+    ``read_size_max`` bytes while they keep filling the buffer, and
+    shrinking when they do not. A positive ``read_delay`` (seconds) lets
+    short reads wait for more data, sending fewer, larger packets at the
+    cost of that much latency.
+
+    ``compression`` names a codec (``'zlib'``, or ``'lz4'`` if the lz4
+    package is installed) to compress the data of forwarded connections
+    with, see :mod:`~aiowstunnel.compression`. It is negotiated per
+    connection: a side compresses only if the other side turned it on too.
+    ``ws_compression`` is passed to ``websockets``, ``None`` turns off
+    permessage-deflate, pointless on top of ``compression``.
+
+    With a positive ``early_data`` a connection to a ``LISTEN`` tunnel
+    sends up to that many bytes (at most the initial window) right after
+    the request, without waiting for the other side to connect to the
+    target. It saves a round trip for protocols where the client speaks
+    first. A rejected connection is closed, its early data dropped.
+
+    ``LISTEN`` tunnels asking for the same host and port share one
+    listener, whether they are the websockets of one pooled client or
+    independent clients. New connections go to the member with the fewest
+    streams, or to the members in turn with ``listen_balance`` set to
+    ``'round-robin'``. A member dropping only takes its own streams, the
+    listener stays open while any member is left. See
+    :mod:`~aiowstunnel.listener`.
+
+    In ``CONNECT`` mode up to ``connect_pool_max`` idle connections to the
+    target are kept open, at least ``connect_pool_min``, each for at most
+    ``connect_pool_ttl`` seconds, so new forwarded connections do not wait
+    for a TCP handshake. See :mod:`~aiowstunnel.connect_pool`.
+
+    Target names are resolved once per ``dns_ttl`` seconds, failures once
+    per ``dns_negative_ttl`` seconds, and connections are raced over the
+    addresses (happy eyeballs) for at most ``connect_timeout`` seconds,
+    see :mod:`~aiowstunnel.resolver`. Hit rates and connect times are in
+    the ``resolver`` stats of ``CONNECT`` tunnels.
+
+    ``targets`` maps ``(host, port)`` pairs of ``CONNECT`` tunnel paths to
+    lists of ``(host, port)`` or ``(host, port, weight)`` targets the
+    forwarded connections are spread over, with ``balance``
+    (``'least-connections'`` or ``'weighted'``). Targets are probed every
+    ``health_interval`` seconds, with a ``health_timeout``, and ejected
+    while they fail, see :mod:`~aiowstunnel.balancer`. Their connection
+    counts and connect times are in the ``targets`` stats of the tunnel.
+    The connect pool is not used for them.
+
+    With a positive ``resume_timeout`` (on the client too) a tunnel whose
+    websocket fails keeps its forwarded connections open for that many
+    seconds, and a client reconnecting in time resumes them where they
+    were, see :mod:`~aiowstunnel.session`. The ``sessions`` stats count
+    the parked, resumed and expired sessions.
+
+    :meth:`drain` closes the server gracefully, e.g. before a restart: no
+    new websockets and forwarded connections are taken, clients are told
+    to open new tunnels elsewhere, and the open streams have a deadline to
+    finish. The ``draining`` stats show the progress.
+
+    With a ``handoff_path`` a new server process takes over the listening
+    sockets for an upgrade, the tunnel port and the forward ports of
+    ``LISTEN`` tunnels: the server waits for its successor on a Unix socket
+    at that path, and a server started with the same path while another
+    one runs there gets its sockets. Once the new server accepts on them
+    the old one drains for ``handoff_drain`` seconds and closes, see
+    :mod:`~aiowstunnel.handoff`. A forward port waits for its tunnel to
+    reconnect in the new server, handed over ports not taken in
+    ``handoff_drain`` seconds are closed. :meth:`wait_closed` returns when
+    the server closed.
+
+    Clients of this version agree with the server on the protocol version,
+    the features and the window sizes at the start of a tunnel (see
+    :class:`~aiowstunnel.connection.Connection`). Older clients send no
+    Greeting and are served in protocol version 0, the original one: no
+    batches, compression, early data, resume or drain, and flow control
+    windows counted in packets.
+
+    Prometheus metrics are served on ``/metrics``. ``/stats/history``
+    serves the throughput history of the tunnels (see
+    :mod:`~aiowstunnel.history`), ``?period=1`` or ``?period=60`` selects
+    one resolution. A tunnel gets a history once it started, at most
+    ``MAX_HISTORIES`` are kept: the one idle for the longest goes first.
+
+    With ``reuse_port`` several processes can listen on the same port, see
+    :class:`~aiowstunnel.multiserver.MultiServer`.
     """
 
     def __init__(
         self, host, port,
         response_timeout=5, heartbeat_interval=10,
+        window_size=fwd_connection.INITIAL_WINDOW,
+        window_min=fwd_connection.WINDOW_MIN,
+        window_max=fwd_connection.WINDOW_MAX,
+        batch_size=0, batch_delay=0.001,
+        stream_weight=1,
+        read_size_min=fwd_connection.READ_SIZE_MIN,
+        read_size_max=fwd_connection.READ_SIZE_MAX, read_delay=0,
+        compression=None, ws_compression='deflate', early_data=0,
+        connect_pool_min=0, connect_pool_max=0, connect_pool_ttl=30,
+        dns_ttl=60, dns_negative_ttl=5, connect_timeout=10,
+        targets=None, balance=LEAST_CONNECTIONS,
+        health_interval=5, health_timeout=2,
+        listen_balance=LEAST_STREAMS,
+        resume_timeout=0,
+        handoff_path=None, handoff_drain=30,
+        reuse_port=False,
         loop=None
     ):
         self.loop = asyncio.get_event_loop() if loop is None else loop
         self.host, self.port = host, port
         self.response_timeout = response_timeout
         self.heartbeat_interval = heartbeat_interval
+        self.window_size = window_size
+        self.window_min, self.window_max = window_min, window_max
+        self.batch_size, self.batch_delay = batch_size, batch_delay
+        self.stream_weight = stream_weight
+        self.read_size_min, self.read_size_max = read_size_min, read_size_max
+        self.read_delay = read_delay
+        assert compression is None or compression in CODECS
+        self.compression = compression
+        self.ws_compression = ws_compression
+        self.early_data = early_data
+        self.connect_pool_min = connect_pool_min
+        self.connect_pool_max = connect_pool_max
+        self.connect_pool_ttl = connect_pool_ttl
+        self.dns_ttl, self.dns_negative_ttl = dns_ttl, dns_negative_ttl
+        self.connect_timeout = connect_timeout
+        self.listen_balance = listen_balance
+        self.resume_timeout = resume_timeout
+        self.sessions = Sessions(resume_timeout, loop=self.loop)
+        self.handoff = None
+        if handoff_path is not None:
+            self.handoff = Handoff(handoff_path, response_timeout, self.loop)
+        self.handoff_drain = handoff_drain
+        # (host, port): forward socket handed over, waiting for its tunnel
+        self.inherited = {}
+        self.reuse_port = reuse_port
+        # set by a MultiServer worker: the stats of all the workers
+        self.cluster_stats = None
+        self.cluster_metrics = None
+        self.published_time = None  # stats or metrics last served
+        self.metrics = metrics.Metrics()
+        self.resolver = Resolver(
+            dns_ttl, dns_negative_ttl, connect_timeout, metrics=self.metrics,
+            loop=self.loop
+        )
+        # (host, port): Balancer
+        self.balancers = {
+            key: Balancer(
+                backends, balance, self.resolver.open_connection,
+                health_interval, health_timeout, loop=self.loop
+            )
+            for key, backends in (targets or {}).items()
+        }
+        self.publisher = StatsPublisher(self.published_stats)
+        # (mode, host, port, group): history.History
+        self.histories = {}
+        self._new_histories = {}  # of tunnels not started yet
+        self.metrics.gauge(
+            'aiowstunnel_tunnels', 'Open tunnel websockets.', ('mode', ),
+            lambda: self._count(lambda conn: 1)
+        )
+        self.metrics.gauge(
+            'aiowstunnel_streams', 'Open forwarded connections.', ('mode', ),
+            lambda: self._count(lambda conn: len(conn.connections))
+        )
+        self.metrics.gauge(
+            'aiowstunnel_send_queue_bytes',
+            'Bytes of packets waiting for the websocket.', ('mode', ),
+            lambda: self._count(lambda conn: conn.scheduler.bytes)
+        )
+        self.metrics.gauge(
+            'aiowstunnel_write_queue_bytes',
+            'Bytes received, waiting to be written to forwarded sockets.',
+            ('mode', ),
+            lambda: self._count(
+                lambda conn: sum(f.queued for f in conn.connections.values())
+            )
+        )
         self._task = None
         self._task_cancelled = False
+        self._ws_server = None
+        self._draining_task = None
+        # since, deadline and streams at start while draining
+        self.draining = None
         self.listening = self.loop.create_future()
-        self.connections = ids.Ids()
+        self.connections = ids.Ids(MAX_TUNNELS)
+        self.listeners = {}  # (host, port): shared fwd listener
 
     def start(self):
         """
@@ -46,58 +271,255 @@ class Server:
 
     @property
     def stats(self):
-        fmt = '%Y-%m-%d %H:%M:%S'
+        # the websockets of a group are one logical tunnel
+        tunnels = {}
+        for id, conn in self.connections.items():
+            key = id if conn.group is None else (conn.mode, conn.group)
+            tunnels.setdefault(key, []).append((id, conn))
         return {
             'host': self.host,
             'port': self.port,
-            'connections': [{
-                'id': id,
-                'mode': conn.mode,
-                'host': conn.host,
-                'port': conn.port,
-                'createTime': conn.create_time.strftime(fmt),
-                'connections': [{
-                    'id': id,
-                    'addr': fwdconn.peername[0],
-                    'port': fwdconn.peername[1],
-                    'fromSocket': fwdconn.from_socket,
-                    'toSocket': fwdconn.to_socket,
-                    'createTime': fwdconn.create_time.strftime(fmt)
-                } for id, fwdconn in conn.connections.items()]
-            } for id, conn in self.connections.items()]
+            'sessions': {
+                'parked': len(self.sessions),
+                'resumed': self.sessions.resumed,
+                'expired': self.sessions.expired
+            },
+            'draining': self.drain_stats(),
+            'connections': [
+                self.tunnel_stats(members) for members in tunnels.values()
+            ]
+        }
+
+    def streams(self):
+        return sum(len(conn.connections) for conn in self.connections.values())
+
+    def drain_stats(self):
+        if self.draining is None:
+            return None
+        return dict(self.draining, streams=self.streams())
+
+    def published_stats(self):
+        """
+        The stats served on ``/stats`` and ``/stats/json``.
+        """
+        self.published_time = self.loop.time()
+        if self.cluster_stats is not None:
+            return self.cluster_stats
+        return self.stats
+
+    def _count(self, fnc):
+        counts = {}
+        for conn in self.connections.values():
+            key = (conn.mode, )
+            counts[key] = counts.get(key, 0) + fnc(conn)
+        return counts
+
+    def published_metrics(self):
+        """
+        The metrics served on ``/metrics``, in the Prometheus text format.
+        """
+        self.published_time = self.loop.time()
+        snapshot = self.cluster_metrics
+        if snapshot is None:
+            snapshot = self.metrics.snapshot()
+        return metrics.render(snapshot)
+
+    def history_stats(self, period=None):
+        now = time.time()
+        return {
+            'host': self.host,
+            'port': self.port,
+            'time': now,
+            'tunnels': [
+                {
+                    'mode': mode, 'host': host, 'port': port, 'group': group,
+                    'active': h.members > 0,
+                    'history': h.query(now, period)
+                }
+                for (mode, host, port, group), h in self.histories.items()
+            ]
+        }
+
+    def _keep_history(self, key):
+        h = self._new_histories.get(key)
+        if h is None:
+            return  # kept already
+        if len(self.histories) >= MAX_HISTORIES:
+            idle = [k for k, v in self.histories.items() if not v.members]
+            if not idle:
+                return
+            oldest = min(
+                idle, key=lambda k: self.histories[k].last_active or 0
+            )
+            del self.histories[oldest]
+        self.histories[key] = self._new_histories.pop(key)
+
+    async def _sample_history(self):
+        while True:
+            now = time.time()
+            # sample at whole seconds
+            await asyncio.sleep(history.SAMPLE_INTERVAL - now % 1)
+            now = time.time()
+            for key, h in list(self.histories.items()):
+                h.sample(now)
+                if h.expired(now):
+                    del self.histories[key]
+
+    def tunnel_stats(self, members):
+        fmt = '%Y-%m-%d %H:%M:%S'
+        id, conn = members[0]
+        return {
+            'id': id,
+            'mode': conn.mode,
+            'host': conn.host,
+            'port': conn.port,
+            'createTime': conn.create_time.strftime(fmt),
+            'group': conn.group,
+            'websockets': [ws_id for ws_id, _ in members],
+            'version': conn.version,
+            'resumable': conn.resume,
+            'framesOut': sum(c.frames_out for _, c in members),
+            'packetsOut': sum(c.packets_out for _, c in members),
+            'connectPool': self.pool_stats(members),
+            'resolver': self.resolver_stats(conn),
+            'targets': conn.balancer and conn.balancer.stats(),
+            'connections': [
+                self.stream_stats(ws_id, id, fwdconn)
+                for ws_id, conn in members
+                for id, fwdconn in conn.connections.items()
+            ]
+        }
+
+    def pool_stats(self, members):
+        pools = [
+            c.connect_pool for _, c in members if c.connect_pool is not None
+        ]
+        if not pools:
+            return None
+        return {
+            'idle': sum(len(p) for p in pools),
+            'hits': sum(p.hits for p in pools),
+            'misses': sum(p.misses for p in pools)
+        }
+
+    def resolver_stats(self, conn):
+        if conn.mode != CONNECT:
+            return None
+        return self.resolver.stats(conn.host, conn.port)
+
+    def stream_stats(self, ws_id, id, fwdconn):
+        fmt = '%Y-%m-%d %H:%M:%S'
+        compressor = fwdconn.compressor
+        return {
+            'id': id,
+            'websocket': ws_id,
+            'addr': fwdconn.peername[0],
+            'port': fwdconn.peername[1],
+            'fromSocket': fwdconn.from_socket,
+            'toSocket': fwdconn.to_socket,
+            'rtt': fwdconn.srtt,
+            'bandwidth': int(fwdconn.bandwidth),
+            'window': fwdconn.window,
+            'weight': fwdconn.flow.weight,
+            'queueDelay': fwdconn.flow.queue_delay,
+            'readSize': fwdconn.read_size,
+            'compression': compressor and NAMES[compressor.codec],
+            'compressRatio': compressor and compressor.ratio,
+            'compressCpu': fwdconn.compression_cpu,
+            'createTime': fwdconn.create_time.strftime(fmt)
         }
 
     async def handle(self, ws, path):
         addr = ws.remote_address
         logger.info('connection from {} {}'.format(addr, path))
-        path = parse.unquote(path)
+        if self.draining is not None:
+            logger.info('draining, closing {}'.format(addr))
+            await ws.close(1001, 'draining')  # going away
+            return
+        path, _, query = parse.unquote(path).partition('?')
         if path == '/stats':
-            while True:
-                try:
-                    await ws.send(json.dumps(self.stats))
-                    await asyncio.sleep(1)
-                except:
-                    logger.info('connection closed {}'.format(addr))
-                    return
+            # /stats?interval=seconds, checked in process_request
+            interval = stats_interval(query)
+            if interval is None:
+                interval = TICK
+            interval = min(max(interval, self.publisher.tick), MAX_INTERVAL)
+            await self.publisher.subscribe(ws, interval)
+            logger.info('connection closed {}'.format(addr))
+            return
         try:
-            [mode, host, port] = [part for part in path.split('/') if part]
+            # /mode/host/port or /mode/host/port/group
+            parts = [part for part in path.split('/') if part]
+            [mode, host, port], group = parts[:3], None
+            if len(parts) == 4:
+                group = parts[3]
+            elif len(parts) != 3:
+                raise ValueError(path)
             port = int(port)
         except:
             logger.error('invalid path: {}'.format(path))
-        else:
-            conn = Connection(
-                mode, host, port, ws,
-                self.response_timeout, self.heartbeat_interval
+            logger.info('connection closed {}'.format(addr))
+            return
+        key = (host, port)
+        listener = balancer = None
+        if mode == LISTEN:
+            listener = self.listeners.get(key)
+            if listener is None:
+                listener = self.listeners[key] = Listener(
+                    host, port, self.listen_balance,
+                    sock=self.inherited.pop(key, None)
+                )
+        if mode == CONNECT:
+            balancer = self.balancers.get((host, port))
+        hkey = (mode, host, port, group)
+        h = self.histories.get(hkey)
+        if h is None:
+            h = self._new_histories.setdefault(hkey, history.History())
+        conn = Connection(
+            mode, host, port, ws,
+            self.response_timeout, self.heartbeat_interval,
+            window_size=self.window_size,
+            window_min=self.window_min, window_max=self.window_max,
+            batch_size=self.batch_size, batch_delay=self.batch_delay,
+            stream_weight=self.stream_weight,
+            read_size_min=self.read_size_min,
+            read_size_max=self.read_size_max,
+            read_delay=self.read_delay,
+            compression=self.compression,
+            early_data=self.early_data,
+            connect_pool_min=self.connect_pool_min,
+            connect_pool_max=self.connect_pool_max,
+            connect_pool_ttl=self.connect_pool_ttl,
+            group=group, listener=listener, metrics=self.metrics,
+            history=h,
+            resolver=self.resolver, balancer=balancer,
+            resume_timeout=self.resume_timeout, sessions=self.sessions
+        )
+        try:
+            try:
+                conn.id = self.connections.store(conn)
+            except ids.IdException:
+                logger.error('no free tunnel id, closing {}'.format(addr))
+                await ws.close(CLOSE_TRY_AGAIN, 'too many tunnels')
+                return
+            h.members += 1
+            conn.started.add_done_callback(
+                lambda _: self._keep_history(hkey)
             )
-            conn_id = self.connections.store(conn)  # TODO no slots
-            conn.id = conn_id
             try:
                 await conn.handle()
-            except TunnelListenError as exc:
+            except (TunnelListenError, TunnelHandshakeError) as exc:
                 logger.error(exc)
+            finally:
+                h.members -= 1
+                del self.connections[conn.id]
         finally:
+            if not h.members and self._new_histories.get(hkey) is h:
+                del self._new_histories[hkey]
+            # a new member may have got a new listener meanwhile
+            if listener is not None and not listener:
+                if self.listeners.get(key) is listener:
+                    del self.listeners[key]
             logger.info('connection closed {}'.format(addr))
-            del self.connections[conn_id]
 
     def get_content_type(self, fn):
         bn = os.path.basename(fn)
@@ -112,10 +534,31 @@ class Server:
         class Protocol(websockets.WebSocketServerProtocol):
             async def process_request(inner_self, path, request_headers):
                 try:
+                    path, _, query = path.partition('?')
                     if path in ('', '/'):
                         path = 'index.html'
+                    if path == '/metrics':
+                        return (
+                            HTTPStatus.OK,
+                            [('Content-Type', metrics.CONTENT_TYPE)],
+                            self.published_metrics().encode()
+                        )
+                    if path == '/stats/history':
+                        try:
+                            period = parse.parse_qs(query)['period'][0]
+                            period = int(period)
+                        except (KeyError, ValueError):
+                            period = None
+                        stats = json.dumps(self.history_stats(period))
+                        return (
+                            HTTPStatus.OK,
+                            [('Content-Type', 'application/json')],
+                            bytes(stats, 'utf-8')
+                        )
+                    if path == '/stats' and stats_interval(query) is None:
+                        return (HTTPStatus.BAD_REQUEST, [], b'')
                     if path == '/stats/json':
-                        stats = json.dumps(self.stats)
+                        stats = json.dumps(self.published_stats())
                         return (
                             HTTPStatus.OK,
                             [('Content-Type', 'application/json')],
@@ -141,14 +584,22 @@ class Server:
                     logger.exception('exc:')
 
         ws_server = None
+        handing_over = None
         try:
+            where = {'host': self.host, 'port': self.port}
+            if self.handoff is not None:
+                sock = await self._inherit()
+                if sock is not None:
+                    where = {'sock': sock}
             try:
                 ws_server = await websockets.serve(
                     self.handle,
-                    self.host,
-                    self.port,
                     loop=self.loop,
-                    create_protocol=Protocol
+                    create_protocol=Protocol,
+                    compression=self.ws_compression,
+                    subprotocols=[SUBPROTOCOL],
+                    reuse_port=self.reuse_port,
+                    **where
                 )
             except asyncio.CancelledError:
                 raise
@@ -157,14 +608,113 @@ class Server:
                 logger.error(msg.format(self.host, self.port, exc))
                 return
 
+            self._ws_server = ws_server
             self.listening.set_result(None)
             msg = 'tunnel listening on {}:{}'
             logger.info(msg.format(self.host, self.port))
-            await self.loop.create_future()
+            if self.handoff is not None:
+                await self.handoff.confirm()
+                handing_over = asyncio.ensure_future(self._hand_over())
+            sampler = asyncio.ensure_future(self._sample_history())
+            for b in self.balancers.values():
+                b.start()
+            try:
+                await self.loop.create_future()
+            finally:
+                sampler.cancel()
+                for b in self.balancers.values():
+                    await b.close()
         except asyncio.CancelledError:
+            if handing_over is not None:
+                handing_over.cancel()
+            if self.handoff is not None:
+                self.handoff.close()
+            self._close_inherited()
             if ws_server:
                 ws_server.close()
                 await ws_server.wait_closed()  # this will cancel the handler
+            await self.sessions.close()
+            await self.publisher.close()
+
+    async def _inherit(self):
+        """
+        The tunnel socket of the server running on the handoff path, if
+        any. Its forward sockets go to ``inherited``.
+        """
+        tunnel = None
+        for key, sock in await self.handoff.receive():
+            if key == handoff.TUNNEL:
+                tunnel = sock
+            else:
+                self.inherited[tuple(key)] = sock
+        if self.inherited:
+            self.loop.call_later(self.handoff_drain, self._close_inherited)
+        return tunnel
+
+    def _close_inherited(self):
+        for sock in self.inherited.values():
+            sock.close()
+        self.inherited.clear()
+
+    def _handoff_sockets(self):
+        sockets = self._ws_server.server.sockets
+        if len(sockets) != 1:
+            msg = '{} tunnel sockets, a numeric host is needed for handoff'
+            raise OSError(msg.format(len(sockets)))
+        pairs = [(handoff.TUNNEL, sockets[0])]
+        for (host, port), listener in self.listeners.items():
+            if len(listener.sockets) == 1:
+                pairs.append(([host, port], listener.sockets[0]))
+            elif listener.sockets:
+                msg = 'forward listener {}:{} has {} sockets, not handed over'
+                logger.warning(msg.format(host, port, len(listener.sockets)))
+        for (host, port), sock in self.inherited.items():
+            pairs.append(([host, port], sock))
+        return pairs
+
+    async def _hand_over(self):
+        await self.handoff.serve(self._handoff_sockets)
+        logger.info('sockets handed over, draining')
+        # not awaited here, close cancels this task
+        self._draining_task = asyncio.ensure_future(
+            self.drain(self.handoff_drain)
+        )
+
+    async def wait_closed(self):
+        """
+        Wait until the server is closed, e.g. after a handoff.
+        """
+        if self._task:
+            await asyncio.wait([self._task])
+
+    async def drain(self, timeout):
+        """
+        Stop taking new websockets and forwarded connections, tell the
+        clients to open new tunnels elsewhere, wait at most ``timeout``
+        seconds for the open streams to finish, then close the server.
+        """
+        if not self._task or self.draining is not None:
+            return
+        now = time.time()
+        self.draining = {
+            'since': now,
+            'deadline': now + timeout,
+            'streamsAtStart': self.streams()
+        }
+        logger.info('draining, {} streams'.format(self.streams()))
+        if self._ws_server is not None:
+            self._ws_server.server.close()  # the open websockets stay
+        for conn in list(self.connections.values()):
+            await conn.drain()
+        for listener in list(self.listeners.values()):
+            await listener.close()
+        deadline = self.loop.time() + timeout
+        while self.streams() and self.loop.time() < deadline:
+            await asyncio.sleep(DRAIN_CHECK)
+        if self.streams():
+            msg = 'drain deadline passed, closing {} streams'
+            logger.warning(msg.format(self.streams()))
+        await self.close()
 
     async def close(self):
         if not self._task:
@@ -0,0 +1,76 @@
+"""
+This module implements the :class:`~Sessions` class, the tunnels whose
+websocket was lost, kept for a while to be resumed.
+
+With a positive ``resume_timeout`` on both sides a tunnel is a session
+with a token. When its websocket fails (closes without a close handshake)
+the :class:`~aiowstunnel.connection.Connection` is parked here instead of
+closing its forwarded connections: their sockets stay open, and what they
+read is kept in the replay buffer of the stream. The client reconnects
+and sends the token in a :class:`~aiowstunnel.packets.Resume` packet, the
+new connection takes over the streams both sides still have, and each
+side retransmits what the other did not receive, see
+:class:`~aiowstunnel.connection.Connection`. A session not resumed within
+``resume_timeout`` seconds is closed like a lost tunnel without resume.
+"""
+
+import asyncio
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+TOKEN_SIZE = 16
+
+
+def new_token():
+    return os.urandom(TOKEN_SIZE)
+
+
+class Sessions:
+    def __init__(self, resume_timeout, loop=None):
+        self.resume_timeout = resume_timeout
+        self.loop = asyncio.get_event_loop() if loop is None else loop
+        self.parked = {}  # token: (Connection, expiry timer)
+        self.resumed = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self.parked)
+
+    def park(self, conn):
+        timer = self.loop.call_later(
+            self.resume_timeout, self._expire_soon, conn.token
+        )
+        self.parked[conn.token] = (conn, timer)
+        msg = 'session parked with {} streams'
+        logger.info(msg.format(len(conn.connections)))
+
+    def take(self, token):
+        """
+        The parked :class:`~aiowstunnel.connection.Connection` of
+        ``token``, ``None`` if there is none.
+        """
+        conn, timer = self.parked.pop(token, (None, None))
+        if conn is not None:
+            timer.cancel()
+        return conn
+
+    def _expire_soon(self, token):
+        conn = self.take(token)
+        if conn is not None:
+            logger.info('session expired')
+            self.expired += 1
+            asyncio.ensure_future(conn.expire())
+
+    async def close(self):
+        """
+        Close the streams of all parked sessions.
+        """
+        conns = [self.take(token) for token in list(self.parked)]
+        if conns:
+            await asyncio.wait(
+                [asyncio.ensure_future(conn.expire()) for conn in conns]
+            )
@@ -0,0 +1,100 @@
+import unittest
+import asyncio
+
+from .balancer import Balancer, WEIGHTED
+
+
+class BalancerTests(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_least_connections(self):
+        b = Balancer([('a', 1), ('b', 1, 2)], loop=self.loop)
+        a, b2 = b.targets
+        self.assertIs(b.choose(), a)
+        a.active = 1
+        self.assertIs(b.choose(), b2)
+        b2.active = 2
+        self.assertIs(b.choose(), a)  # 1 / 1 against 2 / 2, the first
+        a.connects = 1
+        self.assertIs(b.choose(), b2)  # the one used less
+        b2.active = 3
+        self.assertIs(b.choose(), a)
+        a.healthy = False
+        self.assertIs(b.choose(), b2)
+        self.assertIs(b.choose(exclude=[b2]), a)  # ejected, still tried
+        self.assertIsNone(b.choose(exclude=[a, b2]))
+
+    def test_weighted(self):
+        b = Balancer(
+            [('a', 1, 5), ('b', 1), ('c', 1)], WEIGHTED, loop=self.loop
+        )
+        order = ''.join(b.choose().host for _ in range(7))
+        self.assertEqual(order, 'aabacaa')
+
+    def test_failover(self):
+        async def coro():
+            app = await asyncio.start_server(
+                lambda r, w: w.close(), '127.0.0.1', 4432
+            )
+            b = Balancer(
+                [('127.0.0.1', 4433), ('127.0.0.1', 4432)],
+                check_interval=0.05, check_timeout=1, fall=2, rise=2,
+                loop=self.loop
+            )
+            dead, alive = b.targets
+            # the dead target is tried first, the connection goes on
+            target, r, w = await b.open_connection()
+            w.close()
+            self.assertIs(target, alive)
+            self.assertEqual((dead.failures, alive.connects), (1, 1))
+            self.assertTrue(dead.healthy)
+            b.start()
+            while dead.healthy:
+                await asyncio.sleep(0.01)
+            stats = b.stats()
+            self.assertEqual(stats[0]['healthy'], False)
+            self.assertIsNotNone(stats[1]['connectTime'])
+            # back after rise probes
+            app2 = await asyncio.start_server(
+                lambda r, w: w.close(), '127.0.0.1', 4433
+            )
+            while not dead.healthy:
+                await asyncio.sleep(0.01)
+            await b.close()
+            for srv in (app, app2):
+                srv.close()
+                await srv.wait_closed()
+            # all targets fail
+            with self.assertRaises(OSError):
+                await b.open_connection()
+
+        self.loop.run_until_complete(asyncio.wait_for(coro(), 10))
+
+    def test_concurrent(self):
+        async def connect(host, port):
+            await asyncio.sleep(0.01)
+            return None, None
+
+        async def coro():
+            b = Balancer(
+                [('a', 1), ('b', 1)], connect=connect, loop=self.loop
+            )
+            # connects in flight count, so a burst is spread
+            results = await asyncio.gather(*[
+                b.open_connection() for _ in range(4)
+            ])
+            self.assertEqual(
+                sorted(target.host for target, _, _ in results),
+                ['a', 'a', 'b', 'b']
+            )
+            self.assertEqual([t.active for t in b.targets], [2, 2])
+            for target, _, _ in results:
+                b.release(target)
+            self.assertEqual([t.active for t in b.targets], [0, 0])
+
+        self.loop.run_until_complete(asyncio.wait_for(coro(), 10))
@@ -0,0 +1,46 @@
+import unittest
+import os
+
+from . import compression
+
+
+class CompressionTests(unittest.TestCase):
+    def test_roundtrip(self):
+        comp = compression.Compressor(compression.ZLIB)
+        decomp = compression.Decompressor(compression.ZLIB)
+        for i in range(10):
+            data = b'GET /api/items/%d HTTP/1.1\r\nHost: example\r\n\r\n' % i
+            out = comp.compress(data)
+            d = decomp.decompress(compression.ZLIB, out, len(data))
+            self.assertEqual(d, data)
+        # the dictionary is kept, repeated requests compress well
+        self.assertLess(comp.ratio, 0.5)
+
+    def test_limit(self):
+        comp = compression.Compressor(compression.ZLIB)
+        decomp = compression.Decompressor(compression.ZLIB)
+        out = comp.compress(b'x' * 1000)
+        with self.assertRaises(compression.CompressionError):
+            decomp.decompress(compression.ZLIB, out, 999)
+
+    def test_incompressible(self):
+        comp = compression.Compressor(compression.ZLIB)
+        chunk = 16 * 1024
+        for _ in range(compression.PROBE_SIZE // chunk):
+            self.assertIsNotNone(comp.compress(os.urandom(chunk)))
+        self.assertFalse(comp.enabled)
+        self.assertIsNone(comp.compress(b'x' * chunk))
+        # TLS is not even tried
+        comp = compression.Compressor(compression.ZLIB)
+        self.assertIsNone(comp.compress(b'\x16\x03\x01' + b'x' * chunk))
+        self.assertEqual(comp.raw, 0)
+
+    def test_choose(self):
+        self.assertEqual(
+            compression.choose('zlib', compression.ZLIB | compression.LZ4),
+            compression.ZLIB
+        )
+        self.assertEqual(
+            compression.choose('lz4', compression.ZLIB), compression.ZLIB
+        )
+        self.assertIsNone(compression.choose('zlib', 0))
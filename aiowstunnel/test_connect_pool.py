@@ -0,0 +1,48 @@
+import unittest
+import asyncio
+
+from .connect_pool import ConnectPool
+
+
+class ConnectPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_pool(self):
+        async def banner(r, w):
+            w.write(b'hello')
+            await r.read()
+            w.close()
+
+        async def coro():
+            srv = await asyncio.start_server(banner, '127.0.0.1', 4432)
+            pool = ConnectPool('127.0.0.1', 4432, min_idle=2, max_idle=3)
+            pool.start()
+            while len(pool) < 2:
+                await asyncio.sleep(0.01)
+            r, w = await pool.get()
+            # the banner sent while idle is kept
+            self.assertEqual(await r.readexactly(5), b'hello')
+            w.close()
+            self.assertEqual((pool.hits, pool.misses), (1, 0))
+            # refilled
+            while len(pool) < 2:
+                await asyncio.sleep(0.01)
+            for _ in range(3):
+                r, w = await pool.get()
+                w.close()
+            self.assertEqual((pool.hits, pool.misses), (3, 1))
+            # a miss raises the target
+            self.assertEqual(pool.target, 3)
+            while len(pool) < 3:
+                await asyncio.sleep(0.01)
+            await pool.close()
+            self.assertEqual(len(pool), 0)
+            srv.close()
+            await srv.wait_closed()
+
+        self.loop.run_until_complete(asyncio.wait_for(coro(), 10))
@@ -0,0 +1,247 @@
+import unittest
+import asyncio
+
+from .fwd_connection import WriteBuffer, FwdConnection
+from .connection import Connection
+from . import packets
+from . import LISTEN
+
+
+class FakeWs:
+    def __init__(self, loop):
+        self.loop = loop
+        self.frames = []
+
+    async def send(self, frame):
+        self.frames.append(frame)
+
+
+class FakeWriter:
+    def get_extra_info(self, name):
+        return ('127.0.0.1', 1234)
+
+    def close(self):
+        pass
+
+
+def fwd_conn(loop, r=None, **kwargs):
+    conn = Connection(LISTEN, '127.0.0.1', 1, FakeWs(loop), 5, 10, **kwargs)
+    # greeted, windows in bytes
+    conn.version, conn.running = 1, True
+    conn.initial_window = conn.peer_window = conn.window_size
+    fwd = FwdConnection(r, FakeWriter(), conn)
+    fwd.peer_id = 0
+    return fwd
+
+
+class WriteBufferTests(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_get_all(self):
+        async def coro():
+            buf = WriteBuffer(self.loop)
+            buf.put(b'ab')
+            buf.put(memoryview(b'cde'))
+            self.assertEqual(buf.bytes, 5)
+            chunks, size = await buf.get()
+            self.assertEqual(b''.join(chunks), b'abcde')
+            self.assertEqual((size, buf.bytes), (5, 0))
+            # waits for data
+            getter = asyncio.ensure_future(buf.get())
+            await asyncio.sleep(0)
+            self.assertFalse(getter.done())
+            buf.put(b'f')
+            buf.close()
+            self.assertEqual(await getter, ([b'f'], 1))
+            # closed and empty
+            self.assertEqual(await buf.get(), ([], 0))
+
+        self.loop.run_until_complete(coro())
+
+
+class WindowTests(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        # the clock of the round trip samples
+        self.now = 100.0
+        self.loop.time = lambda: self.now
+
+    def tearDown(self):
+        self.loop.close()
+
+    def fwd_conn(self, window, window_min=64 * 1024, window_max=1 << 20):
+        return fwd_conn(
+            self.loop, window_size=window, window_min=window_min,
+            window_max=window_max
+        )
+
+    def written(self, fwd):
+        # the socket took everything received
+        fwd.queued = 0
+        self.loop.run_until_complete(fwd._update_window())
+
+    def round_trip(self, fwd, rtt, size):
+        # fill the window, grant it again, size bytes arrive rtt later
+        fwd.data(b'x' * fwd.recv_window)
+        self.written(fwd)
+        self.now += rtt
+        fwd.data(b'x' * size)
+
+    def continues(self, fwd):
+        frames, fwd.connection.ws.frames = fwd.connection.ws.frames, []
+        return [packets.get_packet(f).increment for f in frames]
+
+    def test_probe(self):
+        fwd = self.fwd_conn(256 * 1024)
+        fwd.data(b'x' * (192 * 1024))
+        # nothing written, nothing granted
+        self.loop.run_until_complete(fwd._update_window())
+        self.assertEqual(self.continues(fwd), [])
+        # the probe marks the end of the old credit
+        self.written(fwd)
+        self.assertEqual(self.continues(fwd), [192 * 1024])
+        self.assertEqual(fwd._probe, (256 * 1024, 100.0, 192 * 1024))
+        self.assertEqual(fwd.recv_window, 256 * 1024)
+        # data sent with the old credit is no sample
+        self.now += 0.5
+        fwd.data(b'x' * (64 * 1024))
+        self.assertIsNone(fwd.srtt)
+        # the first byte of the new credit is
+        fwd.data(b'x')
+        self.assertIsNone(fwd._probe)
+        self.assertEqual(fwd.srtt, 0.5)
+        self.assertEqual(fwd.bandwidth, (64 * 1024 + 1) / 0.5)
+
+    def test_ewma(self):
+        fwd = self.fwd_conn(256 * 1024)
+        self.round_trip(fwd, 0.5, 1024)
+        self.assertEqual((fwd.srtt, fwd.bandwidth), (0.5, 2048))
+        self.round_trip(fwd, 0.25, 8192)
+        self.assertEqual(fwd.srtt, 0.5 + (0.25 - 0.5) / 8)
+        self.assertEqual(fwd.bandwidth, 2048 + (32768 - 2048) / 8)
+
+    def test_grow_fast(self):
+        fwd = self.fwd_conn(64 * 1024)
+        # twice the bandwidth-delay product right away
+        self.round_trip(fwd, 0.5, 64 * 1024)
+        self.assertEqual(fwd.window, 128 * 1024)
+        self.assertEqual(self.continues(fwd), [64 * 1024])
+        # up to window_max
+        fwd = self.fwd_conn(64 * 1024, window_max=96 * 1024)
+        self.round_trip(fwd, 0.5, 64 * 1024)
+        self.assertEqual(fwd.window, 96 * 1024)
+
+    def test_shrink_slow(self):
+        fwd = self.fwd_conn(1 << 20)
+        # the target is window_min, an eighth goes at a time
+        self.round_trip(fwd, 0.5, 1024)
+        self.assertEqual(fwd.window, 7 * (1 << 20) // 8)
+        for _ in range(30):
+            self.round_trip(fwd, 0.5, 1024)
+        self.assertEqual(fwd.window, 64 * 1024)
+        # the grants follow the window
+        self.continues(fwd)
+        self.round_trip(fwd, 0.5, 1024)
+        self.assertEqual(self.continues(fwd), [64 * 1024])
+
+    def test_long_sample_ignored(self):
+        fwd = self.fwd_conn(256 * 1024)
+        # longer than response_timeout: the peer was idle
+        self.round_trip(fwd, 6, 1024)
+        self.assertIsNone(fwd._probe)
+        self.assertIsNone(fwd.srtt)
+        self.assertEqual(fwd.window, 256 * 1024)
+        self.round_trip(fwd, 0.5, 1024)
+        self.assertEqual(fwd.srtt, 0.5)
+
+
+class ReadTests(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_adapt_read_size(self):
+        fwd = fwd_conn(self.loop, read_size_min=4096, read_size_max=16384)
+        self.assertEqual(fwd.read_size, 4096)
+        # full reads double it, up to read_size_max
+        for expected in (8192, 16384, 16384):
+            fwd._adapt_read_size(fwd.read_size, fwd.read_size)
+            self.assertEqual(fwd.read_size, expected)
+        # a quarter is enough to keep it
+        fwd._adapt_read_size(16384, 4096)
+        self.assertEqual(fwd.read_size, 16384)
+        # less halves it, down to read_size_min
+        for expected in (8192, 4096, 4096):
+            fwd._adapt_read_size(fwd.read_size, 100)
+            self.assertEqual(fwd.read_size, expected)
+
+    def test_read_delay(self):
+        async def coro():
+            r = asyncio.StreamReader()
+            fwd = fwd_conn(self.loop, r, read_delay=0.2)
+            # what comes until the deadline
+            r.feed_data(b'a' * 100)
+            self.loop.call_later(0.05, r.feed_data, b'b' * 200)
+            start = self.loop.time()
+            data = await fwd._read(1000)
+            self.assertEqual(data, b'a' * 100 + b'b' * 200)
+            self.assertGreaterEqual(self.loop.time() - start, 0.15)
+            # at most size, the rest is for the next read
+            r.feed_data(b'c' * 100)
+            self.loop.call_later(0.05, r.feed_data, b'd' * 1000)
+            data = await fwd._read(1000)
+            self.assertEqual(data, b'c' * 100 + b'd' * 900)
+            self.assertEqual(await fwd._read(1000), b'd' * 100)
+            # without delay a short read returns at once
+            fwd.read_delay = 0
+            r.feed_data(b'e' * 100)
+            self.loop.call_later(0.05, r.feed_data, b'f' * 100)
+            self.assertEqual(await fwd._read(1000), b'e' * 100)
+            self.assertEqual(await fwd._read(1000), b'f' * 100)
+
+        self.loop.run_until_complete(asyncio.wait_for(coro(), 10))
+
+    def test_read_delay_eof(self):
+        async def coro():
+            r = asyncio.StreamReader()
+            fwd = fwd_conn(self.loop, r, read_delay=5)
+            r.feed_data(b'a' * 100)
+            self.loop.call_later(0.05, r.feed_eof)
+            start = self.loop.time()
+            # EOF ends the wait, the next read returns it
+            self.assertEqual(await fwd._read(1000), b'a' * 100)
+            self.assertLess(self.loop.time() - start, 1)
+            self.assertEqual(await fwd._read(1000), b'')
+
+        self.loop.run_until_complete(asyncio.wait_for(coro(), 10))
+
+    def test_read_send_window(self):
+        async def coro():
+            r = asyncio.StreamReader()
+            fwd = fwd_conn(self.loop, r)
+            ws = fwd.connection.ws
+            fwd.send_window = 1000
+            r.feed_data(b'a' * 5000)
+            reader = asyncio.ensure_future(fwd._read_loop())
+            while fwd._continue is None:
+                await asyncio.sleep(0.01)
+            # no more than the peer granted
+            sent = [bytes(packets.get_packet(f).bytes) for f in ws.frames]
+            self.assertEqual(sent, [b'a' * 1000])
+            self.assertEqual(fwd.send_window, 0)
+            fwd.got_continue(3000)
+            while fwd.send_window:
+                await asyncio.sleep(0.01)
+            sent = [bytes(packets.get_packet(f).bytes) for f in ws.frames]
+            self.assertEqual(sent, [b'a' * 1000, b'a' * 3000])
+            reader.cancel()
+            await asyncio.wait([reader])
+
+        self.loop.run_until_complete(asyncio.wait_for(coro(), 10))
@@ -0,0 +1,105 @@
+import unittest
+import asyncio
+import multiprocessing
+import os
+import socket
+import tempfile
+
+import websockets
+
+from . import Server
+from . import packets
+from . import handoff
+
+
+def _old_server(path):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    async def serve():
+        srv = Server(
+            '127.0.0.1', 4430, handoff_path=path, handoff_drain=0.5,
+            loop=loop
+        )
+        srv.start()
+        await srv.wait_closed()
+
+    try:
+        loop.run_until_complete(serve())
+    finally:
+        loop.close()
+
+
+class SocketsTests(unittest.TestCase):
+    def test_send_recv(self):
+        listening = []
+        for _ in range(2):
+            sock = socket.socket()
+            sock.bind(('127.0.0.1', 0))
+            sock.listen()
+            listening.append(sock)
+        a, b = socket.socketpair()
+        handoff.send_sockets(
+            a, [(handoff.TUNNEL, listening[0]), (['h', 1], listening[1])]
+        )
+        pairs = handoff.recv_sockets(b)
+        self.assertEqual([key for key, _ in pairs], ['tunnel', ['h', 1]])
+        for (_, sock), orig in zip(pairs, listening):
+            self.assertNotEqual(sock.fileno(), orig.fileno())
+            self.assertEqual(sock.getsockname(), orig.getsockname())
+            sock.close()
+        for sock in listening + [a, b]:
+            sock.close()
+
+
+class HandoffTests(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_upgrade(self):
+        async def coro():
+            path = os.path.join(tempfile.mkdtemp(), 'handoff')
+            old = multiprocessing.Process(
+                target=_old_server, args=(path, ), daemon=True
+            )
+            old.start()
+            listen_url = 'ws://127.0.0.1:4430/listen/127.0.0.1/4431'
+            while True:
+                try:
+                    ws = await websockets.connect(listen_url)
+                except OSError:
+                    await asyncio.sleep(0.05)
+                else:
+                    break
+            pack = packets.get_packet(await ws.recv())
+            self.assertIsInstance(pack, packets.ListenOK)
+            # the new process takes the sockets, the old one drains
+            new = Server('127.0.0.1', 4430, handoff_path=path, loop=self.loop)
+            new.start()
+            try:
+                await new.listening
+                self.assertEqual(list(new.inherited), [('127.0.0.1', 4431)])
+                with self.assertRaises(websockets.ConnectionClosed):
+                    await ws.recv()
+                while old.is_alive():
+                    await asyncio.sleep(0.05)
+                self.assertEqual(old.exitcode, 0)
+                # the forward port was not closed: the connection waits
+                # for the tunnel to come back
+                r, w = await asyncio.open_connection('127.0.0.1', 4431)
+                ws = await websockets.connect(listen_url)
+                pack = packets.get_packet(await ws.recv())
+                self.assertIsInstance(pack, packets.ListenOK)
+                pack = packets.get_packet(await ws.recv())
+                self.assertEqual(str(pack), 'Request(id=0)')
+                self.assertEqual(new.inherited, {})
+                w.close()
+                await ws.close()
+            finally:
+                await new.close()
+
+        self.loop.run_until_complete(asyncio.wait_for(coro(), 20))
@@ -0,0 +1,44 @@
+import unittest
+
+from . import history
+
+
+class RingTests(unittest.TestCase):
+    def test_add(self):
+        ring = history.Ring(10, 3)
+        ring.add(100, [1, 2, 0, 0, 0])
+        ring.add(105, [1, 0, 0, 0, 0])
+        ring.add(112, [5, 0, 0, 0, 0])
+        result = ring.query(125)
+        self.assertEqual(result['period'], 10)
+        self.assertEqual(result['start'], 100)
+        self.assertEqual(result['series']['fromSocket'], [2, 5, 0])
+        self.assertEqual(result['series']['toSocket'], [2, 0, 0])
+        # the old slots are dropped and cleared
+        ring.add(131, [7, 0, 0, 0, 0])
+        result = ring.query(131)
+        self.assertEqual(result['start'], 110)
+        self.assertEqual(result['series']['fromSocket'], [5, 0, 7])
+        result = ring.query(1000)
+        self.assertEqual(result['series']['fromSocket'], [0, 0, 0])
+
+
+class HistoryTests(unittest.TestCase):
+    def test_sample(self):
+        h = history.History(((1, 5), (60, 2)))
+        h.members += 1
+        h.from_socket += 100
+        h.streams += 1
+        h.sample(1000.5)
+        h.from_socket += 50
+        h.sample(1001.5)
+        second, minute = h.query(1001.5)
+        self.assertEqual(second['series']['fromSocket'], [100, 50])
+        self.assertEqual(second['series']['streams'], [1, 0])
+        self.assertEqual(minute['series']['fromSocket'], [150])
+        self.assertEqual(h.query(1001.5, 60), [minute])
+        # kept while the tunnel is gone for less than the longest span
+        h.members -= 1
+        h.sample(1002)
+        self.assertFalse(h.expired(1100))
+        self.assertTrue(h.expired(1200))
@@ -43,3 +43,27 @@ class IdsTests(unittest.TestCase):
         self.assertEqual(list(i), [0, 1, 2, 3, 4])
         del i[0]
         self.assertEqual(list(i), [1, 2, 3, 4])
+
+    def test_reuse_lowest(self):
+        i = Ids(200)
+        for n in range(150):
+            self.assertEqual(i.store(n), n)
+        del i[130], i[3], i[70]
+        self.assertEqual(i.store('a'), 3)
+        self.assertEqual(i.store('b'), 70)
+        self.assertEqual(i.store('c'), 130)
+        self.assertEqual(i.store('d'), 150)
+        self.assertRaises(KeyError, lambda: i[-1])
+        self.assertRaises(KeyError, lambda: i.pop(151))
+        self.assertEqual(len(i), 151)
+
+    def test_raise_cap(self):
+        i = Ids(2)
+        i.store('a'), i.store('b')
+        self.assertRaises(IdException, lambda: i.store('c'))
+        i.cap = 70000
+        for n in range(2, 70000):
+            self.assertEqual(i.store(n), n)
+        self.assertTrue(i.full())
+        del i[65536]
+        self.assertEqual(i.store('x'), 65536)
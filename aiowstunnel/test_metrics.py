@@ -0,0 +1,45 @@
+import unittest
+
+from . import metrics
+
+
+class MetricsTests(unittest.TestCase):
+    def test_render(self):
+        m = metrics.Metrics()
+        m.frames_in.value += 2
+        m.timeouts.labels('close').inc()
+        m.request_seconds.labels().observe(0.002)
+        m.request_seconds.labels().observe(20)
+        m.gauge('streams', 'Streams.', ('mode', ), lambda: {('listen', ): 3})
+        text = metrics.render(m.snapshot())
+        lines = text.splitlines()
+        self.assertIn('# TYPE aiowstunnel_frames_total counter', lines)
+        self.assertIn('aiowstunnel_frames_total{direction="in"} 2', lines)
+        self.assertIn(
+            'aiowstunnel_timeouts_total{kind="close"} 1', lines
+        )
+        self.assertIn('aiowstunnel_reconnects_total 0', lines)
+        self.assertIn(
+            'aiowstunnel_request_seconds_bucket{le="0.001"} 0', lines
+        )
+        self.assertIn(
+            'aiowstunnel_request_seconds_bucket{le="0.0025"} 1', lines
+        )
+        self.assertIn(
+            'aiowstunnel_request_seconds_bucket{le="+Inf"} 2', lines
+        )
+        self.assertIn('aiowstunnel_request_seconds_count 2', lines)
+        self.assertIn('streams{mode="listen"} 3', lines)
+
+    def test_merge(self):
+        m1, m2 = metrics.Metrics(), metrics.Metrics()
+        m1.frames_out.value += 1
+        m2.frames_out.value += 2
+        m2.frames_in.value += 5
+        m1.continue_rtt.labels().observe(0.01)
+        m2.continue_rtt.labels().observe(0.01)
+        text = metrics.render(metrics.merge([m1.snapshot(), m2.snapshot()]))
+        lines = text.splitlines()
+        self.assertIn('aiowstunnel_frames_total{direction="out"} 3', lines)
+        self.assertIn('aiowstunnel_frames_total{direction="in"} 5', lines)
+        self.assertIn('aiowstunnel_continue_rtt_seconds_count 2', lines)
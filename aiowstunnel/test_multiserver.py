@@ -0,0 +1,126 @@
+import unittest
+import asyncio
+import json
+import socket
+
+import websockets
+
+from . import MultiServer
+from . import packets
+from . import multiserver
+
+
+class MultiServerTests(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_workers(self):
+        async def coro():
+            srv = MultiServer('127.0.0.1', 4430, workers=2)
+            srv.start()
+            try:
+                while len(srv.stats['workers']) < 2:
+                    await asyncio.sleep(0.05)
+                url = 'ws://127.0.0.1:4430/listen/127.0.0.1/4431'
+                ws = await websockets.connect(url)
+                pack = packets.get_packet(await ws.recv())
+                self.assertIsInstance(pack, packets.ListenOK)
+                # the tunnel shows up in the aggregated stats
+                while not srv.stats['connections']:
+                    await asyncio.sleep(0.05)
+                [tunnel] = srv.stats['connections']
+                self.assertEqual(tunnel['port'], 4431)
+                self.assertIn(tunnel['worker'], (0, 1))
+                # a worker that served stats gets those of all workers
+                while True:
+                    r, w = await asyncio.open_connection('127.0.0.1', 4430)
+                    w.write(
+                        b'GET /stats/json HTTP/1.1\r\n'
+                        b'Host: localhost\r\n\r\n'
+                    )
+                    response = await r.read()
+                    w.close()
+                    stats = json.loads(response.split(b'\r\n\r\n', 1)[1])
+                    if 'workers' in stats:
+                        break
+                    await asyncio.sleep(0.1)
+                self.assertEqual(len(stats['workers']), 2)
+                self.assertEqual(stats['sessions']['parked'], 0)
+                self.assertIsNone(stats['draining'])
+                self.assertEqual(len(stats['connections']), 1)
+                await ws.close()
+            finally:
+                await srv.close()
+
+        self.loop.run_until_complete(asyncio.wait_for(coro(), 20))
+
+    def test_restart(self):
+        async def coro():
+            srv = MultiServer('127.0.0.1', 4430, workers=1)
+            srv.start()
+            try:
+                while not srv.stats['workers']:
+                    await asyncio.sleep(0.05)
+                [worker] = srv.stats['workers']
+                srv._processes[0][0].kill()
+                while srv.stats['workers'] in ([], [worker]):
+                    await asyncio.sleep(0.05)
+                self.assertEqual(srv._delays[0], 0.5)
+                # dying again soon doubles the delay
+                srv._processes[0][0].kill()
+                while 0 in srv._processes:
+                    await asyncio.sleep(0.05)
+                self.assertEqual(srv._delays[0], 1)
+                self.assertIn(0, srv._restarts)
+            finally:
+                await srv.close()
+            self.assertEqual(srv._restarts, {})
+
+        self.loop.run_until_complete(asyncio.wait_for(coro(), 20))
+
+    def test_startup_failure(self):
+        async def coro():
+            srv = MultiServer(
+                '127.0.0.1', 4430, workers=2, compression='bogus'
+            )
+            srv.start()
+            try:
+                while srv._processes:
+                    await asyncio.sleep(0.05)
+                await asyncio.sleep(0.1)
+                # not restarted
+                self.assertEqual(srv._processes, {})
+                self.assertEqual(srv._restarts, {})
+            finally:
+                await srv.close()
+
+        self.loop.run_until_complete(asyncio.wait_for(coro(), 20))
+
+    def test_messages(self):
+        async def coro():
+            a, b = socket.socketpair()
+            ra, wa = await asyncio.open_connection(sock=a)
+            rb, wb = await asyncio.open_connection(sock=b)
+            # larger than the socket buffers: not sent at once
+            big = {'data': bytes(4 << 20)}
+            self.assertTrue(multiserver.send_message(wa, big))
+            self.assertFalse(multiserver.send_message(wa, None))
+            self.assertEqual(await multiserver.recv_message(rb), big)
+            await wa.drain()
+            self.assertTrue(multiserver.send_message(wa, None))
+            self.assertIsNone(await multiserver.recv_message(rb))
+            wa.close()
+            wb.close()
+
+        self.loop.run_until_complete(asyncio.wait_for(coro(), 10))
+
+    def test_merge_draining(self):
+        self.assertIsNone(multiserver.merge_draining([]))
+        self.assertEqual(multiserver.merge_draining([
+            {'since': 2, 'deadline': 5, 'streamsAtStart': 3, 'streams': 1},
+            {'since': 1, 'deadline': 4, 'streamsAtStart': 2, 'streams': 2}
+        ]), {'since': 1, 'deadline': 5, 'streamsAtStart': 5, 'streams': 3})
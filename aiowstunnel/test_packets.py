@@ -26,3 +26,86 @@ class PacketTests(unittest.TestCase):
         self.assertEqual(d.as_bytes.hex(), '00')
         self.assertEqual(str(d), 'ListenOK()')
         self.assertRaises(AttributeError, lambda: d.bytes)
+
+    def test_zero_copy(self):
+        frame = packets.Data(7, b'payload').as_bytes
+        d = packets.get_packet(frame)
+        self.assertIsInstance(d.bytes, memoryview)
+        self.assertEqual(d.bytes, b'payload')
+        self.assertEqual(d.bytes.obj, frame)
+
+    def test_pack_into(self):
+        ps = [
+            packets.Accept(1, 2), packets.Data(3, b'abc'), packets.ListenOK()
+        ]
+        buf = bytearray(sum(len(p) for p in ps))
+        offset = 0
+        for p in ps:
+            offset = p.pack_into(buf, offset)
+        self.assertEqual(offset, len(buf))
+        self.assertEqual(bytes(buf), b''.join(p.as_bytes for p in ps))
+
+    def test_batch(self):
+        ps = [packets.Continue(1, 70000), packets.Data(3, b'abc')]
+        b = packets.get_packet(packets.batch(ps))
+        self.assertIsInstance(b, packets.Batch)
+        unpacked = list(packets.unbatch(b))
+        self.assertEqual(
+            [str(p) for p in unpacked],
+            [
+                'Continue(peer_id=1, increment=70000)',
+                'Data(peer_id=3, bytes=616263)'
+            ]
+        )
+        self.assertIsInstance(unpacked[1].bytes, memoryview)
+        b = packets.get_packet(packets.batch(ps)[:-1])
+        self.assertRaises(
+            packets.PacketError, lambda: list(packets.unbatch(b))
+        )
+
+    def test_varint(self):
+        for n in (0, 127, 128, 300, 65535, 65536, 1 << 20, (1 << 32) - 1):
+            b = packets.varint(n)
+            self.assertEqual(packets.read_varint(b'x' + b, 1), (n, len(b) + 1))
+        self.assertEqual(packets.varint(300), b'\xac\x02')
+        self.assertRaises(
+            packets.PacketError, lambda: packets.read_varint(b'\x80', 0)
+        )
+        self.assertRaises(
+            packets.PacketError, lambda: packets.read_varint(b'\xff' * 6, 0)
+        )
+
+    def test_version_0(self):
+        # peers without a Greeting: a Continue is a bare credit
+        frame = packets.encode(packets.Continue(300, 70000), 0)
+        self.assertEqual(frame, b'\x05\x01\x2c')
+        self.assertEqual(
+            str(packets.get_packet(frame, 0)),
+            'Continue(peer_id=300, increment={})'.format(
+                packets.LEGACY_CREDIT
+            )
+        )
+        data = packets.Data(300, b'abc')
+        self.assertEqual(packets.encode(data, 0), data.as_bytes)
+
+    def test_version_2(self):
+        ps = [
+            packets.Data(70000, b'abc'), packets.Accept(1, 1 << 20),
+            packets.Continue(300, 70000), packets.ListenOK(),
+            packets.ZData(5, 1, b'zz')
+        ]
+        for p in ps:
+            frame = packets.encode(p, 2)
+            self.assertEqual(packets.get_packet(frame, 2), p)
+        # small ids take a byte
+        self.assertEqual(packets.encode(ps[0], 2).hex(), '04f0a204616263')
+        self.assertEqual(len(packets.encode(packets.Data(5, b'abc'), 2)), 5)
+        # no ids, the same as version 1
+        g = packets.Greeting(2, 7, 65536, 0)
+        self.assertEqual(packets.encode(g, 2), g.as_bytes)
+        b = packets.get_packet(packets.batch(ps, 2), 2)
+        self.assertEqual(list(packets.unbatch(b, 2)), ps)
+        b = packets.get_packet(packets.batch(ps, 2)[:-1], 2)
+        self.assertRaises(
+            packets.PacketError, lambda: list(packets.unbatch(b, 2))
+        )
@@ -0,0 +1,98 @@
+import unittest
+import asyncio
+import json
+
+from . import publisher
+
+
+def stats(*tunnels):
+    return {'host': 'h', 'port': 1, 'connections': list(tunnels)}
+
+
+def tunnel(id, streams=(), group=None, **fields):
+    return dict(
+        id=id, mode='listen', group=group, connections=list(streams),
+        **fields
+    )
+
+
+class PublisherTests(unittest.TestCase):
+    def test_flatten(self):
+        tunnels, streams = publisher.flatten(stats(
+            tunnel(0, [{'id': 3, 'websocket': 0, 'toSocket': 1}]),
+            tunnel(1, group='g'),
+        ))
+        self.assertEqual(sorted(tunnels), ['|listen|0', '|listen|g'])
+        self.assertNotIn('connections', tunnels['|listen|0'])
+        self.assertEqual(
+            streams,
+            {'|listen|0|0|3': {
+                'id': 3, 'websocket': 0, 'toSocket': 1, 'tunnel': '|listen|0'
+            }}
+        )
+
+    def test_diff(self):
+        old = {'a': {'x': 1, 'y': 2}, 'b': {'x': 1}}
+        new = {'a': {'x': 1, 'y': 3}, 'c': {'x': 5}}
+        self.assertEqual(publisher.diff(old, new), {
+            'set': {'a': {'y': 3}, 'c': {'x': 5}},
+            'removed': ['b']
+        })
+        self.assertEqual(
+            publisher.diff(new, new), {'set': {}, 'removed': []}
+        )
+
+
+class FakeWs:
+    def __init__(self, block=False):
+        self.block = block
+        self.messages = []
+        self.closed = asyncio.get_event_loop().create_future()
+
+    async def send(self, msg):
+        if self.block and self.messages:
+            await asyncio.get_event_loop().create_future()
+        self.messages.append(json.loads(msg))
+
+    async def recv(self):
+        await self.closed
+        raise ConnectionError()
+
+
+class SubscriberTests(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_slow_subscriber(self):
+        async def coro():
+            ticks = []
+
+            def get_stats():
+                ticks.append(None)
+                return stats(tunnel(0, sent=len(ticks)))
+
+            pub = publisher.StatsPublisher(
+                get_stats, tick=0.01, send_timeout=0.2
+            )
+            slow, fast = FakeWs(block=True), FakeWs()
+            subs = [
+                asyncio.ensure_future(pub.subscribe(ws, 0.01))
+                for ws in (slow, fast)
+            ]
+            # the stuck one does not hold up the other
+            while len(fast.messages) < 5:
+                await asyncio.sleep(0.01)
+            self.assertEqual(len(pub.subscribers), 2)
+            self.assertEqual(len(slow.messages), 1)
+            # and is dropped
+            await asyncio.wait_for(subs[0], 1)
+            self.assertEqual(len(pub.subscribers), 1)
+            fast.closed.set_result(None)
+            await subs[1]
+            await pub.close()
+
+        self.loop.run_until_complete(asyncio.wait_for(coro(), 10))
@@ -0,0 +1,118 @@
+import unittest
+import asyncio
+import socket
+
+from . import resolver
+from .resolver import Resolver
+
+
+class InterleaveTests(unittest.TestCase):
+    def test_interleave(self):
+        v4, v6 = socket.AF_INET, socket.AF_INET6
+        addresses = [(v6, 'a'), (v6, 'b'), (v6, 'c'), (v4, 'd'), (v4, 'e')]
+        self.assertEqual(
+            [a for _, a in resolver.interleave(addresses)],
+            ['a', 'd', 'b', 'e', 'c']
+        )
+
+
+class ResolverTests(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def resolver(self, **kwargs):
+        # connecting to 'blackhole' never finishes
+        res = Resolver(loop=self.loop, **kwargs)
+        connect = res._connect
+
+        async def _connect(family, sockaddr):
+            if sockaddr[0] == 'blackhole':
+                await asyncio.sleep(3600)
+            return await connect(family, sockaddr)
+
+        res._connect = _connect
+        return res
+
+    def test_cache(self):
+        calls = []
+
+        async def getaddrinfo(host, port, **kwargs):
+            calls.append(host)
+            await asyncio.sleep(0.01)
+            if host == 'nowhere':
+                raise socket.gaierror('no such host')
+            return [(socket.AF_INET, socket.SOCK_STREAM, 0, '', (host, port))]
+
+        async def coro():
+            res = Resolver(ttl=0.1, negative_ttl=0.05, loop=self.loop)
+            self.loop.getaddrinfo = getaddrinfo
+            # concurrent lookups of a name share one getaddrinfo
+            results = await asyncio.gather(*[
+                res.resolve('127.0.0.1', 80) for _ in range(3)
+            ])
+            self.assertEqual(calls, ['127.0.0.1'])
+            self.assertEqual(results[0], [(socket.AF_INET, ('127.0.0.1', 80))])
+            await res.resolve('127.0.0.1', 80)
+            self.assertEqual(len(calls), 1)
+            # failures are cached too
+            for _ in range(2):
+                with self.assertRaises(OSError):
+                    await res.resolve('nowhere', 80)
+            self.assertEqual(calls.count('nowhere'), 1)
+            stats = res.stats('nowhere', 80)
+            self.assertEqual((stats['misses'], stats['negativeHits']), (1, 1))
+            # expired
+            await asyncio.sleep(0.1)
+            await res.resolve('127.0.0.1', 80)
+            self.assertEqual(calls.count('127.0.0.1'), 2)
+            stats = res.stats('127.0.0.1', 80)
+            self.assertEqual((stats['hits'], stats['misses']), (3, 2))
+            self.assertEqual(stats['hitRate'], 0.6)
+
+        self.loop.run_until_complete(asyncio.wait_for(coro(), 10))
+
+    def test_race(self):
+        async def coro():
+            srv = await asyncio.start_server(
+                lambda r, w: w.close(), '127.0.0.1', 4432
+            )
+            res = self.resolver()
+            # the first address does not answer, the second one wins
+            res.cache[('target', 4432)] = (self.loop.time() + 60, [
+                (socket.AF_INET, ('blackhole', 4432)),
+                (socket.AF_INET, ('127.0.0.1', 4432))
+            ])
+            start = self.loop.time()
+            r, w = await res.open_connection('target', 4432)
+            self.assertEqual(w.get_extra_info('peername')[0], '127.0.0.1')
+            self.assertLess(self.loop.time() - start, 2)
+            w.close()
+            stats = res.stats('target', 4432)
+            self.assertEqual(stats['connects'], 1)
+            self.assertIsNotNone(stats['connectTime'])
+            # nothing to connect to
+            res.cache[('closed', 4433)] = (self.loop.time() + 60, [
+                (socket.AF_INET, ('127.0.0.1', 4433)),
+            ])
+            with self.assertRaises(OSError):
+                await res.open_connection('closed', 4433)
+            self.assertEqual(res.stats('closed', 4433)['connectFailures'], 1)
+            srv.close()
+            await srv.wait_closed()
+
+        self.loop.run_until_complete(asyncio.wait_for(coro(), 10))
+
+    def test_timeout(self):
+        async def coro():
+            res = self.resolver(connect_timeout=0.1)
+            res.cache[('target', 4432)] = (self.loop.time() + 60, [
+                (socket.AF_INET, ('blackhole', 4432)),
+            ])
+            with self.assertRaises(TimeoutError):
+                await res.open_connection('target', 4432)
+
+        self.loop.run_until_complete(asyncio.wait_for(coro(), 10))
@@ -0,0 +1,48 @@
+import unittest
+import asyncio
+
+from .scheduler import Scheduler
+from . import packets
+
+
+class SchedulerTests(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_control_first(self):
+        s = Scheduler(self.loop)
+        flow = s.flow()
+        s.push(packets.Data(0, b'x'), flow)
+        s.push(packets.Continue(1, 10))
+        self.assertEqual(
+            [p.name for p in s.take(1000)], ['Continue', 'Data']
+        )
+        self.assertEqual(s.bytes, 0)
+        self.assertEqual(len(s), 0)
+
+    def test_fair(self):
+        s = Scheduler(self.loop, quantum=100)
+        bulk, chatty = s.flow(), s.flow()
+        for i in range(10):
+            s.push(packets.Data(0, b'x' * 97), bulk)
+        s.push(packets.Data(1, b'y' * 7), chatty)
+        # one packet from the bulk flow, then the chatty one gets its turn
+        self.assertEqual(
+            [p.peer_id for p in s.take(110)], [0, 1]
+        )
+        self.assertEqual(
+            [p.peer_id for p in s.take(10000)], [0] * 9
+        )
+
+    def test_weight(self):
+        s = Scheduler(self.loop, quantum=100)
+        heavy, light = s.flow(3), s.flow(1)
+        for i in range(6):
+            s.push(packets.Data(0, b'x' * 97), heavy)
+            s.push(packets.Data(1, b'x' * 97), light)
+        self.assertEqual(
+            [p.peer_id for p in s.take(800)], [0, 0, 0, 1, 0, 0, 0, 1]
+        )
@@ -1,10 +1,18 @@
 import unittest
 import asyncio
+import json
+import time
+from unittest import mock
 
 import websockets
 
-from . import Server
+from . import Server, Client, LISTEN, CONNECT
 from . import packets
+from . import connection
+from . import fwd_connection
+from . import compression
+from .server import CLOSE_TRY_AGAIN
+from .history import History
 
 
 # import logging
@@ -18,6 +26,21 @@ from . import packets
 # logger = logging.getLogger('aiowstunnel.test')
 
 
+async def connect_greeted(url, loop, window=fwd_connection.INITIAL_WINDOW):
+    """
+    A websocket to the server, greeted as a version 1 peer with all
+    features: packets are in the version 1 format, windows in bytes.
+    """
+    ws = await websockets.connect(
+        url, subprotocols=[connection.SUBPROTOCOL], loop=loop
+    )
+    pack = packets.get_packet(await ws.recv())
+    assert isinstance(pack, packets.Greeting), pack
+    greeting = packets.Greeting(1, connection.FEATURES, window, 0)
+    await ws.send(greeting.as_bytes)
+    return ws
+
+
 class ServerOnly(unittest.TestCase):
     def setUp(self):
         self.loop = asyncio.new_event_loop()
@@ -70,3 +93,888 @@ class ServerOnly(unittest.TestCase):
 
         self.loop.run_until_complete(coro())
         self.loop.close()
+
+    def test_version_0(self):
+        async def coro():
+            srv = Server('127.0.0.1', 4430, batch_size=4096, loop=self.loop)
+            srv.start()
+            await srv.listening
+            # a peer of the old protocol: no subprotocol, no Greeting
+            url = 'ws://127.0.0.1:4430/listen/127.0.0.1/4431'
+            ws = await websockets.connect(url, loop=self.loop)
+            pack = packets.get_packet(await ws.recv())
+            self.assertIsInstance(pack, packets.ListenOK)
+            conn = srv.connections[0]
+            self.assertEqual((conn.version, conn.batch_size), (0, 0))
+            r, w = await asyncio.open_connection('127.0.0.1', 4431)
+            pack = packets.get_packet(await ws.recv())
+            self.assertEqual(str(pack), 'Request(id=0)')
+            await ws.send(packets.Accept(0, 0).as_bytes)
+            # a Continue, 3 bytes, for every LEGACY_CREDIT packets written
+            for _ in range(packets.LEGACY_CREDIT):
+                await ws.send(packets.Data(0, b'ab').as_bytes)
+            self.assertEqual(
+                await r.readexactly(2 * packets.LEGACY_CREDIT),
+                b'ab' * packets.LEGACY_CREDIT
+            )
+            self.assertEqual(await ws.recv(), b'\x05\x00\x00')
+            # the server sends that many packets, then waits for one
+            for _ in range(packets.LEGACY_CREDIT):
+                w.write(b'x')
+                pack = packets.get_packet(await ws.recv())
+                self.assertEqual(str(pack), 'Data(peer_id=0, bytes=78)')
+            w.write(b'y')
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(ws.recv(), 0.1)
+            await ws.send(b'\x05\x00\x00')
+            pack = packets.get_packet(await ws.recv())
+            self.assertEqual(str(pack), 'Data(peer_id=0, bytes=79)')
+            w.close()
+            pack = packets.get_packet(await ws.recv())
+            self.assertEqual(str(pack), 'Closed(peer_id=0)')
+            await ws.send(packets.Closed(0).as_bytes)
+
+            await ws.close()
+            await srv.close()
+
+        self.loop.run_until_complete(asyncio.wait_for(coro(), 10))
+        self.loop.close()
+
+    def test_window_update(self):
+        async def coro():
+            window = 2 * fwd_connection.INITIAL_WINDOW
+            srv = Server('127.0.0.1', 4430, window_size=window, loop=self.loop)
+            srv.start()
+            await srv.listening
+            url = 'ws://127.0.0.1:4430/listen/127.0.0.1/4431'
+            ws = await connect_greeted(url, self.loop)
+            pack = packets.get_packet(await ws.recv())
+            self.assertIsInstance(pack, packets.ListenOK)
+            # the Greeting announced the window
+            self.assertEqual(srv.connections[0].initial_window, window)
+            r, w = await asyncio.open_connection('127.0.0.1', 4431)
+            pack = packets.get_packet(await ws.recv())
+            self.assertIsInstance(pack, packets.Request)
+            await ws.send(packets.Accept(0, 0).as_bytes)
+            # what is written to the socket is granted again, in bytes
+            data = b'x' * (window // 4)
+            await ws.send(packets.Data(0, data).as_bytes)
+            self.assertEqual(await r.readexactly(len(data)), data)
+            pack = packets.get_packet(await ws.recv())
+            self.assertIsInstance(pack, packets.Continue)
+            self.assertEqual(pack.increment, len(data))
+            w.close()
+            pack = packets.get_packet(await ws.recv())
+            self.assertEqual(str(pack), 'Closed(peer_id=0)')
+            await ws.send(packets.Closed(0).as_bytes)
+
+            await ws.close()
+            await srv.close()
+
+        self.loop.run_until_complete(coro())
+        self.loop.close()
+
+    def test_batch(self):
+        async def coro():
+            srv = Server('127.0.0.1', 4430, batch_size=4096, loop=self.loop)
+            srv.start()
+            await srv.listening
+            url = 'ws://127.0.0.1:4430/listen/127.0.0.1/4431'
+            ws = await connect_greeted(url, self.loop)
+            pack = packets.get_packet(await ws.recv())
+            self.assertIsInstance(pack, packets.ListenOK)
+            r, w = await asyncio.open_connection('127.0.0.1', 4431)
+            pack = packets.get_packet(await ws.recv())
+            self.assertIsInstance(pack, packets.Request)
+            # accept and data in one frame
+            await ws.send(packets.batch([
+                packets.Accept(0, 0), packets.Data(0, b'456')
+            ]))
+            self.assertEqual(await r.read(3), b'456')
+            # the last data and closed are sent in one frame
+            w.write(b'123')
+            w.close()
+            pack = packets.get_packet(await ws.recv())
+            self.assertIsInstance(pack, packets.Batch)
+            self.assertEqual(
+                [str(p) for p in packets.unbatch(pack)],
+                ['Data(peer_id=0, bytes=313233)', 'Closed(peer_id=0)']
+            )
+            await ws.send(packets.Closed(0).as_bytes)
+
+            await ws.close()
+            await srv.close()
+
+        self.loop.run_until_complete(coro())
+        self.loop.close()
+
+    def test_group(self):
+        async def coro():
+            srv = Server('127.0.0.1', 4430, loop=self.loop)
+            srv.start()
+            await srv.listening
+            url = 'ws://127.0.0.1:4430/listen/127.0.0.1/4431/g1'
+            ws1 = await websockets.connect(url, loop=self.loop)
+            ws2 = await websockets.connect(url, loop=self.loop)
+            for ws in (ws1, ws2):
+                pack = packets.get_packet(await ws.recv())
+                self.assertIsInstance(pack, packets.ListenOK)
+            stats = srv.stats['connections']
+            self.assertEqual(len(stats), 1)
+            self.assertEqual(stats[0]['websockets'], [0, 1])
+            # one member leaves, the listener stays
+            await ws1.close()
+            while len(srv.connections) > 1:
+                await asyncio.sleep(0.01)
+            r, w = await asyncio.open_connection('127.0.0.1', 4431)
+            pack = packets.get_packet(await ws2.recv())
+            self.assertIsInstance(pack, packets.Request)
+            await ws2.send(packets.Reject(pack.id).as_bytes)
+            self.assertEqual(await r.read(), b'')
+            await ws2.send(packets.Closed(pack.id).as_bytes)
+            await ws2.close()
+            await srv.close()
+
+        self.loop.run_until_complete(coro())
+        self.loop.close()
+
+    def test_shared_listener(self):
+        async def coro():
+            srv = Server(
+                '127.0.0.1', 4430, listen_balance='round-robin',
+                loop=self.loop
+            )
+            srv.start()
+            await srv.listening
+            # independent clients, no group
+            url = 'ws://127.0.0.1:4430/listen/127.0.0.1/4431'
+            ws1 = await websockets.connect(url, loop=self.loop)
+            ws2 = await websockets.connect(url, loop=self.loop)
+            for ws in (ws1, ws2):
+                pack = packets.get_packet(await ws.recv())
+                self.assertIsInstance(pack, packets.ListenOK)
+            self.assertEqual(len(srv.stats['connections']), 2)
+            # the members take turns
+            for ws in (ws2, ws1):
+                r, w = await asyncio.open_connection('127.0.0.1', 4431)
+                pack = packets.get_packet(await ws.recv())
+                self.assertIsInstance(pack, packets.Request)
+                await ws.send(packets.Reject(pack.id).as_bytes)
+                self.assertEqual(await r.read(), b'')
+                await ws.send(packets.Closed(pack.id).as_bytes)
+            # failover to the member left
+            await ws2.close()
+            while len(srv.connections) > 1:
+                await asyncio.sleep(0.01)
+            r, w = await asyncio.open_connection('127.0.0.1', 4431)
+            pack = packets.get_packet(await ws1.recv())
+            self.assertIsInstance(pack, packets.Request)
+            await ws1.send(packets.Reject(pack.id).as_bytes)
+            await ws1.send(packets.Closed(pack.id).as_bytes)
+            await ws1.close()
+            while srv.connections:
+                await asyncio.sleep(0.01)
+            self.assertEqual(srv.listeners, {})
+            await srv.close()
+
+        self.loop.run_until_complete(coro())
+        self.loop.close()
+
+    def test_compression(self):
+        async def coro():
+            srv = Server(
+                '127.0.0.1', 4430, compression='zlib', loop=self.loop
+            )
+            srv.start()
+            await srv.listening
+            url = 'ws://127.0.0.1:4430/listen/127.0.0.1/4431'
+            ws = await connect_greeted(url, self.loop)
+            pack = packets.get_packet(await ws.recv())
+            self.assertIsInstance(pack, packets.ListenOK)
+            r, w = await asyncio.open_connection('127.0.0.1', 4431)
+            pack = packets.get_packet(await ws.recv())
+            self.assertIsInstance(pack, packets.Request)
+            await ws.send(packets.Accept(0, 0).as_bytes)
+            # the server announces what it can decompress
+            pack = packets.get_packet(await ws.recv())
+            self.assertIsInstance(pack, packets.Compress)
+            self.assertEqual(pack.codecs, compression.available())
+            # compressed data to the socket
+            comp = compression.Compressor(compression.ZLIB)
+            data = b'hello ' * 100
+            z = comp.compress(data)
+            await ws.send(packets.ZData(0, compression.ZLIB, z).as_bytes)
+            self.assertEqual(await r.readexactly(len(data)), data)
+            # data from the socket is compressed after our announcement
+            await ws.send(packets.Compress(0, compression.ZLIB).as_bytes)
+            await asyncio.sleep(0.05)
+            w.write(data)
+            pack = packets.get_packet(await ws.recv())
+            self.assertIsInstance(pack, packets.ZData)
+            decomp = compression.Decompressor(compression.ZLIB)
+            d = decomp.decompress(pack.codec, pack.bytes, len(data))
+            self.assertEqual(d, data)
+            [stream] = srv.stats['connections'][0]['connections']
+            self.assertEqual(stream['compression'], 'zlib')
+            self.assertLess(stream['compressRatio'], 0.5)
+            w.close()
+            pack = packets.get_packet(await ws.recv())
+            self.assertEqual(str(pack), 'Closed(peer_id=0)')
+            await ws.send(packets.Closed(0).as_bytes)
+
+            await ws.close()
+            await srv.close()
+
+        self.loop.run_until_complete(coro())
+        self.loop.close()
+
+    def test_metrics(self):
+        async def coro():
+            srv = Server('127.0.0.1', 4430, loop=self.loop)
+            srv.start()
+            await srv.listening
+            url = 'ws://127.0.0.1:4430/listen/127.0.0.1/4431'
+            ws = await websockets.connect(url, loop=self.loop)
+            pack = packets.get_packet(await ws.recv())
+            self.assertIsInstance(pack, packets.ListenOK)
+            r, w = await asyncio.open_connection('127.0.0.1', 4430)
+            w.write(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            response = await r.read()
+            w.close()
+            head, body = response.split(b'\r\n\r\n', 1)
+            self.assertIn(b'200 OK', head)
+            lines = body.decode().splitlines()
+            self.assertIn('aiowstunnel_tunnels{mode="listen"} 1', lines)
+            self.assertIn(
+                'aiowstunnel_packets_total{direction="out",type="ListenOK"} 1',
+                lines
+            )
+
+            await ws.close()
+            await srv.close()
+
+        self.loop.run_until_complete(coro())
+        self.loop.close()
+
+    def test_stats_subscribers(self):
+        async def coro():
+            srv = Server('127.0.0.1', 4430, loop=self.loop)
+            srv.publisher.tick = 0.05
+            srv.start()
+            await srv.listening
+            url = 'ws://127.0.0.1:4430/stats?interval=0.1'
+            sub1 = await websockets.connect(url, loop=self.loop)
+            sub2 = await websockets.connect(url, loop=self.loop)
+            for sub in (sub1, sub2):
+                msg = json.loads(await sub.recv())
+                self.assertEqual(msg['type'], 'snapshot')
+                self.assertEqual(msg['tunnels'], {})
+            # a tunnel is added
+            url = 'ws://127.0.0.1:4430/listen/127.0.0.1/4431'
+            ws = await websockets.connect(url, loop=self.loop)
+            await ws.recv()
+            for sub in (sub1, sub2):
+                msg = json.loads(await sub.recv())
+                self.assertEqual(msg['type'], 'delta')
+                [(key, fields)] = msg['tunnels']['set'].items()
+                self.assertEqual(fields['port'], 4431)
+            # and removed
+            await ws.close()
+            for sub in (sub1, sub2):
+                msg = json.loads(await sub.recv())
+                self.assertEqual(msg['tunnels']['removed'], [key])
+            self.assertEqual(len(srv.publisher.subscribers), 2)
+            for interval in ('nan', 'inf', '-inf', 'x'):
+                with self.assertRaises(websockets.InvalidStatusCode) as cm:
+                    await websockets.connect(
+                        'ws://127.0.0.1:4430/stats?interval=' + interval,
+                        loop=self.loop
+                    )
+                self.assertEqual(cm.exception.status_code, 400)
+            await sub1.close()
+            await sub2.close()
+            await srv.close()
+
+        self.loop.run_until_complete(coro())
+        self.loop.close()
+
+    def test_history(self):
+        async def coro():
+            srv = Server('127.0.0.1', 4430, loop=self.loop)
+            srv.start()
+            await srv.listening
+            url = 'ws://127.0.0.1:4430/listen/127.0.0.1/4431'
+            ws = await websockets.connect(url, loop=self.loop)
+            pack = packets.get_packet(await ws.recv())
+            self.assertIsInstance(pack, packets.ListenOK)
+            key = ('listen', '127.0.0.1', 4431, None)
+            while key not in srv.histories:
+                await asyncio.sleep(0.01)
+            h = srv.histories[key]
+            self.assertEqual(h.members, 1)
+            h.sample(time.time())
+            r, w = await asyncio.open_connection('127.0.0.1', 4430)
+            w.write(
+                b'GET /stats/history?period=60 HTTP/1.1\r\n'
+                b'Host: localhost\r\n\r\n'
+            )
+            response = await r.read()
+            w.close()
+            body = json.loads(response.split(b'\r\n\r\n', 1)[1])
+            [tunnel] = body['tunnels']
+            self.assertEqual(tunnel['port'], 4431)
+            self.assertTrue(tunnel['active'])
+            [minutes] = tunnel['history']
+            self.assertEqual(minutes['period'], 60)
+            # ListenOK
+            self.assertEqual(minutes['series']['packetsOut'], [1])
+
+            await ws.close()
+            await srv.close()
+            self.assertEqual(h.members, 0)
+
+        self.loop.run_until_complete(coro())
+        self.loop.close()
+
+    def test_history_started(self):
+        async def coro():
+            srv = Server(
+                '127.0.0.1', 4430, response_timeout=0.2, loop=self.loop
+            )
+            srv.start()
+            await srv.listening
+            busy = await asyncio.start_server(
+                lambda r, w: None, '127.0.0.1', 4432
+            )
+            # an invalid path, a listen that fails, a connect without
+            # handshake: no history
+            paths = (
+                '/listen/127.0.0.1/x', '/listen/127.0.0.1/4432',
+                '/connect/127.0.0.1/4432'
+            )
+            for path in paths:
+                ws = await websockets.connect(
+                    'ws://127.0.0.1:4430' + path, loop=self.loop
+                )
+                with self.assertRaises(websockets.ConnectionClosed):
+                    while True:
+                        await ws.recv()
+            self.assertEqual(srv.histories, {})
+            self.assertEqual(srv._new_histories, {})
+            busy.close()
+            await busy.wait_closed()
+            await srv.close()
+
+        self.loop.run_until_complete(coro())
+        self.loop.close()
+
+    def test_history_limit(self):
+        async def coro():
+            srv = Server('127.0.0.1', 4430, loop=self.loop)
+            srv.start()
+            await srv.listening
+            for port in range(3):
+                h = srv.histories['connect', 'h', port, None] = History()
+                h.sample(1000 - port)
+            url = 'ws://127.0.0.1:4430/listen/127.0.0.1/4431'
+            with mock.patch('aiowstunnel.server.MAX_HISTORIES', 3):
+                ws = await websockets.connect(url, loop=self.loop)
+                key = ('listen', '127.0.0.1', 4431, None)
+                while key not in srv.histories:
+                    await asyncio.sleep(0.01)
+            # the one idle for the longest went
+            self.assertEqual(sorted(srv.histories), [
+                ('connect', 'h', 0, None), ('connect', 'h', 1, None),
+                ('listen', '127.0.0.1', 4431, None)
+            ])
+            await ws.close()
+            await srv.close()
+
+        self.loop.run_until_complete(coro())
+        self.loop.close()
+
+    def test_connect_pool(self):
+        async def coro():
+            app = await asyncio.start_server(
+                lambda r, w: None, '127.0.0.1', 4432
+            )
+            srv = Server(
+                '127.0.0.1', 4430, connect_pool_min=1, connect_pool_max=2,
+                loop=self.loop
+            )
+            srv.start()
+            await srv.listening
+            url = 'ws://127.0.0.1:4430/connect/127.0.0.1/4432'
+            ws = await websockets.connect(url, loop=self.loop)
+            await ws.send(packets.ListenOK().as_bytes)
+            while not srv.connections[0].connect_pool:
+                await asyncio.sleep(0.01)
+            await ws.send(packets.Request(7).as_bytes)
+            pack = packets.get_packet(await ws.recv())
+            self.assertEqual(str(pack), 'Accept(peer_id=7, id=0)')
+            [tunnel] = srv.stats['connections']
+            pool = tunnel['connectPool']
+            self.assertEqual((pool['hits'], pool['misses']), (1, 0))
+
+            await ws.close()
+            await srv.close()
+            app.close()
+            await app.wait_closed()
+
+        self.loop.run_until_complete(coro())
+        self.loop.close()
+
+    def test_targets(self):
+        async def coro():
+            app = await asyncio.start_server(
+                lambda r, w: None, '127.0.0.1', 4432
+            )
+            # nothing listens on 4433, no probes: only requests eject it
+            targets = [('127.0.0.1', 4433), ('127.0.0.1', 4432)]
+            srv = Server(
+                '127.0.0.1', 4430, loop=self.loop,
+                targets={('app', 80): targets}, health_interval=0
+            )
+            srv.start()
+            try:
+                await srv.listening
+                url = 'ws://127.0.0.1:4430/connect/app/80'
+                ws = await websockets.connect(url, loop=self.loop)
+                await ws.send(packets.ListenOK().as_bytes)
+                for id in (7, 8):
+                    await ws.send(packets.Request(id).as_bytes)
+                    pack = packets.get_packet(await ws.recv())
+                    self.assertIsInstance(pack, packets.Accept)
+                [tunnel] = srv.stats['connections']
+                dead, alive = tunnel['targets']
+                self.assertEqual(alive['active'], 2)
+                self.assertEqual(dead['active'], 0)
+                self.assertEqual(dead['connectFailures'], 2)
+                self.assertFalse(dead['healthy'])
+                await ws.close()
+            finally:
+                await srv.close()
+                app.close()
+                await app.wait_closed()
+
+        self.loop.run_until_complete(coro())
+        self.loop.close()
+
+    def test_early_data(self):
+        async def coro():
+            srv = Server('127.0.0.1', 4430, early_data=4, loop=self.loop)
+            srv.start()
+            await srv.listening
+            url = 'ws://127.0.0.1:4430/listen/127.0.0.1/4431'
+            ws = await connect_greeted(url, self.loop)
+            pack = packets.get_packet(await ws.recv())
+            self.assertIsInstance(pack, packets.ListenOK)
+            r, w = await asyncio.open_connection('127.0.0.1', 4431)
+            w.write(b'123456')
+            pack = packets.get_packet(await ws.recv())
+            self.assertEqual(str(pack), 'Request(id=0)')
+            # sent before the accept, up to the budget
+            pack = packets.get_packet(await ws.recv())
+            self.assertEqual(str(pack), 'EarlyData(id=0, bytes=31323334)')
+            await ws.send(packets.Accept(0, 5).as_bytes)
+            pack = packets.get_packet(await ws.recv())
+            self.assertEqual(str(pack), 'Data(peer_id=5, bytes=3536)')
+            w.close()
+            pack = packets.get_packet(await ws.recv())
+            self.assertEqual(str(pack), 'Closed(peer_id=5)')
+            await ws.send(packets.Closed(0).as_bytes)
+            await asyncio.sleep(0.05)
+
+            # rejected: the socket is closed
+            r, w = await asyncio.open_connection('127.0.0.1', 4431)
+            w.write(b'ab')
+            pack = packets.get_packet(await ws.recv())
+            self.assertEqual(str(pack), 'Request(id=0)')
+            pack = packets.get_packet(await ws.recv())
+            self.assertEqual(str(pack), 'EarlyData(id=0, bytes=6162)')
+            await ws.send(packets.Reject(0).as_bytes)
+            await ws.send(packets.Closed(0).as_bytes)
+            self.assertEqual(await r.read(), b'')
+            await asyncio.sleep(0.05)
+            self.assertEqual(len(srv.connections[0].connections), 0)
+
+            await ws.close()
+            await srv.close()
+
+        self.loop.run_until_complete(coro())
+        self.loop.close()
+
+    def test_early_data_connect(self):
+        async def coro():
+            received = self.loop.create_future()
+
+            async def app(r, w):
+                received.set_result(await r.readexactly(5))
+                w.close()
+
+            server = await asyncio.start_server(app, '127.0.0.1', 4432)
+            srv = Server('127.0.0.1', 4430, loop=self.loop)
+            srv.start()
+            await srv.listening
+            url = 'ws://127.0.0.1:4430/connect/127.0.0.1/4432'
+            ws = await websockets.connect(url, loop=self.loop)
+            await ws.send(packets.ListenOK().as_bytes)
+            # early data is kept until the target connection is open
+            await ws.send(packets.Request(7).as_bytes)
+            await ws.send(packets.EarlyData(7, b'abc').as_bytes)
+            pack = packets.get_packet(await ws.recv())
+            self.assertEqual(str(pack), 'Accept(peer_id=7, id=0)')
+            # still in flight when the accept was sent
+            await ws.send(packets.EarlyData(7, b'de').as_bytes)
+            self.assertEqual(await received, b'abcde')
+
+            await ws.close()
+            await srv.close()
+            server.close()
+            await server.wait_closed()
+
+        self.loop.run_until_complete(coro())
+        self.loop.close()
+
+    def test_greeting(self):
+        async def coro():
+            srv = Server(
+                '127.0.0.1', 4430, batch_size=4096, early_data=1024,
+                loop=self.loop
+            )
+            srv.start()
+            await srv.listening
+            url = 'ws://127.0.0.1:4430/listen/127.0.0.1/4431'
+            ws = await websockets.connect(
+                url, subprotocols=[connection.SUBPROTOCOL], loop=self.loop
+            )
+            pack = packets.get_packet(await ws.recv())
+            self.assertIsInstance(pack, packets.Greeting)
+            self.assertEqual(pack.version, connection.PROTOCOL_VERSION)
+            # no resume_timeout, no RESUME
+            self.assertEqual(
+                pack.features, connection.FEATURES & ~connection.RESUME
+            )
+            # a peer without batches and early data, and a small window
+            greeting = packets.Greeting(1, connection.COMPRESS, 1000, 0)
+            await ws.send(greeting.as_bytes)
+            pack = packets.get_packet(await ws.recv())
+            self.assertIsInstance(pack, packets.ListenOK)
+            conn = srv.connections[0]
+            self.assertEqual((conn.batch_size, conn.early_data), (0, 0))
+            self.assertEqual(srv.stats['connections'][0]['version'], 1)
+            r, w = await asyncio.open_connection('127.0.0.1', 4431)
+            pack = packets.get_packet(await ws.recv())
+            self.assertEqual(str(pack), 'Request(id=0)')
+            await ws.send(packets.Accept(0, 0).as_bytes)
+            w.write(b'x' * 3000)
+            got = 0
+            while got < 1000:
+                pack = packets.get_packet(await ws.recv())
+                self.assertIsInstance(pack, packets.Data)
+                got += len(pack.bytes)
+            self.assertEqual(got, 1000)
+            # the rest waits for the window
+            await ws.send(packets.Continue(0, 2000).as_bytes)
+            while got < 3000:
+                pack = packets.get_packet(await ws.recv())
+                got += len(pack.bytes)
+
+            await ws.close()
+            await srv.close()
+
+        self.loop.run_until_complete(coro())
+        self.loop.close()
+
+    def test_greeting_client(self):
+        async def coro():
+            async def echo(r, w):
+                w.write(await r.read(100))
+                w.close()
+
+            app = await asyncio.start_server(echo, '127.0.0.1', 4432)
+            srv = Server('127.0.0.1', 4430, loop=self.loop)
+            srv.start()
+            await srv.listening
+            client = Client(
+                LISTEN, '127.0.0.1', 4430, '127.0.0.1', 4431,
+                '127.0.0.1', 4432, window_size=512 * 1024
+            )
+            client.start()
+            while not srv.connections or srv.connections[0].peer is None:
+                await asyncio.sleep(0.01)
+            conn = srv.connections[0]
+            self.assertEqual(conn.version, connection.PROTOCOL_VERSION)
+            self.assertEqual(conn.peer_window, 512 * 1024)
+            await asyncio.sleep(0.05)
+            r, w = await asyncio.open_connection('127.0.0.1', 4431)
+            w.write(b'ping')
+            self.assertEqual(await r.read(100), b'ping')
+            w.close()
+
+            await client.close()
+            await srv.close()
+            app.close()
+            await app.wait_closed()
+
+        self.loop.run_until_complete(coro())
+        self.loop.close()
+
+    def test_client_before_loop(self):
+        # built first, run on another loop, as with asyncio.run
+        client = Client(
+            LISTEN, '127.0.0.1', 4430, '127.0.0.1', 4431,
+            '127.0.0.1', 4432
+        )
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        async def coro():
+            async def echo(r, w):
+                w.write(await r.read(100))
+                w.close()
+
+            app = await asyncio.start_server(echo, '127.0.0.1', 4432)
+            srv = Server('127.0.0.1', 4430, loop=loop)
+            srv.start()
+            await srv.listening
+            client.start()
+            while not client.connections or \
+                    not client.connections[0].running:
+                await asyncio.sleep(0.01)
+            # parked sessions expire on this loop
+            self.assertIs(client.sessions.loop, loop)
+            r, w = await asyncio.open_connection('127.0.0.1', 4431)
+            w.write(b'ping')
+            self.assertEqual(await r.read(100), b'ping')
+            w.close()
+
+            await client.close()
+            await srv.close()
+            app.close()
+            await app.wait_closed()
+
+        try:
+            loop.run_until_complete(asyncio.wait_for(coro(), 10))
+        finally:
+            loop.close()
+            self.loop.close()
+
+    def test_resume(self):
+        async def coro():
+            async def echo(r, w):
+                while True:
+                    data = await r.read(65536)
+                    if not data:
+                        break
+                    w.write(data)
+                w.close()
+
+            app = await asyncio.start_server(echo, '127.0.0.1', 4432)
+            srv = Server('127.0.0.1', 4430, resume_timeout=5, loop=self.loop)
+            srv.start()
+            await srv.listening
+            client = Client(
+                LISTEN, '127.0.0.1', 4430, '127.0.0.1', 4431,
+                '127.0.0.1', 4432, resume_timeout=5, initial_delay=0.05
+            )
+            client.start()
+            while not srv.connections or srv.connections[0].token is None:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.05)
+            r, w = await asyncio.open_connection('127.0.0.1', 4431)
+            w.write(b'ping')
+            self.assertEqual(await r.readexactly(4), b'ping')
+            # the link fails with data on the way in both directions
+            data = bytes(range(256)) * 4096
+            w.write(data)
+            await asyncio.sleep(0.01)
+            srv.connections[0].ws.transport.abort()
+            self.assertEqual(await r.readexactly(len(data)), data)
+            self.assertEqual(srv.stats['sessions']['resumed'], 1)
+            # the stream goes on, and new ones open
+            w.write(b'pong')
+            self.assertEqual(await r.readexactly(4), b'pong')
+            r2, w2 = await asyncio.open_connection('127.0.0.1', 4431)
+            w2.write(b'new')
+            self.assertEqual(await r2.readexactly(3), b'new')
+            for writer in (w, w2):
+                writer.close()
+
+            await client.close()
+            await srv.close()
+            app.close()
+            await app.wait_closed()
+
+        self.loop.run_until_complete(asyncio.wait_for(coro(), 20))
+        self.loop.close()
+
+    def test_drain(self):
+        async def coro():
+            async def echo(r, w):
+                while True:
+                    data = await r.read(65536)
+                    if not data:
+                        break
+                    w.write(data)
+                w.close()
+
+            app = await asyncio.start_server(echo, '127.0.0.1', 4432)
+            srv = Server('127.0.0.1', 4430, loop=self.loop)
+            srv.start()
+            await srv.listening
+            # the client listens on 4431, the server connects to the app
+            client = Client(
+                CONNECT, '127.0.0.1', 4430, '127.0.0.1', 4431,
+                '127.0.0.1', 4432, initial_delay=0.05
+            )
+            client.start()
+            while not srv.connections or not srv.connections[0].running:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.05)
+            r1, w1 = await asyncio.open_connection('127.0.0.1', 4431)
+            r2, w2 = await asyncio.open_connection('127.0.0.1', 4431)
+            for r, w in ((r1, w1), (r2, w2)):
+                w.write(b'ping')
+                self.assertEqual(await r.readexactly(4), b'ping')
+            draining = asyncio.ensure_future(srv.drain(0.5))
+            while not client.connections[0].peer_draining.done():
+                await asyncio.sleep(0.01)
+            self.assertEqual(srv.stats['draining']['streams'], 2)
+            # no new tunnels, no new streams, the open ones go on
+            with self.assertRaises(OSError):
+                await websockets.connect(
+                    'ws://127.0.0.1:4430/stats', loop=self.loop
+                )
+            r3, w3 = await asyncio.open_connection('127.0.0.1', 4431)
+            self.assertEqual(await r3.read(), b'')
+            w1.write(b'pong')
+            self.assertEqual(await r1.readexactly(4), b'pong')
+            w1.close()
+            while srv.stats['draining']['streams'] > 1:
+                await asyncio.sleep(0.01)
+            # the deadline closes the last one
+            self.assertEqual(await r2.read(), b'')
+            await draining
+            self.assertEqual(srv.stats['draining']['streamsAtStart'], 2)
+            self.assertEqual(srv.stats['draining']['streams'], 0)
+
+            await client.close()
+            app.close()
+            await app.wait_closed()
+
+        self.loop.run_until_complete(asyncio.wait_for(coro(), 10))
+        self.loop.close()
+
+    def test_drain_client(self):
+        async def coro():
+            async def echo(r, w):
+                while True:
+                    data = await r.read(65536)
+                    if not data:
+                        break
+                    w.write(data)
+                w.close()
+
+            app = await asyncio.start_server(echo, '127.0.0.1', 4432)
+            srv = Server('127.0.0.1', 4430, loop=self.loop)
+            srv.start()
+            await srv.listening
+            client = Client(
+                LISTEN, '127.0.0.1', 4430, '127.0.0.1', 4431,
+                '127.0.0.1', 4432
+            )
+            client.start()
+            while not srv.connections or not srv.connections[0].running:
+                await asyncio.sleep(0.01)
+            r1, w1 = await asyncio.open_connection('127.0.0.1', 4431)
+            w1.write(b'ping')
+            self.assertEqual(await r1.readexactly(4), b'ping')
+            draining = asyncio.ensure_future(client.drain(5))
+            conn = srv.connections[0]
+            while not conn.peer_draining.done():
+                await asyncio.sleep(0.01)
+            self.assertEqual(client.drain_stats()['streams'], 1)
+            # the server gives no new streams to the draining client
+            r2, w2 = await asyncio.open_connection('127.0.0.1', 4431)
+            self.assertEqual(await r2.read(), b'')
+            w1.write(b'pong')
+            self.assertEqual(await r1.readexactly(4), b'pong')
+            w1.close()
+            # done before the deadline
+            await asyncio.wait_for(draining, 1)
+            self.assertEqual(client.drain_stats()['streams'], 0)
+            await conn.wait_closed()
+
+            await srv.close()
+            app.close()
+            await app.wait_closed()
+
+        self.loop.run_until_complete(asyncio.wait_for(coro(), 10))
+        self.loop.close()
+
+    def test_stream_ids_exhausted(self):
+        async def coro():
+            app = await asyncio.start_server(
+                lambda r, w: None, '127.0.0.1', 4432
+            )
+            srv = Server('127.0.0.1', 4430, loop=self.loop)
+            srv.start()
+            await srv.listening
+            url = 'ws://127.0.0.1:4430/listen/127.0.0.1/4431'
+            ws = await websockets.connect(url, loop=self.loop)
+            pack = packets.get_packet(await ws.recv())
+            self.assertIsInstance(pack, packets.ListenOK)
+            srv.connections[0].connections.cap = 1
+            r1, w1 = await asyncio.open_connection('127.0.0.1', 4431)
+            pack = packets.get_packet(await ws.recv())
+            self.assertEqual(str(pack), 'Request(id=0)')
+            # no id for the second one, it is closed
+            r2, w2 = await asyncio.open_connection('127.0.0.1', 4431)
+            self.assertEqual(await r2.read(), b'')
+            # the tunnel goes on
+            await ws.send(packets.Accept(0, 0).as_bytes)
+            w1.write(b'123')
+            pack = packets.get_packet(await ws.recv())
+            self.assertEqual(str(pack), 'Data(peer_id=0, bytes=313233)')
+
+            # the connecting side rejects the request
+            url = 'ws://127.0.0.1:4430/connect/127.0.0.1/4432'
+            ws2 = await websockets.connect(url, loop=self.loop)
+            await ws2.send(packets.ListenOK().as_bytes)
+            while len(srv.connections) < 2:
+                await asyncio.sleep(0.01)
+            srv.connections[1].connections.cap = 0
+            await ws2.send(packets.Request(7).as_bytes)
+            pack = packets.get_packet(await ws2.recv())
+            self.assertEqual(str(pack), 'Reject(peer_id=7)')
+            pack = packets.get_packet(await ws2.recv())
+            self.assertEqual(str(pack), 'Closed(peer_id=7)')
+            rejects = srv.metrics.rejects.labels('out').value
+            self.assertEqual(rejects, 2)
+
+            w1.close()
+            await ws.close()
+            await ws2.close()
+            await srv.close()
+            app.close()
+            await app.wait_closed()
+
+        self.loop.run_until_complete(coro())
+        self.loop.close()
+
+    def test_tunnel_ids_exhausted(self):
+        async def coro():
+            srv = Server('127.0.0.1', 4430, loop=self.loop)
+            srv.connections.cap = 0
+            srv.start()
+            await srv.listening
+            url = 'ws://127.0.0.1:4430/listen/127.0.0.1/4431'
+            ws = await websockets.connect(url, loop=self.loop)
+            with self.assertRaises(websockets.ConnectionClosed):
+                await ws.recv()
+            self.assertEqual(ws.close_code, CLOSE_TRY_AGAIN)
+            await srv.close()
+
+        self.loop.run_until_complete(coro())
+        self.loop.close()
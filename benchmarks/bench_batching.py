@@ -0,0 +1,63 @@
+"""
+Benchmark of websocket frame batching with many chatty streams.
+
+Opens ``STREAMS`` forwarded connections through a LISTEN mode tunnel, each
+doing ``ROUNDS`` request/response round trips of small messages against an
+echo server, with batching off and on. Reports messages per second, CPU
+time per thousand messages, and server side frames/packets sent::
+
+    python -m benchmarks.bench_batching
+"""
+
+import asyncio
+import time
+
+from aiowstunnel import LISTEN
+
+from .common import Tunnel, HOST, FWD_PORT, run
+
+
+STREAMS = 200
+ROUNDS = 50
+MESSAGE = b'x' * 64
+
+SETTINGS = (
+    ('batching off', {}),
+    ('batching 1ms', {'batch_size': 65536, 'batch_delay': 0.001}),
+    ('batching 5ms', {'batch_size': 65536, 'batch_delay': 0.005}),
+)
+
+
+async def chatty_stream():
+    r, w = await asyncio.open_connection(HOST, FWD_PORT)
+    for _ in range(ROUNDS):
+        w.write(MESSAGE)
+        await r.readexactly(len(MESSAGE))
+    w.close()
+
+
+async def bench(label, kwargs):
+    async with Tunnel(LISTEN, kwargs, kwargs) as tunnel:
+        start, cpu = time.perf_counter(), time.process_time()
+        await asyncio.gather(*[chatty_stream() for _ in range(STREAMS)])
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+        conn = tunnel.server_connections()[0]
+        messages = STREAMS * ROUNDS
+        print(
+            '{:<14} {:8.0f} msg/s {:8.1f} ms CPU/1k msg '
+            '{:8.0f} frames/s {:6.2f} packets/frame'.format(
+                label, messages / elapsed, cpu / messages * 1e6,
+                conn.frames_out / elapsed,
+                conn.packets_out / max(conn.frames_out, 1)
+            )
+        )
+
+
+async def main():
+    for label, kwargs in SETTINGS:
+        await bench(label, kwargs)
+
+
+if __name__ == '__main__':
+    run(main())
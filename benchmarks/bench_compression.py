@@ -0,0 +1,100 @@
+"""
+Benchmark of compression: throughput and bytes on the wire of a bulk
+transfer of text and of random data, with no compression, websocket
+permessage-deflate and the tunnel's per-stream compression::
+
+    python -m benchmarks.bench_compression
+"""
+
+import asyncio
+import json
+import os
+import time
+
+from aiowstunnel import LISTEN
+from aiowstunnel import compression
+
+from .common import Tunnel, Relay, HOST, FWD_PORT, RELAY_PORT, run
+
+
+BULK = 32 * 1024 * 1024
+CHUNK = 64 * 1024
+
+SETTINGS = [
+    ('none', {'ws_compression': None}),
+    ('permessage-deflate', {}),
+    ('zlib', {'compression': 'zlib', 'ws_compression': None}),
+]
+if compression.lz4 is not None:
+    SETTINGS.append(
+        ('lz4', {'compression': 'lz4', 'ws_compression': None})
+    )
+
+
+def text_chunk():
+    # log lines of a JSON API, varying a little
+    lines, size, i = [], 0, 0
+    while size < CHUNK:
+        line = json.dumps({
+            'time': '2017-10-18T12:00:%02d' % (i % 60),
+            'method': 'GET', 'path': '/api/items/%d' % (i * 7919 % 10000),
+            'status': 200, 'size': i * 31 % 5000
+        }).encode() + b'\n'
+        lines.append(line)
+        size += len(line)
+        i += 1
+    return b''.join(lines)[:CHUNK]
+
+
+PAYLOADS = (
+    ('text', text_chunk()),
+    ('random', os.urandom(CHUNK)),
+)
+
+
+async def app(r, w):
+    got = 0
+    while got < BULK:
+        data = await r.read(1024 * 1024)
+        if not data:
+            break
+        got += len(data)
+    w.write(b'k')
+    await w.drain()
+    w.close()
+
+
+async def bulk(chunk):
+    r, w = await asyncio.open_connection(HOST, FWD_PORT)
+    start = time.perf_counter()
+    for _ in range(BULK // len(chunk)):
+        w.write(chunk)
+        await w.drain()
+    await r.readexactly(1)
+    elapsed = time.perf_counter() - start
+    w.close()
+    return BULK / elapsed / 1e6
+
+
+async def bench(label, kwargs, payload, chunk):
+    async with Relay() as relay:
+        tunnel = Tunnel(
+            LISTEN, kwargs, kwargs, app=app, tunnel_port=RELAY_PORT
+        )
+        async with tunnel:
+            wire = relay.bytes
+            throughput = await bulk(chunk)
+            wire = relay.bytes - wire
+    print('{:<7} {:<19} {:8.1f} MB/s  wire {:6.1%}'.format(
+        payload, label, throughput, wire / BULK
+    ))
+
+
+async def main():
+    for payload, chunk in PAYLOADS:
+        for label, kwargs in SETTINGS:
+            await bench(label, kwargs, payload, chunk)
+
+
+if __name__ == '__main__':
+    run(main())
@@ -0,0 +1,68 @@
+"""
+Benchmark of early data: time to the first byte of the response of short
+request/response connections over a link with a round trip time of
+``2 * DELAY``, with and without early data::
+
+    python -m benchmarks.bench_early_data
+"""
+
+import asyncio
+import statistics
+import time
+
+from aiowstunnel import LISTEN
+
+from .common import Tunnel, Relay, HOST, FWD_PORT, RELAY_PORT, run
+
+
+DELAY = 0.01  # seconds, one way
+CONNECTIONS = 50
+REQUEST = b'GET / HTTP/1.0\r\n\r\n'
+
+SETTINGS = [
+    ('off', {}),
+    ('early data', {'early_data': 16 * 1024}),
+]
+
+
+async def app(r, w):
+    # answers when the request is in
+    try:
+        await r.readexactly(len(REQUEST))
+    except asyncio.IncompleteReadError:
+        w.close()  # the port check of Tunnel
+        return
+    w.write(b'HTTP/1.0 204 No Content\r\n\r\n')
+    await w.drain()
+    w.close()
+
+
+async def first_byte():
+    start = time.perf_counter()
+    r, w = await asyncio.open_connection(HOST, FWD_PORT)
+    w.write(REQUEST)
+    await r.readexactly(1)
+    elapsed = time.perf_counter() - start
+    w.close()
+    return elapsed
+
+
+async def bench(label, kwargs):
+    async with Relay(delay=DELAY):
+        tunnel = Tunnel(LISTEN, kwargs, app=app, tunnel_port=RELAY_PORT)
+        async with tunnel:
+            times = [await first_byte() for _ in range(CONNECTIONS)]
+    print('{:<11} first byte p50 {:6.1f} ms  p90 {:6.1f} ms'.format(
+        label, statistics.median(times) * 1e3,
+        sorted(times)[len(times) * 9 // 10] * 1e3
+    ))
+
+
+async def main():
+    print('round trip {:.0f} ms'.format(2 * DELAY * 1e3))
+    for label, kwargs in SETTINGS:
+        await bench(label, kwargs)
+
+
+if __name__ == '__main__':
+    run(main())
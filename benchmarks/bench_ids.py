@@ -0,0 +1,50 @@
+"""
+Benchmark of the stream/tunnel id allocator.
+
+Fills an :class:`~aiowstunnel.ids.Ids` with 60k live ids, then churns it:
+every round frees a random live id, allocates a new one and looks up a
+random live id, like a busy tunnel opening and closing streams while
+``Data`` packets are dispatched. Only the public ``Ids`` API is used, so the
+script runs against any revision::
+
+    python -m benchmarks.bench_ids
+"""
+
+import random
+import time
+
+from aiowstunnel.ids import Ids
+
+
+LIVE = 60000
+ROUNDS = 200000
+
+
+def main():
+    rnd = random.Random(0)
+    ids = Ids()
+
+    start = time.perf_counter()
+    live = [ids.store(i) for i in range(LIVE)]
+    elapsed = time.perf_counter() - start
+    print('fill {} ids: {:8.0f} ns/store'.format(LIVE, elapsed / LIVE * 1e9))
+
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        idx = rnd.randrange(LIVE)
+        ids.pop(live[idx])
+        live[idx] = ids.store(idx)
+        ids[live[rnd.randrange(LIVE)]]
+    elapsed = time.perf_counter() - start
+    print('churn pop+store+get: {:8.0f} ns/round'.format(
+        elapsed / ROUNDS * 1e9))
+
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        ids[live[rnd.randrange(LIVE)]]
+    elapsed = time.perf_counter() - start
+    print('lookup: {:8.0f} ns/get'.format(elapsed / ROUNDS * 1e9))
+
+
+if __name__ == '__main__':
+    main()
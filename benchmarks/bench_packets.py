@@ -0,0 +1,46 @@
+"""
+Micro-benchmark of the packet codec.
+
+Measures the per-packet cost of encoding (``as_bytes``) and decoding
+(``get_packet`` plus a field read) for control packets and for ``Data``
+packets of a few payload sizes. The script only uses the public packet API,
+so it can be run against any revision to compare before/after numbers::
+
+    python -m benchmarks.bench_packets
+"""
+
+import timeit
+
+from aiowstunnel import packets
+
+
+NUMBER = 100000
+
+
+def bench(label, stmt):
+    best = min(timeit.repeat(stmt, number=NUMBER, repeat=5))
+    print('{:<32} {:8.0f} ns/packet'.format(label, best / NUMBER * 1e9))
+
+
+def main():
+    for size in (0, 4096, 65536):
+        payload = b'x' * size
+        if size:
+            pack = packets.Data(42, payload)
+            frame = pack.as_bytes
+            bench(
+                'encode Data({})'.format(size),
+                lambda: packets.Data(42, payload).as_bytes
+            )
+            bench(
+                'decode Data({})'.format(size),
+                lambda: packets.get_packet(frame).peer_id
+            )
+        else:
+            frame = packets.Accept(1, 2).as_bytes
+            bench('encode Accept', lambda: packets.Accept(1, 2).as_bytes)
+            bench('decode Accept', lambda: packets.get_packet(frame).id)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Benchmark of the socket read path: bulk throughput and request/response
+latency with fixed 4 KiB reads, adaptive read sizes and adaptive read sizes
+with a coalescing delay::
+
+    python -m benchmarks.bench_read
+"""
+
+import asyncio
+import time
+
+from aiowstunnel import LISTEN
+
+from .common import Tunnel, HOST, FWD_PORT, run
+
+
+BULK = 64 * 1024 * 1024
+ROUNDS = 2000
+MESSAGE = b'x' * 100
+
+SETTINGS = (
+    ('fixed 4 KiB', {'read_size_min': 4096, 'read_size_max': 4096}),
+    ('adaptive', {}),
+    ('adaptive 1ms', {'read_delay': 0.001}),
+)
+
+
+async def app(r, w):
+    # the first byte selects: bulk sink or echo
+    kind = await r.read(1)
+    if kind == b'b':
+        got = 0
+        while got < BULK:
+            data = await r.read(1024 * 1024)
+            if not data:
+                break
+            got += len(data)
+        w.write(b'k')
+    elif kind == b'e':
+        while True:
+            data = await r.read(65536)
+            if not data:
+                break
+            w.write(data)
+    await w.drain()
+    w.close()
+
+
+async def bulk():
+    r, w = await asyncio.open_connection(HOST, FWD_PORT)
+    w.write(b'b')
+    chunk = b'x' * (1024 * 1024)
+    start = time.perf_counter()
+    for _ in range(BULK // len(chunk)):
+        w.write(chunk)
+        await w.drain()
+    await r.readexactly(1)
+    elapsed = time.perf_counter() - start
+    w.close()
+    return BULK / elapsed / 1e6
+
+
+async def request_response():
+    r, w = await asyncio.open_connection(HOST, FWD_PORT)
+    w.write(b'e')
+    latencies = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        w.write(MESSAGE)
+        await r.readexactly(len(MESSAGE))
+        latencies.append(time.perf_counter() - start)
+    w.close()
+    latencies.sort()
+    return [
+        latencies[int(len(latencies) * q)] * 1e3 for q in (0.5, 0.99)
+    ]
+
+
+async def bench(label, kwargs):
+    async with Tunnel(LISTEN, kwargs, kwargs, app=app):
+        throughput = await bulk()
+        p50, p99 = await request_response()
+    print('{:<14} bulk {:8.1f} MB/s  rtt p50 {:6.2f} ms p99 {:6.2f} ms'.format(
+        label, throughput, p50, p99
+    ))
+
+
+async def main():
+    for label, kwargs in SETTINGS:
+        await bench(label, kwargs)
+
+
+if __name__ == '__main__':
+    run(main())
@@ -0,0 +1,174 @@
+"""
+Scale test: opens more concurrent idle streams on one tunnel than fit in
+the 16 bit ids of protocol version 1, checks that one more than the id
+space is rejected while the tunnel goes on, and reports the time to open
+them and the memory of an idle stream::
+
+    python -m benchmarks.bench_streams [streams]
+
+So many sockets do not fit in the file descriptor limit of most hosts, so
+the streams are in-memory connections handed to the listening side of a
+:class:`~aiowstunnel.Server` tunnel, the way its forward listener hands
+over accepted sockets. The other side of the tunnel is a bare websocket
+speaking protocol version 2: it answers every ``Request`` with an
+``Accept``.
+"""
+
+import asyncio
+import resource
+import sys
+import time
+
+import websockets
+
+from aiowstunnel import Server, LISTEN
+from aiowstunnel import packets
+from aiowstunnel import connection
+
+from .common import HOST, TUNNEL_PORT, FWD_PORT, run
+
+
+STREAMS = 100000
+ACCEPTS = 1000  # per Batch frame
+
+
+class MemoryTransport(asyncio.Transport):
+    def __init__(self, protocol, n):
+        super().__init__({'peername': ('memory', n)})
+        self.protocol = protocol
+        self.closing = False
+
+    def write(self, data):
+        pass
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self):
+        if not self.closing:
+            self.closing = True
+            asyncio.get_event_loop().call_soon(
+                self.protocol.connection_lost, None
+            )
+
+    def get_write_buffer_size(self):
+        return 0
+
+
+def memory_stream(n):
+    loop = asyncio.get_event_loop()
+    reader = asyncio.StreamReader()
+    protocol = asyncio.StreamReaderProtocol(reader)
+    transport = MemoryTransport(protocol, n)
+    protocol.connection_made(transport)
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return reader, writer, transport
+
+
+class Peer:
+    """
+    The other side of the tunnel, accepting every stream.
+    """
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.accepted = 0
+        self.data = asyncio.get_event_loop().create_future()
+
+    def incoming(self, frame):
+        pack = packets.get_packet(frame, 2)
+        if isinstance(pack, packets.Batch):
+            yield from packets.unbatch(pack, 2)
+        else:
+            yield pack
+
+    async def run(self):
+        try:
+            while True:
+                accepts = []
+                for pack in self.incoming(await self.ws.recv()):
+                    if isinstance(pack, packets.Request):
+                        accepts.append(packets.Accept(pack.id, pack.id))
+                    elif isinstance(pack, packets.Data):
+                        if not self.data.done():
+                            self.data.set_result(pack)
+                for i in range(0, len(accepts), ACCEPTS):
+                    chunk = accepts[i:i + ACCEPTS]
+                    await self.ws.send(packets.batch(chunk, 2))
+                    self.accepted += len(chunk)
+        except websockets.ConnectionClosed:
+            pass
+
+
+def max_rss():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def main(streams):
+    srv = Server(HOST, TUNNEL_PORT, batch_size=16 * 1024, response_timeout=60)
+    srv.start()
+    await srv.listening
+    url = 'ws://{}:{}/{}/{}/{}'.format(
+        HOST, TUNNEL_PORT, LISTEN, HOST, FWD_PORT
+    )
+    ws = await websockets.connect(
+        url, subprotocols=[connection.SUBPROTOCOL], max_size=None
+    )
+    pack = packets.get_packet(await ws.recv())
+    assert isinstance(pack, packets.Greeting), pack
+    greeting = packets.Greeting(2, connection.BATCH, 256 * 1024, 0)
+    await ws.send(greeting.as_bytes)
+    pack = packets.get_packet(await ws.recv(), 2)
+    assert isinstance(pack, packets.ListenOK), pack
+    conn = srv.connections[0]
+    assert conn.version == 2
+    peer = Peer(ws)
+    peer_task = asyncio.ensure_future(peer.run())
+
+    rss = max_rss()
+    start = time.perf_counter()
+    first = None
+    for n in range(streams):
+        r, w, transport = memory_stream(n)
+        if first is None:
+            first = r
+        asyncio.ensure_future(conn.handle_fwd_conn(r, w))
+    while peer.accepted < streams:
+        await asyncio.sleep(0.1)
+    elapsed = time.perf_counter() - start
+    await asyncio.sleep(0.5)
+    assert len(conn.connections) == streams
+    highest = max(conn.connections)
+    used = max_rss() - rss
+    print('{} streams open in {:.1f} s ({:.0f} streams/s)'.format(
+        streams, elapsed, streams / elapsed
+    ))
+    print('highest stream id {}, {:.0f} bytes per idle stream'.format(
+        highest, used / streams
+    ))
+
+    # out of ids: the next stream is closed, the others go on
+    conn.connections.cap = streams
+    r, w, transport = memory_stream(streams)
+    await conn.handle_fwd_conn(r, w)
+    assert transport.is_closing()
+    print('stream over the id space closed, rejects {}'.format(
+        srv.metrics.rejects.labels('out').value
+    ))
+    first.feed_data(b'ping')
+    pack = await asyncio.wait_for(peer.data, 10)
+    assert bytes(pack.bytes) == b'ping'
+    print('tunnel still forwarding')
+
+    start = time.perf_counter()
+    await ws.close()
+    await peer_task
+    while len(srv.connections):
+        await asyncio.sleep(0.1)
+    print('closed in {:.1f} s'.format(time.perf_counter() - start))
+    await srv.close()
+
+
+if __name__ == '__main__':
+    run(main(int(sys.argv[1]) if len(sys.argv) > 1 else STREAMS))
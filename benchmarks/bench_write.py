@@ -0,0 +1,83 @@
+"""
+Benchmark of the socket write path with many small Data packets.
+
+The app server sends ``MESSAGES`` small messages on every stream, each as a
+separate write, so the tunnel carries them as many small ``Data`` packets
+that are written to the receiving socket. Reports throughput, messages per
+second and CPU time per message, with batching off and on (with batching
+many Data packets arrive at once)::
+
+    python -m benchmarks.bench_write
+"""
+
+import asyncio
+import time
+
+from aiowstunnel import LISTEN
+from aiowstunnel import fwd_connection
+
+from .common import Tunnel, HOST, FWD_PORT, run
+
+
+STREAMS = 20
+MESSAGES = 5000
+MESSAGE = b'x' * 100
+
+
+async def chatty_app(r, w):
+    # a small message per write, then a drain to let it go out
+    for _ in range(MESSAGES):
+        w.write(MESSAGE)
+        await w.drain()
+    w.close()
+
+
+async def sink_stream():
+    r, w = await asyncio.open_connection(HOST, FWD_PORT)
+    await r.readexactly(MESSAGES * len(MESSAGE))
+    w.close()
+
+
+class Counter:
+    # counts calls of a method, to see how many Data chunks a socket write
+    # carries
+    def __init__(self, klass, name):
+        self.count = 0
+        method = getattr(klass, name)
+
+        def wrapper(*args, **kwargs):
+            self.count += 1
+            return method(*args, **kwargs)
+
+        setattr(klass, name, wrapper)
+        self.restore = lambda: setattr(klass, name, method)
+
+
+async def bench(label, kwargs):
+    chunks = Counter(fwd_connection.WriteBuffer, 'put')
+    writes = Counter(asyncio.StreamWriter, 'writelines')
+    async with Tunnel(LISTEN, kwargs, kwargs, app=chatty_app):
+        start, cpu = time.perf_counter(), time.process_time()
+        await asyncio.gather(*[sink_stream() for _ in range(STREAMS)])
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+    chunks.restore()
+    writes.restore()
+    messages = STREAMS * MESSAGES
+    print(
+        '{:<14} {:8.2f} MB/s {:8.0f} msg/s {:6.1f} us CPU/msg '
+        '{:6.2f} chunks/write'.format(
+            label, messages * len(MESSAGE) / elapsed / 1e6,
+            messages / elapsed, cpu / messages * 1e6,
+            chunks.count / max(writes.count, 1)
+        )
+    )
+
+
+async def main():
+    await bench('batching off', {})
+    await bench('batching on', {'batch_size': 65536})
+
+
+if __name__ == '__main__':
+    run(main())
@@ -0,0 +1,143 @@
+"""
+Helpers for running an app server, a tunnel :class:`~aiowstunnel.Server`
+and a :class:`~aiowstunnel.Client` in one event loop on localhost.
+"""
+
+import asyncio
+import time
+
+from aiowstunnel import Server, Client
+
+
+HOST = '127.0.0.1'
+TUNNEL_PORT = 14430
+FWD_PORT = 14431
+RELAY_PORT = 14432
+APP_PORT = 16000
+
+
+async def echo(r, w):
+    try:
+        while True:
+            data = await r.read(65536)
+            if not data:
+                break
+            w.write(data)
+            await w.drain()
+    except ConnectionError:
+        pass
+    w.close()
+
+
+class Tunnel:
+    """
+    Async context manager setting up ``app`` <- Client/Server -> FWD_PORT.
+    """
+
+    def __init__(
+        self, server_mode, server_kwargs=None, client_kwargs=None, app=echo,
+        tunnel_port=TUNNEL_PORT
+    ):
+        self.server_mode = server_mode
+        self.server_kwargs = server_kwargs or {}
+        self.client_kwargs = client_kwargs or {}
+        self.app = app
+        # the client connects here, e.g. to a Relay in front of the server
+        self.tunnel_port = tunnel_port
+
+    async def __aenter__(self):
+        self.app_server = await asyncio.start_server(
+            self.app, HOST, APP_PORT
+        )
+        self.server = Server(HOST, TUNNEL_PORT, **self.server_kwargs)
+        self.server.start()
+        await self.server.listening
+        self.client = Client(
+            self.server_mode,
+            HOST, self.tunnel_port, HOST, FWD_PORT, HOST, APP_PORT,
+            **self.client_kwargs
+        )
+        self.client.start()
+        await wait_port(HOST, FWD_PORT)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.client.close()
+        await self.server.close()
+        self.app_server.close()
+        await self.app_server.wait_closed()
+
+    def server_connections(self):
+        return list(self.server.connections.values())
+
+
+class Relay:
+    """
+    TCP relay from ``RELAY_PORT`` to ``port`` counting the bytes, to
+    measure what goes over the wire. With a ``delay`` (seconds) everything
+    is forwarded that much later, as over a link with twice that round
+    trip time.
+    """
+
+    def __init__(self, port=TUNNEL_PORT, delay=0):
+        self.port = port
+        self.delay = delay
+        self.bytes = 0
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self.handle, HOST, RELAY_PORT)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, r, w):
+        try:
+            r2, w2 = await asyncio.open_connection(HOST, self.port)
+        except OSError:
+            w.close()
+            return
+        await asyncio.gather(self.pipe(r, w2), self.pipe(r2, w))
+
+    async def pipe(self, r, w):
+        try:
+            while True:
+                data = await r.read(65536)
+                if not data:
+                    break
+                self.bytes += len(data)
+                if self.delay:
+                    loop = asyncio.get_event_loop()
+                    loop.call_later(self.delay, w.write, data)
+                    continue
+                w.write(data)
+                await w.drain()
+            if self.delay:
+                await asyncio.sleep(self.delay)
+        except ConnectionError:
+            pass
+        w.close()
+
+
+async def wait_port(host, port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            r, w = await asyncio.open_connection(host, port)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+        else:
+            w.close()
+            return
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
@@ -0,0 +1,250 @@
+"""
+End-to-end benchmark suite: an app server, a tunnel
+:class:`~aiowstunnel.Server` and a :class:`~aiowstunnel.Client` on
+localhost, in ``LISTEN`` and ``CONNECT`` mode. Measures bulk throughput,
+request/response latency percentiles, the rate of new forwarded
+connections and the memory of an idle stream (both ends of the tunnel
+and the app server together, traced with ``tracemalloc``).
+
+Write the results to a JSON file::
+
+    python -m benchmarks.suite run -o before.json
+
+and flag the metrics that got worse by more than the threshold between
+two runs (the exit status is 1 if any did)::
+
+    python -m benchmarks.suite compare before.json after.json
+
+Only the public ``Server`` and ``Client`` API is used, so the suite runs
+against any revision.
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+from aiowstunnel import LISTEN, CONNECT
+
+from .common import Tunnel, HOST, FWD_PORT, run
+
+
+BULK = 64 * 1024 * 1024
+ROUNDS = 2000
+MESSAGE = b'x' * 100
+CONNECTIONS = 500
+CONCURRENCY = 10
+IDLE_STREAMS = 500
+
+# metric: (unit, higher is better)
+METRICS = {
+    'throughput': ('MB/s', True),
+    'latency_p50': ('ms', False),
+    'latency_p90': ('ms', False),
+    'latency_p99': ('ms', False),
+    'connection_rate': ('conn/s', True),
+    'idle_stream_memory': ('bytes', False),
+}
+
+
+async def app(r, w):
+    # the first byte selects: bulk sink or echo
+    kind = await r.read(1)
+    try:
+        if kind == b'b':
+            got = 0
+            while got < BULK:
+                data = await r.read(1024 * 1024)
+                if not data:
+                    break
+                got += len(data)
+            w.write(b'k')
+        elif kind == b'e':
+            while True:
+                data = await r.read(65536)
+                if not data:
+                    break
+                w.write(data)
+                await w.drain()
+        await w.drain()
+    except ConnectionError:
+        pass
+    w.close()
+
+
+async def throughput():
+    r, w = await asyncio.open_connection(HOST, FWD_PORT)
+    w.write(b'b')
+    chunk = b'x' * (1024 * 1024)
+    start = time.perf_counter()
+    for _ in range(BULK // len(chunk)):
+        w.write(chunk)
+        await w.drain()
+    await r.readexactly(1)
+    elapsed = time.perf_counter() - start
+    w.close()
+    return {'throughput': BULK / elapsed / 1e6}
+
+
+async def latency():
+    r, w = await asyncio.open_connection(HOST, FWD_PORT)
+    w.write(b'e')
+    latencies = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        w.write(MESSAGE)
+        await r.readexactly(len(MESSAGE))
+        latencies.append(time.perf_counter() - start)
+    w.close()
+    latencies.sort()
+    return {
+        'latency_p%d' % q: latencies[len(latencies) * q // 100] * 1e3
+        for q in (50, 90, 99)
+    }
+
+
+async def connection_rate():
+    async def worker(count):
+        for _ in range(count):
+            r, w = await asyncio.open_connection(HOST, FWD_PORT)
+            w.write(b'ex')
+            await r.readexactly(1)
+            w.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        worker(CONNECTIONS // CONCURRENCY) for _ in range(CONCURRENCY)
+    ])
+    elapsed = time.perf_counter() - start
+    return {'connection_rate': CONNECTIONS / elapsed}
+
+
+async def idle_stream_memory():
+    # one round trip per stream, so it is set up at both ends
+    async def open_stream():
+        r, w = await asyncio.open_connection(HOST, FWD_PORT)
+        w.write(b'ex')
+        await r.readexactly(1)
+        return w
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        writers = []
+        for _ in range(IDLE_STREAMS // CONCURRENCY):
+            writers += await asyncio.gather(
+                *[open_stream() for _ in range(CONCURRENCY)]
+            )
+        await asyncio.sleep(0.1)
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    for w in writers:
+        w.close()
+    return {'idle_stream_memory': used / len(writers)}
+
+
+BENCHMARKS = (throughput, latency, connection_rate, idle_stream_memory)
+
+
+async def run_mode(mode, repeat):
+    samples = {}
+    async with Tunnel(mode, app=app):
+        for _ in range(repeat):
+            for bench in BENCHMARKS:
+                for name, value in (await bench()).items():
+                    samples.setdefault(name, []).append(value)
+                # let closed streams finish
+                await asyncio.sleep(0.2)
+    return {name: statistics.median(v) for name, v in samples.items()}
+
+
+async def run_all(repeat):
+    results = {}
+    for mode in (LISTEN, CONNECT):
+        for name, value in (await run_mode(mode, repeat)).items():
+            results['{}.{}'.format(mode, name)] = value
+            unit = METRICS[name][0]
+            print('{:<8} {:<20} {:12.2f} {}'.format(mode, name, value, unit))
+    return results
+
+
+def cmd_run(args):
+    results = run(run_all(args.repeat))
+    doc = {
+        'time': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(doc, f, indent=2, sort_keys=True)
+    return 0
+
+
+def compare(base, new, threshold):
+    """
+    Yield ``(metric, base value, new value, relative change, regression)``
+    for the metrics of both runs. The change is positive when the metric
+    got better.
+    """
+    for key in sorted(set(base) & set(new)):
+        higher_is_better = METRICS[key.split('.', 1)[1]][1]
+        old, value = base[key], new[key]
+        change = (value - old) / old if old else 0.0
+        if not higher_is_better:
+            change = -change
+        yield key, old, value, change, change < -threshold
+
+
+def cmd_compare(args):
+    with open(args.base) as f:
+        base = json.load(f)['results']
+    with open(args.new) as f:
+        new = json.load(f)['results']
+    regressions = 0
+    for key, old, value, change, regression in compare(
+        base, new, args.threshold
+    ):
+        regressions += regression
+        print('{:<30} {:12.2f} {:12.2f} {:+8.1%} {}'.format(
+            key, old, value, change, 'REGRESSION' if regression else ''
+        ))
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.suite',
+        description='End-to-end benchmarks of the tunnel.'
+    )
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    p = commands.add_parser('run', help='run the benchmarks')
+    p.add_argument('-o', '--output', help='write the results to this file')
+    p.add_argument(
+        '-r', '--repeat', type=int, default=3,
+        help='runs per benchmark, the median is reported (default 3)'
+    )
+    p.set_defaults(func=cmd_run)
+    p = commands.add_parser('compare', help='compare two result files')
+    p.add_argument('base')
+    p.add_argument('new')
+    p.add_argument(
+        '-t', '--threshold', type=float, default=0.1,
+        help='relative change counted as a regression (default 0.1)'
+    )
+    p.set_defaults(func=cmd_compare)
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
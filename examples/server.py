@@ -16,13 +16,19 @@ logger = logging.getLogger('aiowstunnel.server')
 
 
 async def serve(stop):
+    # starting this again while it runs upgrades it: the new process takes
+    # over the sockets, this one drains and exits
     srv = Server(
         '127.0.0.1', 4430,
         heartbeat_interval=100,
-        response_timeout=10
+        response_timeout=10,
+        handoff_path='/tmp/aiowstunnel-handoff'
     )
     srv.start()
-    await stop
+    await asyncio.wait(
+        [stop, asyncio.ensure_future(srv.wait_closed())],
+        return_when=asyncio.FIRST_COMPLETED
+    )
     await srv.close()
 
 
@@ -21,7 +21,7 @@ setup(
     ],
     keywords='tunneling TCP websocket',
     install_requires=[
-        'websockets >= 3.4'
+        'websockets >= 6.0'
     ],
     package_data={'aiowstunnel': ['resources/static/*/*', 'resources/*.*']},
     license='MIT',